@@ -135,6 +135,38 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Voice notes are kept out of MEDIA_ROOT so they are never served publicly;
+# swap AUDIO_STORAGE_BACKEND for any Django storage (e.g. S3) in production.
+AUDIO_STORAGE_ROOT = config('AUDIO_STORAGE_ROOT', default=os.path.join(BASE_DIR, 'private_media', 'audio'))
+
+# Largest voice note accepted over REST or WebSocket, enforced while the upload streams in
+CHAT_AUDIO_MAX_BYTES = config('CHAT_AUDIO_MAX_BYTES', default=10 * 1024 * 1024, cast=int)
+
+# Signed audio links are re-issued once per window so the URL (and the browser cache
+# entry behind it) stays the same within it; a link is accepted for two windows
+CHAT_AUDIO_URL_WINDOW_SECONDS = config('CHAT_AUDIO_URL_WINDOW_SECONDS', default=24 * 60 * 60, cast=int)
+
+# Resumable uploads stage their chunks here until they are committed
+CHAT_UPLOAD_TEMP_ROOT = config('CHAT_UPLOAD_TEMP_ROOT', default=os.path.join(BASE_DIR, 'private_media', 'uploads'))
+CHAT_UPLOAD_MAX_CHUNK_BYTES = config('CHAT_UPLOAD_MAX_CHUNK_BYTES', default=512 * 1024, cast=int)
+# Uncommitted uploads older than this are purged by chat.tasks.cleanup_stale_audio_uploads
+CHAT_UPLOAD_EXPIRY_HOURS = config('CHAT_UPLOAD_EXPIRY_HOURS', default=24, cast=int)
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+    'audio': {
+        'BACKEND': config('AUDIO_STORAGE_BACKEND', default='django.core.files.storage.FileSystemStorage'),
+        'OPTIONS': {
+            'location': AUDIO_STORAGE_ROOT,
+        },
+    },
+}
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -150,6 +182,16 @@ REST_FRAMEWORK = {
         'rest_framework_simplejwt.authentication.JWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',  # Keep for Django admin
     ],
+    # JSON goes through chat.codec (orjson when installed)
+    'DEFAULT_RENDERER_CLASSES': [
+        'chat.renderers.CodecJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'chat.parsers.CodecJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
 # JWT Configuration
@@ -185,6 +227,60 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Django cache (Redis DB 2); set CACHE_BACKEND=django.core.cache.backends.locmem.LocMemCache for tests
+CACHES = {
+    "default": {
+        "BACKEND": config('CACHE_BACKEND', default='django.core.cache.backends.redis.RedisCache'),
+        "LOCATION": config('CACHE_LOCATION', default=f"redis://{config('REDIS_HOST', default='redis')}:{config('REDIS_PORT', default=6379, cast=int)}/2"),
+    },
+}
+
+# How long a user's serialized first page of conversations may be served from cache
+CHAT_CONVERSATION_LIST_CACHE_TIMEOUT = config('CHAT_CONVERSATION_LIST_CACHE_TIMEOUT', default=300, cast=int)
+
+# Hard ceiling on a single channel-layer event; larger events are rejected and counted
+CHANNEL_LAYER_MAX_EVENT_BYTES = config('CHANNEL_LAYER_MAX_EVENT_BYTES', default=64 * 1024, cast=int)
+
+# Ephemeral events (typing) that the layer cannot take within this many seconds are dropped
+CHANNEL_LAYER_EPHEMERAL_SEND_TIMEOUT = config('CHANNEL_LAYER_EPHEMERAL_SEND_TIMEOUT', default=0.25, cast=float)
+
+# At most one "typing" broadcast per user per conversation per throttle window;
+# "stopped" is broadcast automatically after the TTL passes without a refresh
+CHAT_TYPING_THROTTLE_SECONDS = config('CHAT_TYPING_THROTTLE_SECONDS', default=3, cast=float)
+CHAT_TYPING_TTL_SECONDS = config('CHAT_TYPING_TTL_SECONDS', default=6, cast=float)
+
+# Delivery acks are buffered per socket and written at most once per interval
+CHAT_DELIVERY_ACK_FLUSH_SECONDS = config('CHAT_DELIVERY_ACK_FLUSH_SECONDS', default=0.3, cast=float)
+
+# Per-socket outbound queue (chat.outbound): frames held for a slow client before it is
+# disconnected, and how long a single write may block before the client counts as stuck
+CHAT_OUTBOUND_QUEUE_LIMIT = config('CHAT_OUTBOUND_QUEUE_LIMIT', default=256, cast=int)
+CHAT_OUTBOUND_STALL_SECONDS = config('CHAT_OUTBOUND_STALL_SECONDS', default=10, cast=float)
+
+# Write-behind persistence of socket messages (chat.write_behind): broadcast first, insert in
+# batches. The journal (Redis DB 3) keeps unflushed messages across crashes; blank disables it.
+CHAT_WRITE_BEHIND = config('CHAT_WRITE_BEHIND', default=False, cast=bool)
+CHAT_WRITE_BEHIND_FLUSH_SECONDS = config('CHAT_WRITE_BEHIND_FLUSH_SECONDS', default=0.05, cast=float)
+CHAT_WRITE_BEHIND_BATCH_SIZE = config('CHAT_WRITE_BEHIND_BATCH_SIZE', default=500, cast=int)
+CHAT_WRITE_BEHIND_JOURNAL_URL = config(
+    'CHAT_WRITE_BEHIND_JOURNAL_URL',
+    default=f"redis://{config('REDIS_HOST', default='redis')}:{config('REDIS_PORT', default=6379, cast=int)}/3",
+)
+CHAT_WRITE_BEHIND_JOURNAL_STREAM = config('CHAT_WRITE_BEHIND_JOURNAL_STREAM', default='chat:message-journal')
+CHAT_WRITE_BEHIND_REPLAY_AFTER_SECONDS = config('CHAT_WRITE_BEHIND_REPLAY_AFTER_SECONDS', default=60, cast=int)
+
+# Presence (chat.presence): sockets count as connections for CHAT_PRESENCE_TTL_SECONDS past their
+# last refresh, kept in Redis DB 4. Set CHAT_PRESENCE_BACKEND=chat.presence.InMemoryPresence for tests.
+# Users whose sockets vanish go offline at most TTL + SWEEP seconds after their last refresh.
+CHAT_PRESENCE_BACKEND = config('CHAT_PRESENCE_BACKEND', default='chat.presence.RedisPresence')
+CHAT_PRESENCE_REDIS_URL = config(
+    'CHAT_PRESENCE_REDIS_URL',
+    default=f"redis://{config('REDIS_HOST', default='redis')}:{config('REDIS_PORT', default=6379, cast=int)}/4",
+)
+CHAT_PRESENCE_TTL_SECONDS = config('CHAT_PRESENCE_TTL_SECONDS', default=15, cast=float)
+CHAT_PRESENCE_SWEEP_SECONDS = config('CHAT_PRESENCE_SWEEP_SECONDS', default=5, cast=float)
+CHAT_PRESENCE_SWEEP_BATCH_SIZE = config('CHAT_PRESENCE_SWEEP_BATCH_SIZE', default=500, cast=int)
+
 # Celery Configuration
 CELERY_BROKER_URL = config('CELERY_BROKER_URL', default='redis://redis:6379/1')  # Different DB from channels
 CELERY_RESULT_BACKEND = config('CELERY_RESULT_BACKEND', default='redis://redis:6379/1')
@@ -192,7 +288,27 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
-CELERY_BEAT_SCHEDULE = {}
+CELERY_BEAT_SCHEDULE = {
+    'cleanup-stale-audio-uploads': {
+        'task': 'chat.tasks.cleanup_stale_audio_uploads',
+        'schedule': timedelta(hours=1),
+    },
+    'flush-presence': {
+        'task': 'chat.tasks.flush_presence',
+        'schedule': timedelta(seconds=30),
+    },
+    'expire-presence': {
+        'task': 'chat.tasks.expire_presence',
+        'schedule': timedelta(seconds=CHAT_PRESENCE_SWEEP_SECONDS),
+        # A sweep that waited longer than the next one is redundant
+        'options': {'expires': CHAT_PRESENCE_SWEEP_SECONDS},
+    },
+}
+if CHAT_WRITE_BEHIND:
+    CELERY_BEAT_SCHEDULE['replay-message-journal'] = {
+        'task': 'chat.tasks.replay_message_journal',
+        'schedule': timedelta(minutes=1),
+    }
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60  # 30 minutes
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True  # Fix for Celery 6.0+ deprecation warning
@@ -0,0 +1,88 @@
+"""
+Ingest-time analysis of voice notes.
+
+Clips are parsed once when they are stored so clients can draw the player
+(duration and waveform) without downloading the audio. Only uncompressed
+PCM WAV is decoded; other containers are stored without a summary.
+"""
+import wave
+from typing import NamedTuple
+
+import numpy as np
+
+# Number of bars in the stored waveform summary
+PEAK_COUNT = 64
+
+PCM_DTYPES = {
+    1: np.uint8,   # 8-bit WAV is unsigned
+    2: np.dtype('<i2'),
+    4: np.dtype('<i4'),
+}
+
+
+class AudioMetadata(NamedTuple):
+    duration: float
+    sample_rate: int
+    peaks: list
+
+
+def downsample_peaks(amplitudes, peak_count=PEAK_COUNT):
+    """
+    Reduce per-frame amplitudes (0.0-1.0) to ``peak_count`` bucket maxima,
+    scaled to 0-255 so the summary stays compact in JSON.
+    """
+    frame_count = len(amplitudes)
+    if frame_count == 0:
+        return []
+    peak_count = min(peak_count, frame_count)
+    # Spread the frames evenly over the buckets, so every bucket holds audio
+    starts = np.linspace(0, frame_count, peak_count, endpoint=False).astype(np.intp)
+    peaks = np.maximum.reduceat(np.asarray(amplitudes, dtype=np.float32), starts)
+    return np.rint(np.clip(peaks, 0.0, 1.0) * 255).astype(np.uint8).tolist()
+
+
+def analyze_wav(audio_file, peak_count=PEAK_COUNT):
+    """Decode a PCM WAV file object into an AudioMetadata, or None if it is not one"""
+    try:
+        with wave.open(audio_file, 'rb') as wav:
+            channels = wav.getnchannels()
+            sample_width = wav.getsampwidth()
+            sample_rate = wav.getframerate()
+            frame_count = wav.getnframes()
+            raw = wav.readframes(frame_count)
+    except (wave.Error, EOFError):
+        return None
+
+    if sample_rate <= 0 or channels <= 0:
+        return None
+
+    if sample_width == 3:
+        # 24-bit: widen each little-endian sample to int32 by shifting into the top bytes
+        packed = np.frombuffer(raw, dtype=np.uint8)
+        packed = packed[:len(packed) - len(packed) % 3].reshape(-1, 3).astype(np.int32)
+        samples = (packed[:, 0] << 8 | packed[:, 1] << 16 | packed[:, 2] << 24) >> 8
+    elif sample_width in PCM_DTYPES:
+        samples = np.frombuffer(raw, dtype=PCM_DTYPES[sample_width])
+        if sample_width == 1:
+            samples = samples.astype(np.int16) - 128
+    else:
+        return None
+
+    samples = samples[:len(samples) - len(samples) % channels]
+    frames = samples.reshape(-1, channels)
+    full_scale = float(2 ** (8 * sample_width - 1))
+    amplitudes = np.abs(frames.astype(np.float32)).max(axis=1) / full_scale
+
+    return AudioMetadata(
+        duration=round(len(frames) / sample_rate, 3),
+        sample_rate=sample_rate,
+        peaks=downsample_peaks(amplitudes, peak_count),
+    )
+
+
+def analyze_audio(audio_file, mime_type):
+    """Summarize a clip if its format is one we can decode, else return None"""
+    if mime_type in ('audio/wav', 'audio/x-wav', 'audio/wave'):
+        audio_file.seek(0)
+        return analyze_wav(audio_file)
+    return None
@@ -0,0 +1,70 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.urls import reverse
+from rest_framework.authentication import BaseAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+
+
+class WindowedTimestampSigner(signing.TimestampSigner):
+    """
+    A TimestampSigner whose timestamp is the start of the current
+    CHAT_AUDIO_URL_WINDOW_SECONDS window, so signing the same value twice in
+    one window gives the same signature and browser caches keep working.
+    """
+
+    def timestamp(self):
+        window = settings.CHAT_AUDIO_URL_WINDOW_SECONDS
+        return signing.b62_encode(int(time.time()) // window * window)
+
+
+# Links expire, measured from the start of the window they were signed in, so each
+# one lasts at least a full window; the view still re-checks conversation membership
+# on every request.
+audio_url_signer = WindowedTimestampSigner(salt='chat.audio')
+
+
+def signed_audio_path(message_id, user):
+    """
+    Path to a message's audio, signed for ``user`` so that <audio src> can
+    fetch it without an Authorization header.
+    """
+    path = reverse('message_audio', args=[message_id])
+    if user is not None and user.is_authenticated:
+        signature = audio_url_signer.sign_object({'user': user.id, 'message': message_id})
+        path = f'{path}?sig={signature}'
+    return path
+
+
+def build_audio_url(message, request):
+    return request.build_absolute_uri(signed_audio_path(message.id, getattr(request, 'user', None)))
+
+
+class AudioURLSignatureAuthentication(BaseAuthentication):
+    """Authenticate audio requests carrying a ``sig`` from build_audio_url"""
+
+    def authenticate(self, request):
+        signature = request.query_params.get('sig')
+        if not signature:
+            return None
+
+        try:
+            payload = audio_url_signer.unsign_object(
+                signature, max_age=2 * settings.CHAT_AUDIO_URL_WINDOW_SECONDS
+            )
+        except signing.SignatureExpired:
+            raise AuthenticationFailed('Audio link has expired.')
+        except signing.BadSignature:
+            raise AuthenticationFailed('Invalid audio link.')
+
+        message_id = request.parser_context['kwargs'].get('message_id')
+        if payload.get('message') != message_id:
+            raise AuthenticationFailed('Audio link does not match this message.')
+
+        try:
+            user = User.objects.get(id=payload.get('user'), is_active=True)
+        except User.DoesNotExist:
+            raise AuthenticationFailed('User not found.')
+        return (user, None)
@@ -0,0 +1,65 @@
+"""
+JSON encoding for WebSocket frames and API responses.
+
+Uses orjson when it is installed and the standard library otherwise. Both
+paths emit compact UTF-8 JSON, hand anything they do not encode natively
+(datetimes, lazy strings, decimals, ...) to DRF's encoder, and encode integers
+wider than 64 bits through the standard library, so they produce the same
+bytes as each other and as DRF's compact JSONRenderer, with two exceptions:
+
+- NaN and infinities raise ValueError on the standard library path, as they
+  do in DRF, but orjson writes them as null.
+- U+2028 and U+2029 are left unescaped; CodecJSONRenderer escapes them in API
+  responses the way DRF does.
+"""
+import json
+
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # Optional: pip install orjson
+    orjson = None
+
+# orjson.JSONDecodeError subclasses this, so one except clause covers both backends
+DecodeError = json.JSONDecodeError
+
+_fallback = JSONEncoder().default
+# allow_nan=False: NaN is not JSON, and DRF's renderer refuses it too
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), allow_nan=False, default=_fallback)
+
+if orjson is not None:
+    BACKEND = 'orjson'
+    # DRF formats datetimes itself (UTC as "Z"); keep that rather than orjson's format
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps_bytes(obj):
+        try:
+            return orjson.dumps(obj, default=_fallback, option=_ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            # orjson rejects integers beyond 64 bits; anything else fails the same way here
+            return _encoder.encode(obj).encode()
+
+    def dumps(obj):
+        return dumps_bytes(obj).decode()
+
+    loads = orjson.loads
+else:
+    BACKEND = 'json'
+
+    def dumps(obj):
+        return _encoder.encode(obj)
+
+    def dumps_bytes(obj):
+        return _encoder.encode(obj).encode()
+
+    def loads(data):
+        return json.loads(data)
+
+
+def extend(encoded_object, fields):
+    """
+    Add ``fields`` to an already encoded, non-empty JSON object without
+    decoding it, e.g. to personalise one key of a frame shared by many sockets
+    """
+    return f'{encoded_object[:-1]},{dumps(fields)[1:]}'
@@ -1,31 +1,39 @@
-import json
+import asyncio
 import base64
+import time
+import struct
+import tempfile
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.contrib.auth.models import User
 from users.models import UserProfile
 from .models import Conversation, Message
 from .serializers import MessageSerializer, ConversationSerializer
+from .storage import store_audio, store_audio_file
+from .authentication import signed_audio_path
+from .utils import frame_event, group_send, group_send_ephemeral
+from . import codec, metrics, write_behind
+from .outbound import OutboundQueueMixin
+from .presence import PresenceMixin
+from .services import acreate_message, amark_delivered, amark_read
 from asgiref.sync import sync_to_async
 from django.urls import reverse
 from django.conf import settings
-from django.utils import timezone
 import random
 from channels.db import database_sync_to_async
-from django.shortcuts import get_object_or_404
 from rest_framework_simplejwt.tokens import UntypedToken
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from urllib.parse import parse_qs
-from .tasks import create_and_schedule_email_notification, cancel_pending_notifications_for_message
+from .tasks import create_and_schedule_email_notification
 
 # JWT authentication is now handled by middleware
 
-@database_sync_to_async
-def generate_unique_phone_number():
+def generate_unique_phone_number_sync():
     while True:
         number = f"03{random.randint(100000000, 999999999)}"
         if not UserProfile.objects.filter(phone_number=number).exists():
             return number
 
+generate_unique_phone_number = database_sync_to_async(generate_unique_phone_number_sync)
+
 def schedule_email_notification_sync(message_id):
     """Schedule email notification task - synchronous version"""
     try:
@@ -38,33 +46,79 @@ def schedule_email_notification_sync(message_id):
         logger.warning(f"Failed to schedule email notification for message {message_id}: {str(e)}")
         return None
 
-def cancel_email_notifications_sync(message_id):
-    """Cancel email notifications task - synchronous version"""
+# Binary audio frames: 4-byte big-endian header length, a JSON header, then raw audio bytes
+AUDIO_FRAME_HEADER_LENGTH = struct.Struct('!I')
+MAX_AUDIO_FRAME_HEADER_BYTES = 4096
+MAX_PENDING_AUDIO_UPLOADS = 4
+# Conversations one multiplexed socket may follow at once
+MAX_MULTIPLEX_SUBSCRIPTIONS = 100
+# Uploads larger than this spill from memory to a temporary file
+AUDIO_UPLOAD_SPOOL_BYTES = 1024 * 1024
+
+
+def parse_audio_frame(bytes_data):
+    """Split a binary frame into its JSON header dict and audio payload"""
+    prefix_size = AUDIO_FRAME_HEADER_LENGTH.size
+    if len(bytes_data) < prefix_size:
+        raise ValueError('Binary frame is too short')
+    (header_length,) = AUDIO_FRAME_HEADER_LENGTH.unpack_from(bytes_data)
+    if header_length > MAX_AUDIO_FRAME_HEADER_BYTES or prefix_size + header_length > len(bytes_data):
+        raise ValueError('Invalid binary frame header')
     try:
-        # Only try to cancel if Celery is working
-        return cancel_pending_notifications_for_message.delay(message_id)
-    except Exception as e:
-        # Log the error but don't break the messaging functionality
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.warning(f"Failed to cancel email notifications for message {message_id}: {str(e)}")
-        return None
+        header = codec.loads(bytes_data[prefix_size:prefix_size + header_length])
+    except (codec.DecodeError, UnicodeDecodeError):
+        raise ValueError('Invalid binary frame header')
+    if not isinstance(header, dict):
+        raise ValueError('Invalid binary frame header')
+    return header, memoryview(bytes_data)[prefix_size + header_length:]
+
+
+class AudioUpload:
+    """Audio bytes received so far for one upload_id, spooled to disk past a threshold"""
+
+    def __init__(self, header):
+        self.header = header
+        self.file = tempfile.SpooledTemporaryFile(max_size=AUDIO_UPLOAD_SPOOL_BYTES)
+        self.size = 0
+
+    def write(self, payload):
+        self.file.write(payload)
+        self.size += len(payload)
+
+    def close(self):
+        self.file.close()
 
-@database_sync_to_async
-def get_user_by_username(username):
-    return User.objects.get(username=username)
 
 @database_sync_to_async
-def get_userprofile_by_user(user):
-    return UserProfile.objects.get(user=user)
+def get_or_create_profile(user):
+    try:
+        return UserProfile.objects.get(user=user)
+    except UserProfile.DoesNotExist:
+        # Create profile if it doesn't exist (for Google users)
+        return UserProfile.objects.create(user=user, phone_number=generate_unique_phone_number_sync())
 
 @database_sync_to_async
-def get_conversation_by_id(conversation_id):
-    return Conversation.objects.get(id=conversation_id)
+def load_chat_membership(profile, conversation_id):
+    """
+    Load a conversation ``profile`` belongs to, with its participants (and their
+    users) prefetched, and return ``(conversation, participants)``. Raises
+    Conversation.DoesNotExist if ``profile`` is not a participant.
+    """
+    conversation = (
+        Conversation.objects
+        .prefetch_related('participants__user')
+        .get(id=conversation_id, memberships__profile=profile)
+    )
+    # Reuse the sender's own profile instance so presence updates apply to it
+    participants = [
+        profile if participant.id == profile.id else participant
+        for participant in conversation.participants.all()
+    ]
+    return conversation, participants
 
 @database_sync_to_async
-def get_message_by_id(message_id):
-    return get_object_or_404(Message, id=message_id)
+def get_conversation_message(message_id, conversation_id):
+    return Message.objects.get(id=message_id, conversation_id=conversation_id)
 
 @database_sync_to_async
 def update_message_content(message, content):
@@ -75,495 +129,783 @@ def update_message_content(message, content):
 def delete_message(message):
     message.delete()
 
-@database_sync_to_async
-def get_messages_by_ids(message_ids, recipient_profile):
-    return list(Message.objects.filter(
-        id__in=message_ids,
-        recipient=recipient_profile,
-        is_read=False
-    ))
 
-@database_sync_to_async
-def mark_messages_as_read(message_ids):
-    return Message.objects.filter(id__in=message_ids).update(is_read=True)
+class ChatMembership:
+    """
+    A socket's cached view of one conversation it is subscribed to: the
+    conversation, its participants and the recipient of outgoing messages.
+    Loaded once and reloaded only on a membership_changed event.
+    """
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        # Get authenticated user from middleware
-        self.user = self.scope.get('user')
-        
-        if self.user and not self.user.is_anonymous:
-            self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
-            self.room_group_name = f'chat_{self.conversation_id}'
-            await self.channel_layer.group_add(
-                self.room_group_name,
-                self.channel_name
-            )
-            
-            # Only mark user as online when connecting if they have valid authentication
-            # This prevents users from appearing online after they've logged out
-            try:
-                user_profile = await database_sync_to_async(UserProfile.objects.get)(user=self.user)
-                # Only set online if user has a valid session/token - 
-                # the middleware already validates the JWT token, so if we reach here, user is authenticated
-                user_profile.is_online = True
-                user_profile.last_seen = timezone.now()
-                await database_sync_to_async(user_profile.save)(update_fields=['is_online', 'last_seen'])
-            except UserProfile.DoesNotExist:
-                pass  # User profile doesn't exist yet
-            
-            await self.accept()
+    def __init__(self, conversation_id):
+        self.conversation_id = conversation_id
+        self.group_name = f'chat_{conversation_id}'
+        # Typing state for this socket's user (see ChatProtocolMixin.handle_typing)
+        self.typing_sent_at = None
+        self.typing_refreshed_at = None
+        self.typing_expiry = None
+        # Delivery acks: the highest id acked since the last flush, and the last one written
+        self.pending_delivered_up_to = 0
+        self.delivered_up_to = 0
+
+    async def load(self, profile):
+        self.conversation, self.participants = await load_chat_membership(profile, self.conversation_id)
+        # 1-to-1 chats: the other participant receives every message
+        self.recipient_profile = next(
+            (p for p in self.participants if p.id != profile.id), None
+        )
+
+
+class ChatProtocolMixin:
+    """
+    Chat actions and group events shared by ChatConsumer (one conversation per
+    socket) and MultiplexConsumer (any number per socket). Consumers provide
+    ``user``, ``user_profile``, ``audio_uploads`` and the hooks below.
+    """
+
+    # Pending flush of buffered delivery acks (see handle_ack)
+    delivery_flush = None
+
+    def subscribed_memberships(self):
+        """Every ChatMembership this socket currently follows"""
+        raise NotImplementedError
+
+    def membership_for(self, data):
+        """The subscribed ChatMembership a client frame or group event refers to, or None"""
+        raise NotImplementedError
+
+    async def send_chat(self, membership, payload):
+        """Deliver a payload belonging to ``membership``'s conversation to the client"""
+        raise NotImplementedError
+
+    async def membership_lost(self, membership):
+        """The user is no longer a participant of ``membership``'s conversation"""
+        raise NotImplementedError
+
+    async def send_error(self, error, membership=None, **extra):
+        payload = {'error': error, **extra}
+        if membership is not None:
+            await self.send_chat(membership, payload)
         else:
-            await self.close(code=4001)  # Unauthorized
+            await self.send(text_data=codec.dumps(payload))
 
-    async def disconnect(self, close_code):
-        # Mark user as offline when disconnecting
-        if hasattr(self, 'user') and self.user and not self.user.is_anonymous:
-            try:
-                user_profile = await database_sync_to_async(UserProfile.objects.get)(user=self.user)
-                user_profile.is_online = False
-                user_profile.last_seen = timezone.now()
-                await database_sync_to_async(user_profile.save)(update_fields=['is_online', 'last_seen'])
-            except UserProfile.DoesNotExist:
-                pass  # User profile doesn't exist yet
-        
-        # Only try to leave group if connection was established
-        if hasattr(self, 'room_group_name'):
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
+    async def membership_changed(self, event):
+        """Participants or profiles changed (see utils.send_membership_changed): reload them"""
+        membership = self.membership_for(event)
+        if membership is None:
+            return
+        try:
+            await membership.load(self.user_profile)
+        except Conversation.DoesNotExist:
+            await self.membership_lost(membership)
 
-    async def receive(self, text_data):
+    async def receive_chat_frame(self, membership, data):
         try:
-            data = json.loads(text_data)
             action_type = data.get('action_type', 'send')
             content = data.get('content')
-            sender_username = data.get('sender_username')
             message_type = data.get('message_type', 'text')
             audio_data_base64 = data.get('audio_data_base64')
-            message_id = data.get('message_id')
-            
+
             # Handle different action types
             if action_type == 'edit':
-                await self.edit_message(data)
+                await self.edit_message(membership, data)
                 return
             elif action_type == 'delete':
-                await self.delete_message(data)
+                await self.delete_message(membership, data)
                 return
             elif action_type == 'typing':
-                await self.handle_typing(data)
+                await self.handle_typing(membership, data)
                 return
             elif action_type == 'stop_typing':
-                await self.handle_stop_typing(data)
+                await self.handle_stop_typing(membership, data)
                 return
             elif action_type == 'mark_read':
-                await self.handle_mark_read(data)
+                await self.handle_mark_read(membership, data)
                 return
-            
-            # Validate required fields for message creation
-            if not sender_username:
-                await self.send(text_data=json.dumps({'error': 'sender_username is required'}))
+            elif action_type == 'ack':
+                await self.handle_ack(membership, data)
                 return
-                
+
+            # Validate required fields for message creation
             if not content and message_type == 'text':
-                await self.send(text_data=json.dumps({'error': 'content is required for text messages'}))
+                await self.send_error('content is required for text messages', membership)
                 return
-                
+
             if message_type == 'audio' and not audio_data_base64:
-                await self.send(text_data=json.dumps({'error': 'audio_data_base64 is required for audio messages'}))
+                await self.send_error('audio_data_base64 is required for audio messages', membership)
                 return
 
-            # Find sender User
-            sender_user = await database_sync_to_async(User.objects.get)(username=sender_username)
-            
-            # Get or create UserProfile for sender
-            try:
-                sender_profile = await database_sync_to_async(UserProfile.objects.get)(user=sender_user)
-            except UserProfile.DoesNotExist:
-                # Create profile if it doesn't exist (for Google users)
-                phone = await generate_unique_phone_number()
-                sender_profile = await database_sync_to_async(UserProfile.objects.create)(
-                    user=sender_user,
-                    phone_number=phone
-                )
-
-            # Fetch conversation
-            conversation = await database_sync_to_async(Conversation.objects.get)(id=self.conversation_id)
-
-            # Find recipient: all participants except the sender
-            participants = await database_sync_to_async(lambda: list(conversation.participants.all()))()
-            recipient_profiles = [p for p in participants if p.id != sender_profile.id]
-            
-            if not recipient_profiles:
-                raise ValueError("No recipient found in conversation")
-                
-            recipient_profile = recipient_profiles[0]
-
-            # Process audio data if present
-            audio_data = None
+            # Legacy base64 upload path; binary frames (receive_audio_frame) avoid the decode
+            stored_audio = None
             if message_type == 'audio' and audio_data_base64:
-                import base64
+                if len(audio_data_base64) * 3 // 4 > settings.CHAT_AUDIO_MAX_BYTES:
+                    await self.send_error('Audio message is too large', membership)
+                    return
                 audio_data = base64.b64decode(audio_data_base64)
+                stored_audio = await sync_to_async(store_audio)(audio_data)
 
-            # Create the message
-            message = await database_sync_to_async(Message.objects.create)(
-                conversation=conversation,
-                sender=sender_user,
-                recipient=recipient_profile,
-                content=content,
-                message_type=message_type,
-                audio_data=audio_data
-            )
+            await self.create_message(membership, content, message_type, stored_audio)
+        except Exception as e:
+            await self.send_error(str(e), membership)
 
-            # Auto-restore conversation for participants who deleted it
-            for participant in await database_sync_to_async(lambda: list(conversation.participants.all()))():
-                if await database_sync_to_async(lambda: participant in conversation.deleted_by.all())():
-                    await database_sync_to_async(conversation.deleted_by.remove)(participant)
-                    # DO NOT clear deletion timestamp - keep it so user only sees messages after deletion
-                    # The deletion timestamp should persist even after restoration
+    async def receive_audio_frame(self, bytes_data):
+        """
+        Handle a binary audio frame (see parse_audio_frame). A clip may span
+        several frames sharing an ``upload_id``; the last one sets ``final``.
+        Bytes are spooled to a temporary file and the size limit is checked
+        per frame, so an oversized clip is dropped as soon as it crosses it.
+        """
+        try:
+            header, payload = parse_audio_frame(bytes_data)
+        except ValueError as e:
+            await self.send_error(str(e))
+            return
 
-            # Build absolute URL for profile pictures
-            base_url = f"{settings.BASE_API_URL}"
-            sender_picture_url = None
-            recipient_picture_url = None
+        upload_id = str(header.get('upload_id', ''))
+        upload = self.audio_uploads.get(upload_id)
+        if upload is None:
+            if len(self.audio_uploads) >= MAX_PENDING_AUDIO_UPLOADS:
+                await self.send_error('Too many audio uploads in progress')
+                return
+            if self.membership_for(header) is None:
+                await self.send_error('Not subscribed to this conversation', upload_id=upload_id)
+                return
+            upload = self.audio_uploads[upload_id] = AudioUpload(header)
 
-            if sender_profile.profile_picture:
-                sender_picture_url = f"{base_url}{sender_profile.profile_picture.url}"
-            if recipient_profile and recipient_profile.profile_picture:
-                recipient_picture_url = f"{base_url}{recipient_profile.profile_picture.url}"
+        if upload.size + len(payload) > settings.CHAT_AUDIO_MAX_BYTES:
+            self.audio_uploads.pop(upload_id).close()
+            await self.send_error('Audio message is too large', upload_id=upload_id)
+            return
+        upload.write(payload)
 
-            # Prepare response data
-            response_data = {
-                "id": message.id,
-                "content": message.content,
-                "sender_username": sender_username,
-                "timestamp": message.timestamp.isoformat(),
-                "is_delivered": message.is_delivered,
-                "is_read": message.is_read,
-                "sender_profile_picture": sender_picture_url,
-                "recipient_profile_picture": recipient_picture_url,
-                "message_type": message.message_type
-            }
-            
-            # Add audio data if present
-            if message.message_type == 'audio' and message.audio_data:
-                import base64
-                response_data["audio_data_base64"] = base64.b64encode(message.audio_data).decode('utf-8')
+        if not header.get('final'):
+            return
 
-            # Email notifications are now handled automatically by Django signals
+        del self.audio_uploads[upload_id]
+        try:
+            # The first frame's header names the conversation
+            membership = self.membership_for(upload.header)
+            if membership is None:
+                await self.send_error('Not subscribed to this conversation', upload_id=upload_id)
+                return
+            if not upload.size:
+                await self.send_error('Audio message is empty', membership)
+                return
+            stored_audio = await sync_to_async(store_audio_file)(
+                upload.file, upload.header.get('mime_type')
+            )
+        finally:
+            upload.close()
 
-            # Broadcast to the group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "chat_message",
-                    "message": response_data,
-                }
+        try:
+            await self.create_message(
+                membership,
+                upload.header.get('content') or 'Audio message',
+                'audio',
+                stored_audio,
             )
-        except User.DoesNotExist:
-            await self.send(text_data=json.dumps({'error': 'User not found'}))
-        except Conversation.DoesNotExist:
-            await self.send(text_data=json.dumps({'error': 'Conversation not found'}))
         except Exception as e:
-            await self.send(text_data=json.dumps({'error': str(e)}))
+            await self.send_error(str(e), membership)
+
+    async def create_message(self, membership, content, message_type, stored_audio=None):
+        # Sender, conversation and recipient were resolved when the socket subscribed;
+        # the only query on the way in is the INSERT and its summary updates
+        sender_profile = self.user_profile
+        recipient_profile = membership.recipient_profile
+        if recipient_profile is None:
+            raise ValueError("No recipient found in conversation")
+
+        # With write-behind on, the message is broadcast before its batch is inserted
+        save = write_behind.submit_message if settings.CHAT_WRITE_BEHIND else acreate_message
+        message = await save(
+            membership.conversation,
+            self.user,
+            recipient_profile,
+            content,
+            message_type,
+            stored_audio=stored_audio,
+            participant_ids=[p.id for p in membership.participants],
+        )
+
+        # Build absolute URL for profile pictures
+        base_url = f"{settings.BASE_API_URL}"
+        sender_picture_url = None
+        recipient_picture_url = None
+
+        if sender_profile.profile_picture:
+            sender_picture_url = f"{base_url}{sender_profile.profile_picture.url}"
+        if recipient_profile and recipient_profile.profile_picture:
+            recipient_picture_url = f"{base_url}{recipient_profile.profile_picture.url}"
+
+        # Prepare response data
+        response_data = {
+            "id": message.id,
+            "content": message.content,
+            "sender_username": self.user.username,
+            "timestamp": message.timestamp.isoformat(),
+            "is_delivered": message.is_delivered,
+            "is_read": message.is_read,
+            "sender_profile_picture": sender_picture_url,
+            "recipient_profile_picture": recipient_picture_url,
+            "message_type": message.message_type
+        }
+
+        # Attachments are referenced, never inlined; each receiver signs its own URL in chat_message
+        response_data.update(message.attachment_metadata())
+
+        # Email notifications are now handled automatically by Django signals
+
+        # Broadcast to the group; audio receivers splice in their own signed URL
+        audio_fields = {'audio_message_id': message.id} if message.has_audio else {}
+        sent = await group_send(
+            self.channel_layer,
+            membership.group_name,
+            self.chat_frame_event(membership, "chat_message", response_data, **audio_fields)
+        )
+        if not sent:
+            await self.send_error('Message saved but too large to broadcast', membership, id=message.id)
+
+    def chat_frame_event(self, membership, event_type, payload, **fields):
+        """A frame_event for ``membership``'s group; the frame names the conversation"""
+        return frame_event(
+            event_type,
+            {**payload, 'conversation_id': membership.conversation_id},
+            conversation_id=membership.conversation_id,
+            **fields
+        )
 
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event["message"]))
-        
-    async def edit_message(self, data):
+        membership = self.membership_for(event)
+        if membership is None:
+            return
+        frame = event['frame']
+        if event.get('audio_message_id'):
+            # The only per-receiver part of a message: the audio URL is signed for this user
+            audio_path = signed_audio_path(event['audio_message_id'], self.user)
+            frame = codec.extend(frame, {'audio_url': f"{settings.BASE_API_URL}{audio_path}"})
+        await self.send(text_data=frame, coalesce_key=event.get('coalesce_key'))
+
+    async def edit_message(self, membership, data):
         try:
             message_id = data.get('message_id')
             content = data.get('content')
-            sender_username = data.get('sender_username')
-            
-            if not message_id or not content or not sender_username:
-                await self.send(text_data=json.dumps({
-                    'error': 'Missing required fields for editing message'
-                }))
+
+            if not message_id or not content:
+                await self.send_error('Missing required fields for editing message', membership)
                 return
-                
-            # Get the sender user
-            sender_user = await get_user_by_username(sender_username)
-            
+
             # Get the message and verify ownership
-            message = await get_message_by_id(message_id)
-            
-            if message.sender.id != sender_user.id:
-                await self.send(text_data=json.dumps({
-                    'error': 'You do not have permission to edit this message'
-                }))
+            message = await get_conversation_message(message_id, membership.conversation_id)
+
+            if message.sender_id != self.user.id:
+                await self.send_error('You do not have permission to edit this message', membership)
                 return
-                
+
             # Verify message type is text
             if message.message_type != 'text':
-                await self.send(text_data=json.dumps({
-                    'error': 'Only text messages can be edited'
-                }))
+                await self.send_error('Only text messages can be edited', membership)
                 return
-                
+
             # Update the message
             await update_message_content(message, content)
-            
+
             # Prepare response data
             response_data = {
                 'action_type': 'edit',
                 'id': message_id,
                 'content': content.strip(),
-                'sender_username': sender_username,
+                'sender_username': self.user.username,
                 'timestamp': message.timestamp.isoformat(),
                 'message_type': 'text'
             }
-            
+
             # Broadcast to the group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': response_data,
-                }
+            await group_send(
+                self.channel_layer,
+                membership.group_name,
+                self.chat_frame_event(
+                    membership, 'chat_message', response_data,
+                    coalesce_key=f'message:{membership.conversation_id}:{message_id}'
+                )
             )
-            
-        except User.DoesNotExist:
-            await self.send(text_data=json.dumps({'error': 'User not found'}))
+
         except Message.DoesNotExist:
-            await self.send(text_data=json.dumps({'error': 'Message not found'}))
+            await self.send_error('Message not found', membership)
         except Exception as e:
-            await self.send(text_data=json.dumps({'error': str(e)}))
-    
-    async def delete_message(self, data):
+            await self.send_error(str(e), membership)
+
+    async def delete_message(self, membership, data):
         try:
             message_id = data.get('message_id')
-            sender_username = data.get('sender_username')
-            
-            if not message_id or not sender_username:
-                await self.send(text_data=json.dumps({
-                    'error': 'Missing required fields for deleting message'
-                }))
+
+            if not message_id:
+                await self.send_error('Missing required fields for deleting message', membership)
                 return
-                
-            # Get the sender user
-            sender_user = await get_user_by_username(sender_username)
-            
+
             # Get the message and verify ownership
-            message = await get_message_by_id(message_id)
-            
-            if message.sender.id != sender_user.id:
-                await self.send(text_data=json.dumps({
-                    'error': 'You do not have permission to delete this message'
-                }))
+            message = await get_conversation_message(message_id, membership.conversation_id)
+
+            if message.sender_id != self.user.id:
+                await self.send_error('You do not have permission to delete this message', membership)
                 return
-                
+
             # Delete the message
             await delete_message(message)
-            
+
             # Prepare response data
             response_data = {
                 'action_type': 'delete',
                 'id': message_id,
-                'sender_username': sender_username
+                'sender_username': self.user.username
             }
-            
+
             # Broadcast to the group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': response_data,
-                }
+            await group_send(
+                self.channel_layer,
+                membership.group_name,
+                self.chat_frame_event(
+                    membership, 'chat_message', response_data,
+                    coalesce_key=f'message:{membership.conversation_id}:{message_id}'
+                )
             )
-            
-        except User.DoesNotExist:
-            await self.send(text_data=json.dumps({'error': 'User not found'}))
+
         except Message.DoesNotExist:
-            await self.send(text_data=json.dumps({'error': 'Message not found'}))
+            await self.send_error('Message not found', membership)
         except Exception as e:
-            await self.send(text_data=json.dumps({'error': str(e)}))
-    
-    async def handle_typing(self, data):
-        """Handle typing indicator"""
+            await self.send_error(str(e), membership)
+
+    async def handle_typing(self, membership, data):
+        """
+        Handle typing indicator. Clients may send this on every keystroke; it is
+        broadcast at most once per CHAT_TYPING_THROTTLE_SECONDS, and a "stopped"
+        follows automatically once no refresh has arrived for CHAT_TYPING_TTL_SECONDS.
+        """
+        now = time.monotonic()
+        membership.typing_refreshed_at = now
+        if membership.typing_expiry is None:
+            membership.typing_expiry = asyncio.ensure_future(self.expire_typing(membership))
+
+        if (
+            membership.typing_sent_at is not None
+            and now - membership.typing_sent_at < settings.CHAT_TYPING_THROTTLE_SECONDS
+        ):
+            metrics.increment(metrics.TYPING_EVENTS_COALESCED)
+            return
+        membership.typing_sent_at = now
+        await self.broadcast_typing(membership, True)
+
+    async def handle_stop_typing(self, membership, data):
+        """Handle stop typing indicator"""
+        await self.stop_typing(membership)
+
+    async def stop_typing(self, membership):
+        """Broadcast "stopped" if peers were told this user is typing"""
+        if membership.typing_expiry is not None:
+            membership.typing_expiry.cancel()
+            membership.typing_expiry = None
+        if membership.typing_sent_at is None:
+            return
+        membership.typing_sent_at = None
+        await self.broadcast_typing(membership, False)
+
+    async def expire_typing(self, membership):
+        """Stop typing once refreshes have lapsed for CHAT_TYPING_TTL_SECONDS"""
+        while True:
+            remaining = membership.typing_refreshed_at + settings.CHAT_TYPING_TTL_SECONDS - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        # Clear the handle first so stop_typing does not cancel this task
+        membership.typing_expiry = None
+        await self.stop_typing(membership)
+
+    async def broadcast_typing(self, membership, is_typing):
         try:
-            sender_username = data.get('sender_username')
-            if not sender_username:
-                return
-            
-            # Broadcast typing indicator to the group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'typing_indicator',
-                    'username': sender_username,
-                    'is_typing': True
-                }
+            await group_send_ephemeral(
+                self.channel_layer,
+                membership.group_name,
+                self.chat_frame_event(membership, 'typing_indicator', {
+                    'action_type': 'typing_indicator',
+                    'username': self.user.username,
+                    'is_typing': is_typing,
+                }, ephemeral=True, coalesce_key=f'typing:{membership.conversation_id}:{self.user.username}',
+                    sent_at=time.time())
             )
         except Exception as e:
-            await self.send(text_data=json.dumps({'error': str(e)}))
-    
-    async def handle_stop_typing(self, data):
-        """Handle stop typing indicator"""
+            await self.send_error(str(e), membership)
+
+    async def handle_mark_read(self, membership, data):
+        """
+        Move the reader's watermark to ``message_id``: one write and one
+        read_up_to broadcast however many messages it covers
+        """
         try:
-            sender_username = data.get('sender_username')
-            if not sender_username:
+            message_id = data.get('message_id')
+            if message_id is None:
+                # Older clients list every message they have seen; the newest is the watermark
+                message_id = max((int(i) for i in data.get('message_ids') or []), default=None)
+            if message_id is None:
                 return
-            
-            # Broadcast stop typing indicator to the group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'typing_indicator',
-                    'username': sender_username,
-                    'is_typing': False
-                }
-            )
+
+            await amark_read(membership.conversation, self.user, self.user_profile, int(message_id))
+
         except Exception as e:
-            await self.send(text_data=json.dumps({'error': str(e)}))
-    
-    async def handle_mark_read(self, data):
-        """Handle marking messages as read"""
+            await self.send_error(str(e), membership)
+
+    async def handle_ack(self, membership, data):
+        """
+        The client has received every message up to ``message_id``. Acks are
+        buffered per conversation and written by one flush every
+        CHAT_DELIVERY_ACK_FLUSH_SECONDS, so a burst of messages costs one write
+        and one delivered_up_to broadcast rather than one per message.
+        """
         try:
-            reader_username = data.get('reader_username')
-            message_ids = data.get('message_ids', [])
-            
-            if not reader_username or not message_ids:
-                return
-            
-            # Get the reader user
-            reader_user = await get_user_by_username(reader_username)
-            reader_profile = await get_userprofile_by_user(reader_user)
-            
-            # Mark messages as read
-            messages = await get_messages_by_ids(message_ids, reader_profile)
-            
-            if messages:
-                # Update messages to read
-                message_ids_to_update = [msg.id for msg in messages]
-                await mark_messages_as_read(message_ids_to_update)
-                
-                # Cancel pending email notifications for read messages
-                for message in messages:
-                    await sync_to_async(cancel_email_notifications_sync)(message.id)
-                for message in messages:
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            'type': 'read_receipt',
-                            'message_id': message.id,
-                            'reader_username': reader_username
-                        }
-                    )
-                    
-        except User.DoesNotExist:
-            await self.send(text_data=json.dumps({'error': 'User not found'}))
-        except UserProfile.DoesNotExist:
-            await self.send(text_data=json.dumps({'error': 'User profile not found'}))
+            message_id = int(data.get('message_id'))
+        except (TypeError, ValueError):
+            await self.send_error('message_id is required', membership)
+            return
+        if message_id <= max(membership.delivered_up_to, membership.pending_delivered_up_to):
+            return
+        membership.pending_delivered_up_to = message_id
+        if self.delivery_flush is None:
+            self.delivery_flush = asyncio.ensure_future(self.flush_delivery_acks_later())
+
+    async def flush_delivery_acks_later(self):
+        await asyncio.sleep(settings.CHAT_DELIVERY_ACK_FLUSH_SECONDS)
+        # Clear the handle first so acks arriving during the flush schedule the next one
+        self.delivery_flush = None
+        await self.flush_delivery_acks()
+
+    async def flush_delivery_acks(self):
+        for membership in self.subscribed_memberships():
+            await self.flush_delivery_ack(membership)
+
+    async def flush_delivery_ack(self, membership):
+        message_id = membership.pending_delivered_up_to
+        if message_id <= membership.delivered_up_to:
+            return
+        membership.pending_delivered_up_to = 0
+        membership.delivered_up_to = message_id
+        try:
+            await amark_delivered(membership.conversation, self.user, self.user_profile, message_id)
         except Exception as e:
-            await self.send(text_data=json.dumps({'error': str(e)}))
-    
+            await self.send_error(str(e), membership)
+
+    async def delivered_up_to(self, event):
+        """Send a delivery watermark to WebSocket: recipient_username's client has everything up to message_id"""
+        if self.membership_for(event) is not None:
+            await self.send_event_frame(event)
+
     async def typing_indicator(self, event):
-        """Send typing indicator to WebSocket"""
-        await self.send(text_data=json.dumps({
-            'action_type': 'typing_indicator',
-            'username': event['username'],
-            'is_typing': event['is_typing']
-        }))
-    
-    async def read_receipt(self, event):
-        """Send read receipt to WebSocket"""
-        await self.send(text_data=json.dumps({
-            'action_type': 'read_receipt',
-            'message_id': event['message_id'],
-            'reader_username': event['reader_username']
-        }))
-
-
-class ConversationListConsumer(AsyncWebsocketConsumer):
+        """Send typing indicator to WebSocket, unless it sat in a backlog long enough to be stale"""
+        membership = self.membership_for(event)
+        if membership is None:
+            return
+        if time.time() - event.get('sent_at', time.time()) > settings.CHAT_TYPING_TTL_SECONDS:
+            metrics.increment(metrics.EPHEMERAL_EVENTS_DROPPED)
+            return
+        await self.send_event_frame(event)
+
+    async def presence_changed(self, event):
+        """Send a participant coming online or going offline to WebSocket"""
+        if self.membership_for(event) is not None and event['user_id'] != self.user.id:
+            await self.send_event_frame(event)
+
+    async def read_up_to(self, event):
+        """Send a read watermark to WebSocket: every message up to message_id is read by reader_username"""
+        if self.membership_for(event) is not None:
+            await self.send_event_frame(event)
+
+
+class ConversationListEventsMixin:
+    """Deliver events sent to a user's conversation-list group (see chat.utils)"""
+
+    # Handle conversation updates
+    async def conversation_update(self, event):
+        """
+        Send conversation update to WebSocket, as encoded once by send_conversation_update
+        with this user's unread count and audio link filled in
+        """
+        payload = codec.loads(event['frame'])
+        conversation = payload['conversation']
+        conversation['unread_count'] = event.get('unread_counts', {}).get(str(self.user.id), 0)
+        if event.get('audio_message_id') and conversation.get('last_message'):
+            # Signed for this user, like chat_message's audio_url
+            audio_path = signed_audio_path(event['audio_message_id'], self.user)
+            conversation['last_message']['audio_url'] = f"{settings.BASE_API_URL}{audio_path}"
+        await self.send(text_data=codec.dumps(payload), coalesce_key=event.get('coalesce_key'))
+
+    # Handle conversation deletion
+    async def conversation_delete(self, event):
+        """Send conversation deletion to WebSocket"""
+        await self.send_event_frame(event)
+
+
+class ChatConsumer(PresenceMixin, OutboundQueueMixin, ChatProtocolMixin, AsyncWebsocketConsumer):
+    """One socket per open conversation, at ws/chat/<conversation_id>/"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # In-progress binary audio uploads keyed by client-chosen upload_id
+        self.audio_uploads = {}
+        self.membership = None
+
     async def connect(self):
         # Get authenticated user from middleware
         self.user = self.scope.get('user')
-        
+
+        if self.user and not self.user.is_anonymous:
+            # Identity comes from the authenticated scope, never the payload; it is
+            # resolved once here and reused until a membership_changed event arrives
+            self.user_profile = await get_or_create_profile(self.user)
+            membership = ChatMembership(int(self.scope['url_route']['kwargs']['conversation_id']))
+            try:
+                await membership.load(self.user_profile)
+            except Conversation.DoesNotExist:
+                await self.close(code=4003)  # Not a participant
+                return
+            self.membership = membership
+
+            await self.channel_layer.group_add(
+                membership.group_name,
+                self.channel_name
+            )
+
+            # Only count the socket toward presence once the user is authenticated
+            # This prevents users from appearing online after they've logged out
+            # the middleware already validates the JWT token, so if we reach here, user is authenticated
+            await self.join_presence()
+
+            await self.accept()
+        else:
+            await self.close(code=4001)  # Unauthorized
+
+    def membership_for(self, data):
+        return self.membership
+
+    def subscribed_memberships(self):
+        return [self.membership] if self.membership is not None else []
+
+    async def send_chat(self, membership, payload):
+        await self.send(text_data=codec.dumps(payload))
+
+    async def membership_lost(self, membership):
+        await self.close(code=4003)  # Removed from the conversation
+
+    async def disconnect(self, close_code):
+        # Drop any half-received audio uploads
+        for upload in self.audio_uploads.values():
+            upload.close()
+        self.audio_uploads.clear()
+        # Buffered acks are flushed below rather than by the timer
+        if self.delivery_flush is not None:
+            self.delivery_flush.cancel()
+
+        # Only try to leave group if connection was established
+        if self.membership is not None:
+            await self.stop_typing(self.membership)
+            await self.flush_delivery_ack(self.membership)
+            await self.channel_layer.group_discard(
+                self.membership.group_name,
+                self.channel_name
+            )
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            await self.receive_audio_frame(bytes_data)
+            return
+        try:
+            data = codec.loads(text_data)
+        except codec.DecodeError as e:
+            await self.send_error(str(e))
+            return
+        await self.receive_chat_frame(self.membership, data)
+
+
+class ConversationListConsumer(PresenceMixin, OutboundQueueMixin, ConversationListEventsMixin, AsyncWebsocketConsumer):
+    async def connect(self):
+        # Get authenticated user from middleware
+        self.user = self.scope.get('user')
+
         if self.user and not self.user.is_anonymous:
             # Create a unique group for this user's conversation updates
             self.user_group_name = f'user_conversations_{self.user.id}'
-            
+
             # Join user-specific conversation group
             await self.channel_layer.group_add(
                 self.user_group_name,
                 self.channel_name
             )
-            
-            # Mark user as online when connecting to conversation list (main presence indicator)
-            try:
-                user_profile = await database_sync_to_async(UserProfile.objects.get)(user=self.user)
-                user_profile.is_online = True
-                user_profile.last_seen = timezone.now()
-                await database_sync_to_async(user_profile.save)(update_fields=['is_online', 'last_seen'])
-            except UserProfile.DoesNotExist:
-                pass  # User profile doesn't exist yet
-            
+
+            # Count this socket toward the user's presence (main presence indicator)
+            self.user_profile = await get_or_create_profile(self.user)
+            await self.join_presence()
+
             await self.accept()
         else:
             await self.close(code=4001)  # Unauthorized
-    
+
     async def disconnect(self, close_code):
-        # Mark user as offline when disconnecting from conversation list
-        if hasattr(self, 'user') and self.user and not self.user.is_anonymous:
-            try:
-                user_profile = await database_sync_to_async(UserProfile.objects.get)(user=self.user)
-                user_profile.is_online = False
-                user_profile.last_seen = timezone.now()
-                await database_sync_to_async(user_profile.save)(update_fields=['is_online', 'last_seen'])
-            except UserProfile.DoesNotExist:
-                pass  # User profile doesn't exist yet
-        
         # Leave user-specific conversation group
         if hasattr(self, 'user_group_name'):
             await self.channel_layer.group_discard(
                 self.user_group_name,
                 self.channel_name
             )
-    
+
     async def receive(self, text_data):
         # Handle ping/pong and heartbeat messages
         try:
-            data = json.loads(text_data)
+            data = codec.loads(text_data)
             message_type = data.get('type')
-            
+
             if message_type == 'ping':
-                # Update last_seen time on heartbeat
-                if hasattr(self, 'user') and self.user and not self.user.is_anonymous:
-                    try:
-                        user_profile = await database_sync_to_async(UserProfile.objects.get)(user=self.user)
-                        user_profile.last_seen = timezone.now()
-                        await database_sync_to_async(user_profile.save)(update_fields=['last_seen'])
-                    except UserProfile.DoesNotExist:
-                        pass
-                
-                await self.send(text_data=json.dumps({'type': 'pong'}))
+                # Refresh presence (and last_seen) on heartbeat
+                await self.touch_presence()
+                await self.send(text_data=codec.dumps({'type': 'pong'}))
             elif message_type == 'heartbeat':
                 # Update user activity timestamp
-                if hasattr(self, 'user') and self.user and not self.user.is_anonymous:
-                    try:
-                        user_profile = await database_sync_to_async(UserProfile.objects.get)(user=self.user)
-                        user_profile.last_seen = timezone.now()
-                        await database_sync_to_async(user_profile.save)(update_fields=['last_seen'])
-                    except UserProfile.DoesNotExist:
-                        pass
-        except json.JSONDecodeError:
+                await self.touch_presence()
+        except codec.DecodeError:
             pass
-    
-    # Handle conversation updates
-    async def conversation_update(self, event):
-        """Send conversation update to WebSocket"""
-        await self.send(text_data=json.dumps({
-            'type': 'conversation_update',
-            'conversation': event['conversation'],
-            'is_new': event.get('is_new', False)
-        }))
-    
-    # Handle conversation deletion
-    async def conversation_delete(self, event):
-        """Send conversation deletion to WebSocket"""
-        await self.send(text_data=json.dumps({
-            'type': 'conversation_delete',
-            'conversation_id': event['conversation_id']
-        }))
+
+
+class MultiplexConsumer(PresenceMixin, OutboundQueueMixin, ChatProtocolMixin, ConversationListEventsMixin, AsyncWebsocketConsumer):
+    """
+    One socket per user, at ws/multiplex/, carrying any number of conversations
+    plus the conversation list. The client manages subscriptions with
+
+        {"action_type": "subscribe" | "unsubscribe", "conversation_id": <id>}
+        {"action_type": "subscribe_list" | "unsubscribe_list"}
+
+    Every other frame is a ChatConsumer frame with a ``conversation_id`` added
+    (binary audio frames put it in their JSON header), and every conversation
+    event sent back carries its ``conversation_id``. List events and pings
+    look exactly as on ConversationListConsumer.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.audio_uploads = {}
+        # Subscribed conversations by id
+        self.memberships = {}
+        self.user_group_name = None
+
+    async def connect(self):
+        self.user = self.scope.get('user')
+        if not self.user or self.user.is_anonymous:
+            await self.close(code=4001)  # Unauthorized
+            return
+
+        self.user_profile = await get_or_create_profile(self.user)
+        # Presence counts the socket once, not once per conversation
+        await self.join_presence()
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        for upload in self.audio_uploads.values():
+            upload.close()
+        self.audio_uploads.clear()
+        if self.delivery_flush is not None:
+            self.delivery_flush.cancel()
+
+        for membership in self.memberships.values():
+            await self.stop_typing(membership)
+            await self.flush_delivery_ack(membership)
+            await self.channel_layer.group_discard(membership.group_name, self.channel_name)
+        self.memberships.clear()
+        if self.user_group_name:
+            await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+
+    def membership_for(self, data):
+        try:
+            return self.memberships.get(int(data.get('conversation_id')))
+        except (TypeError, ValueError):
+            return None
+
+    def subscribed_memberships(self):
+        return list(self.memberships.values())
+
+    async def send_chat(self, membership, payload):
+        await self.send(text_data=codec.dumps({**payload, 'conversation_id': membership.conversation_id}))
+
+    async def membership_lost(self, membership):
+        await self.unsubscribe(membership.conversation_id, reason='removed')
+
+    async def subscribe(self, conversation_id):
+        if conversation_id in self.memberships:
+            return
+        if len(self.memberships) >= MAX_MULTIPLEX_SUBSCRIPTIONS:
+            await self.send_error('Too many subscriptions', conversation_id=conversation_id)
+            return
+        membership = ChatMembership(conversation_id)
+        try:
+            await membership.load(self.user_profile)
+        except Conversation.DoesNotExist:
+            await self.send_error('Conversation not found', conversation_id=conversation_id)
+            return
+        self.memberships[conversation_id] = membership
+        await self.channel_layer.group_add(membership.group_name, self.channel_name)
+        await self.send(text_data=codec.dumps({'type': 'subscribed', 'conversation_id': conversation_id}))
+
+    async def unsubscribe(self, conversation_id, reason=None):
+        membership = self.memberships.pop(conversation_id, None)
+        if membership is None:
+            return
+        await self.stop_typing(membership)
+        await self.flush_delivery_ack(membership)
+        await self.channel_layer.group_discard(membership.group_name, self.channel_name)
+        payload = {'type': 'unsubscribed', 'conversation_id': conversation_id}
+        if reason:
+            payload['reason'] = reason
+        await self.send(text_data=codec.dumps(payload))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            await self.receive_audio_frame(bytes_data)
+            return
+        try:
+            data = codec.loads(text_data)
+        except codec.DecodeError as e:
+            await self.send_error(str(e))
+            return
+        if not isinstance(data, dict):
+            await self.send_error('Frames must be JSON objects')
+            return
+
+        if data.get('type') == 'ping':
+            await self.touch_presence()
+            await self.send(text_data=codec.dumps({'type': 'pong'}))
+            return
+        if data.get('type') == 'heartbeat':
+            await self.touch_presence()
+            return
+
+        action_type = data.get('action_type')
+        if action_type == 'subscribe_list':
+            if not self.user_group_name:
+                self.user_group_name = f'user_conversations_{self.user.id}'
+                await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+            await self.send(text_data=codec.dumps({'type': 'subscribed', 'stream': 'conversations'}))
+            return
+        if action_type == 'unsubscribe_list':
+            if self.user_group_name:
+                await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+                self.user_group_name = None
+            await self.send(text_data=codec.dumps({'type': 'unsubscribed', 'stream': 'conversations'}))
+            return
+
+        try:
+            conversation_id = int(data.get('conversation_id'))
+        except (TypeError, ValueError):
+            await self.send_error('conversation_id is required')
+            return
+
+        if action_type == 'subscribe':
+            await self.subscribe(conversation_id)
+        elif action_type == 'unsubscribe':
+            await self.unsubscribe(conversation_id)
+        elif conversation_id in self.memberships:
+            await self.receive_chat_frame(self.memberships[conversation_id], data)
+        else:
+            await self.send_error('Not subscribed to this conversation', conversation_id=conversation_id)
@@ -0,0 +1,84 @@
+"""
+Per-user cache of the serialized first page of the conversation list.
+
+Dashboard loads and reconnects all hit the first page, so it is kept in the
+Django cache, one entry per profile and page size. Every profile also has a
+generation token, and entries are keyed by the token current when their query
+started. Writes that change what a participant would see replace the token
+once the surrounding transaction commits, so a response built from a query
+that raced with the write lands under the old token, where nothing reads it.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from . import metrics
+
+
+def conversation_list_generation_key(profile_id):
+    return f'chat:conversation_list:{profile_id}:generation'
+
+
+def conversation_list_key(profile_id, generation, page_size):
+    return f'chat:conversation_list:{profile_id}:{generation}:{page_size}'
+
+
+def get_conversation_list_generation(profile_id):
+    """The profile's current generation token; read it before querying the list"""
+    key = conversation_list_generation_key(profile_id)
+    generation = cache.get(key)
+    if generation is None:
+        # A fresh token rather than a counter, so an evicted token can never come back
+        generation = uuid.uuid4().hex
+        if not cache.add(key, generation, settings.CHAT_CONVERSATION_LIST_CACHE_TIMEOUT):
+            generation = cache.get(key) or generation
+    return generation
+
+
+def get_cached_conversation_list(profile_id, generation, page_size):
+    """Cached response body for the first page, or None (hits and misses are counted)"""
+    data = cache.get(conversation_list_key(profile_id, generation, page_size))
+    metrics.increment(
+        metrics.CONVERSATION_LIST_CACHE_HITS if data is not None else metrics.CONVERSATION_LIST_CACHE_MISSES
+    )
+    return data
+
+
+def cache_conversation_list(profile_id, generation, page_size, data):
+    cache.add(
+        conversation_list_key(profile_id, generation, page_size), data, settings.CHAT_CONVERSATION_LIST_CACHE_TIMEOUT
+    )
+
+
+def invalidate_conversation_lists(profile_ids):
+    """Retire the cached lists of ``profile_ids`` after the current transaction commits"""
+    keys = [conversation_list_generation_key(profile_id) for profile_id in set(profile_ids)]
+    if keys:
+        transaction.on_commit(lambda: cache.set_many(
+            {key: uuid.uuid4().hex for key in keys}, settings.CHAT_CONVERSATION_LIST_CACHE_TIMEOUT
+        ))
+
+
+def invalidate_conversation(conversation_id):
+    """Invalidate the list of every participant of a conversation"""
+    from .models import ConversationMembership  # Avoid a circular import with models
+
+    invalidate_conversation_lists(
+        ConversationMembership.objects.filter(
+            conversation_id=conversation_id
+        ).values_list('profile_id', flat=True)
+    )
+
+
+def invalidate_contacts_of(profile_id):
+    """Invalidate ``profile_id``'s list and the list of everyone they share a conversation with"""
+    from .models import ConversationMembership
+
+    invalidate_conversation_lists([
+        profile_id,
+        *ConversationMembership.objects.filter(
+            conversation__memberships__profile=profile_id
+        ).values_list('profile_id', flat=True).distinct(),
+    ])
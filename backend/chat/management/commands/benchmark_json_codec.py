@@ -0,0 +1,113 @@
+import json
+import random
+import timeit
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from chat import codec
+from chat.audio_metadata import PEAK_COUNT
+from chat.models import Message
+from chat.renderers import CodecJSONRenderer
+from chat.serializers import MessageSerializer
+from users.models import UserProfile
+
+BASE_URL = 'https://chat.example.com'
+
+
+class SampleRequest:
+    """Just enough of a request for MessageSerializer: the viewer, and absolute URLs"""
+
+    def __init__(self, user):
+        self.user = user
+
+    def build_absolute_uri(self, path):
+        return f'{BASE_URL}{path}'
+
+
+def sample_users():
+    """Unsaved alice and bob, with profiles and pictures, so serializing needs no database"""
+    users = []
+    for user_id, username in enumerate(['alice', 'bob'], start=1):
+        user = User(id=user_id, username=username)
+        UserProfile(id=user_id, user=user, profile_picture=f'profile_pictures/{username}.jpg')
+        users.append(user)
+    return users
+
+
+def sample_message(message_id, timestamp, users, audio=False):
+    """A message as MessageSerializer emits it, read by ``users[0]``"""
+    sender, recipient = random.sample(users, 2)
+    message = Message(
+        id=message_id,
+        sender=sender,
+        recipient=recipient.userprofile,
+        timestamp=timestamp,
+        content='Audio message' if audio else ' '.join(
+            random.choice(['hey', 'are', 'you', 'coming', 'tonight', 'sure', 'café', '👍']) for _ in range(random.randint(3, 40))
+        ),
+        message_type='audio' if audio else 'text',
+    )
+    if audio:
+        message.audio_sha256 = '0' * 64
+        message.audio_size = 48213
+        message.audio_mime_type = 'audio/wav'
+        message.audio_duration = 7.42
+        message.audio_sample_rate = 48000
+        message.audio_peaks = [random.randint(0, 255) for _ in range(PEAK_COUNT)]
+    context = {
+        'request': SampleRequest(users[0]),
+        'read_watermarks': {recipient.userprofile.id: message_id - message_id % 3},
+        'delivery_watermarks': {recipient.userprofile.id: message_id},
+    }
+    return dict(MessageSerializer(message, context=context).data)
+
+
+class Command(BaseCommand):
+    help = 'Compare stdlib json with chat.codec on a chat frame and a 50-message history page'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=20000,
+            help='Frame encodes/decodes per measurement; pages use a fiftieth of this (default: 20000)',
+        )
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        iterations = options['iterations']
+        page_iterations = max(iterations // 50, 1)
+        now = timezone.now()
+        users = sample_users()
+
+        frame = {**sample_message(1001, now, users), 'conversation_id': 42}
+        frame_text = json.dumps(frame)
+        page = {
+            'messages': [
+                sample_message(1000 + i, now - timedelta(minutes=50 - i), users, audio=i % 10 == 0) for i in range(50)
+            ],
+            'pagination': {
+                'page_size': 50, 'next_cursor': None, 'has_next': True,
+                'oldest_cursor': 'MjAyNi0xMC0xN1QwNzo1ODo0Ny41ODk2NDkrMDA6MDB8MTAwMA', 'newest_cursor': None,
+            },
+        }
+        drf_renderer = JSONRenderer()
+        codec_renderer = CodecJSONRenderer()
+
+        cases = [
+            ('frame encode', iterations, lambda: json.dumps(frame), lambda: codec.dumps(frame)),
+            ('frame decode', iterations, lambda: json.loads(frame_text), lambda: codec.loads(frame_text)),
+            ('50-message page render', page_iterations,
+             lambda: drf_renderer.render(page), lambda: codec_renderer.render(page)),
+        ]
+
+        self.stdout.write(f'chat.codec backend: {codec.BACKEND}')
+        self.stdout.write(f'{"":<24}{"before (us)":>14}{"after (us)":>14}{"speedup":>10}')
+        for name, number, before, after in cases:
+            before_us = min(timeit.repeat(before, number=number, repeat=3)) / number * 1e6
+            after_us = min(timeit.repeat(after, number=number, repeat=3)) / number * 1e6
+            self.stdout.write(f'{name:<24}{before_us:>14.2f}{after_us:>14.2f}{before_us / after_us:>9.1f}x')
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from chat.audio_metadata import analyze_audio
+from chat.models import Message
+from chat.storage import open_audio
+
+
+class Command(BaseCommand):
+    help = 'Compute duration and waveform peaks for audio messages stored before ingest analysis existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=200,
+            help='Number of messages to update per batch (default: 200)',
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        pending = Message.objects.filter(
+            message_type='audio',
+            audio_sha256__isnull=False,
+            audio_duration__isnull=True,
+        ).only('id', 'audio_sha256', 'audio_mime_type').order_by('id')
+
+        analyzed = skipped = 0
+        last_id = 0
+        while True:
+            chunk = list(pending.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+            updated = []
+            for message in chunk:
+                with open_audio(message.audio_sha256) as audio_file:
+                    metadata = analyze_audio(audio_file, message.audio_mime_type)
+                if metadata is None:
+                    skipped += 1
+                    continue
+                message.audio_duration = metadata.duration
+                message.audio_sample_rate = metadata.sample_rate
+                message.audio_peaks = metadata.peaks
+                updated.append(message)
+            Message.objects.bulk_update(updated, ['audio_duration', 'audio_sample_rate', 'audio_peaks'])
+            analyzed += len(updated)
+            last_id = chunk[-1].id
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Stored metadata for {analyzed} audio messages '
+                f'({skipped} skipped in formats that cannot be decoded)'
+            )
+        )
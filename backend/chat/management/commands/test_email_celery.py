@@ -2,6 +2,7 @@ from django.core.management.base import BaseCommand
 from django.core.mail import send_mail
 from django.conf import settings
 from chat.tasks import send_email_notification, create_and_schedule_email_notification
+from chat import presence
 from chat.models import EmailNotification, Message
 from django.contrib.auth.models import User
 from users.models import UserProfile
@@ -96,10 +97,10 @@ class Command(BaseCommand):
                 is_read=False  # Ensure message is unread
             )
             
-            # Ensure recipient profile is offline for test
+            # Ensure the recipient is offline for the test; online state lives in chat.presence
             test_profile = test_message.recipient
-            test_profile.is_online = False
-            test_profile.save()
+            for user_id in {test_user.id, test_profile.user_id}:
+                presence.get_presence().clear(user_id)
             
             # Create a test email notification directly
             email_notification = EmailNotification.objects.create(
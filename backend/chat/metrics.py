@@ -0,0 +1,40 @@
+"""
+Lightweight in-process counters for chat internals.
+
+Counters are per worker process; scrape each worker (or sum the
+``/chat/api/metrics/`` responses) to get deployment-wide totals.
+"""
+import threading
+from collections import Counter
+
+_counters = Counter()
+_lock = threading.Lock()
+
+OVERSIZED_EVENTS_REJECTED = 'channel_layer.oversized_events_rejected'
+CONVERSATION_LIST_CACHE_HITS = 'conversation_list_cache.hits'
+CONVERSATION_LIST_CACHE_MISSES = 'conversation_list_cache.misses'
+TYPING_EVENTS_COALESCED = 'typing.events_coalesced'
+EPHEMERAL_EVENTS_DROPPED = 'channel_layer.ephemeral_events_dropped'
+OUTBOUND_FRAMES_COALESCED = 'outbound.frames_coalesced'
+OUTBOUND_EPHEMERAL_DROPPED = 'outbound.ephemeral_dropped'
+SLOW_CONSUMERS_DISCONNECTED = 'outbound.slow_consumers_disconnected'
+WRITE_BEHIND_BATCHES = 'write_behind.batches'
+WRITE_BEHIND_MESSAGES_PERSISTED = 'write_behind.messages_persisted'
+WRITE_BEHIND_MESSAGES_REJECTED = 'write_behind.messages_rejected'
+WRITE_BEHIND_MESSAGES_REPLAYED = 'write_behind.messages_replayed'
+WRITE_BEHIND_JOURNAL_ERRORS = 'write_behind.journal_errors'
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def get(name):
+    return _counters[name]
+
+
+def snapshot():
+    """Copy of every counter, for reporting"""
+    with _lock:
+        return dict(_counters)
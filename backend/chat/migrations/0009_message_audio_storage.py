@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_emailnotification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='audio_sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='audio_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='audio_mime_type',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
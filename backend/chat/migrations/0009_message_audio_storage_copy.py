@@ -0,0 +1,87 @@
+import hashlib
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+from django.db import migrations
+
+CHUNK_SIZE = 200
+
+# Frozen copies of chat.storage as it was when this migration was written, so later
+# changes there never alter what this migration does
+AUDIO_STORAGE_ALIAS = 'audio'
+
+
+def audio_blob_name(sha256):
+    return f'{sha256[:2]}/{sha256[2:4]}/{sha256}'
+
+
+def guess_audio_mime_type(data):
+    header = bytes(data[:12])
+    if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+        return 'audio/wav'
+    if header[:4] == b'OggS':
+        return 'audio/ogg'
+    if header[:4] == b'\x1a\x45\xdf\xa3':
+        return 'audio/webm'
+    if header[:3] == b'ID3' or header[:2] in (b'\xff\xfb', b'\xff\xf3', b'\xff\xf2'):
+        return 'audio/mpeg'
+    if header[4:8] == b'ftyp':
+        return 'audio/mp4'
+    return 'application/octet-stream'
+
+
+def copy_audio_to_storage(apps, schema_editor):
+    """
+    Copy inline audio blobs into content-addressed storage, a chunk at a time.
+    audio_data is left in place (0009_message_audio_storage_drop removes it), so
+    rows already copied are skipped and an interrupted run can simply be rerun.
+    """
+    Message = apps.get_model('chat', 'Message')
+    storage = storages[AUDIO_STORAGE_ALIAS]
+    pending = Message.objects.filter(audio_data__isnull=False, audio_sha256__isnull=True)
+    last_id = 0
+    while True:
+        chunk = list(pending.filter(id__gt=last_id).order_by('id').only('id', 'audio_data')[:CHUNK_SIZE])
+        if not chunk:
+            break
+        for message in chunk:
+            data = bytes(message.audio_data)
+            sha256 = hashlib.sha256(data).hexdigest()
+            name = audio_blob_name(sha256)
+            if not storage.exists(name):
+                storage.save(name, ContentFile(data))
+            message.audio_sha256 = sha256
+            message.audio_size = len(data)
+            message.audio_mime_type = guess_audio_mime_type(data)
+        Message.objects.bulk_update(chunk, ['audio_sha256', 'audio_size', 'audio_mime_type'])
+        last_id = chunk[-1].id
+
+
+def copy_audio_from_storage(apps, schema_editor):
+    """Refill audio_data from storage for rows that only have a reference"""
+    Message = apps.get_model('chat', 'Message')
+    storage = storages[AUDIO_STORAGE_ALIAS]
+    pending = Message.objects.filter(audio_data__isnull=True, audio_sha256__isnull=False)
+    last_id = 0
+    while True:
+        chunk = list(pending.filter(id__gt=last_id).order_by('id').only('id', 'audio_sha256')[:CHUNK_SIZE])
+        if not chunk:
+            break
+        for message in chunk:
+            with storage.open(audio_blob_name(message.audio_sha256)) as blob:
+                message.audio_data = blob.read()
+        Message.objects.bulk_update(chunk, ['audio_data'])
+        last_id = chunk[-1].id
+
+
+class Migration(migrations.Migration):
+    # Each chunk commits on its own; a rerun continues with the rows not copied yet
+    atomic = False
+
+    dependencies = [
+        ('chat', '0009_message_audio_storage'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_audio_to_storage, copy_audio_from_storage),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Reversing re-adds an empty column; reversing 0009_message_audio_storage_copy refills it
+
+    dependencies = [
+        ('chat', '0009_message_audio_storage_copy'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='message',
+            name='audio_data',
+        ),
+    ]
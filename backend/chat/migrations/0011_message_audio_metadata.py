@@ -0,0 +1,28 @@
+# Generated by Django 5.1.6 on 2026-10-17 07:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_audioupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='audio_duration',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='audio_peaks',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='audio_sample_rate',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
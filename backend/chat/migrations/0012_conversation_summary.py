@@ -0,0 +1,71 @@
+# Generated by Django 5.1.6 on 2026-10-17 07:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, F, OuterRef, Subquery
+
+
+def backfill_conversation_summary(apps, schema_editor):
+    """Create a membership per participant and fill last_message / unread counters"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    ConversationMembership = apps.get_model('chat', 'ConversationMembership')
+    Message = apps.get_model('chat', 'Message')
+    Participant = Conversation.participants.through
+
+    unread_counts = {
+        (row['conversation_id'], row['recipient_id']): row['count']
+        for row in Message.objects.filter(is_read=False)
+        .values('conversation_id', 'recipient_id')
+        .annotate(count=Count('id'))
+        .order_by()
+    }
+    ConversationMembership.objects.bulk_create(
+        [
+            ConversationMembership(
+                conversation_id=conversation_id,
+                profile_id=profile_id,
+                unread_count=unread_counts.get((conversation_id, profile_id), 0),
+            )
+            for conversation_id, profile_id in Participant.objects.values_list('conversation_id', 'userprofile_id')
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+    latest = Message.objects.filter(conversation=OuterRef('pk')).order_by('-timestamp', '-id')
+    Conversation.objects.update(
+        last_message_id=Subquery(latest.values('id')[:1]),
+    )
+    # updated_at was never bumped on send, so catch it up with the newest message
+    Conversation.objects.filter(last_message__timestamp__gt=F('updated_at')).update(
+        updated_at=Subquery(latest.values('timestamp')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_message_audio_metadata'),
+        ('users', '0007_auto_20250815_1049'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.CreateModel(
+            name='ConversationMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='chat.conversation')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_memberships', to='users.userprofile')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('conversation', 'profile'), name='unique_conversation_membership')],
+            },
+        ),
+        migrations.RunPython(backfill_conversation_summary, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-17 07:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_message_keyset_index'),
+        ('users', '0007_auto_20250815_1049'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['-updated_at', '-id'], name='chat_conv_updated_id_idx'),
+        ),
+    ]
@@ -0,0 +1,124 @@
+# Generated by Django 5.1.6 on 2026-10-17 08:02
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.db import migrations, models
+from django.db.models import Max, Min, Q, Sum
+
+
+def merge_duplicate_conversations(apps, schema_editor):
+    """
+    Fold duplicate 1:1 conversations into the oldest one per participant pair,
+    then stamp every 1:1 conversation with its pair key.
+    """
+    Conversation = apps.get_model('chat', 'Conversation')
+    ConversationMembership = apps.get_model('chat', 'ConversationMembership')
+    Message = apps.get_model('chat', 'Message')
+    AudioUpload = apps.get_model('chat', 'AudioUpload')
+    Participant = Conversation.participants.through
+    DeletedBy = Conversation.deleted_by.through
+
+    participants = defaultdict(list)
+    for conversation_id, profile_id in Participant.objects.values_list('conversation_id', 'userprofile_id'):
+        participants[conversation_id].append(profile_id)
+
+    by_pair = defaultdict(list)
+    for conversation_id, profile_ids in participants.items():
+        if len(profile_ids) == 2:
+            low, high = sorted(profile_ids)
+            by_pair[f'{low}:{high}'].append(conversation_id)
+
+    for pair_key, conversation_ids in by_pair.items():
+        keep_id, *duplicate_ids = sorted(conversation_ids)
+        if duplicate_ids:
+            merge_into(
+                Conversation, ConversationMembership, Message, AudioUpload, DeletedBy,
+                keep_id, duplicate_ids, participants[keep_id],
+            )
+        Conversation.objects.filter(id=keep_id).update(pair_key=pair_key)
+
+
+def merge_into(Conversation, ConversationMembership, Message, AudioUpload, DeletedBy,
+               keep_id, duplicate_ids, profile_ids):
+    all_ids = [keep_id, *duplicate_ids]
+    conversations = {c.id: c for c in Conversation.objects.filter(id__in=all_ids)}
+    deleted_by = defaultdict(set)
+    for conversation_id, profile_id in DeletedBy.objects.filter(
+        conversation_id__in=all_ids
+    ).values_list('conversation_id', 'userprofile_id'):
+        deleted_by[profile_id].add(conversation_id)
+
+    # Each copy hid the messages up to its own deletion time, but the merged conversation
+    # has a single cutoff per participant: the latest of their deletions, lowered to just
+    # before the earliest message still visible to them in any copy. Nothing they could
+    # see becomes hidden, and a cleared message only comes back if it is newer than one
+    # they never cleared (typically not at all, as duplicates are used side by side).
+    deletion_timestamps = {}
+    for profile_id in profile_ids:
+        stamps = {
+            conversation_id: datetime.fromisoformat(stamp)
+            for conversation_id in all_ids
+            if (stamp := (conversations[conversation_id].deletion_timestamps or {}).get(str(profile_id)))
+        }
+        if not stamps:
+            continue
+        visible = Q()
+        for conversation_id in all_ids:
+            if conversation_id in stamps:
+                visible |= Q(conversation_id=conversation_id, timestamp__gt=stamps[conversation_id])
+            else:
+                visible |= Q(conversation_id=conversation_id)
+        cutoff = max(stamps.values())
+        earliest_visible = Message.objects.filter(visible).aggregate(earliest=Min('timestamp'))['earliest']
+        if earliest_visible is not None and earliest_visible <= cutoff:
+            cutoff = earliest_visible - timedelta(microseconds=1)
+        deletion_timestamps[str(profile_id)] = cutoff.isoformat()
+
+    Message.objects.filter(conversation_id__in=duplicate_ids).update(conversation_id=keep_id)
+    AudioUpload.objects.filter(conversation_id__in=duplicate_ids).update(conversation_id=keep_id)
+
+    for profile_id in profile_ids:
+        unread = ConversationMembership.objects.filter(
+            conversation_id__in=all_ids, profile_id=profile_id
+        ).aggregate(total=Sum('unread_count'))['total'] or 0
+        ConversationMembership.objects.filter(
+            conversation_id=keep_id, profile_id=profile_id
+        ).update(unread_count=unread)
+
+    DeletedBy.objects.filter(conversation_id=keep_id).exclude(
+        userprofile_id__in=[
+            profile_id for profile_id, deleted in deleted_by.items() if deleted.issuperset(all_ids)
+        ]
+    ).delete()
+
+    keep = conversations[keep_id]
+    keep.deletion_timestamps = deletion_timestamps
+    keep.last_message = Message.objects.filter(conversation_id=keep_id).order_by('-timestamp', '-id').first()
+    keep.save(update_fields=['deletion_timestamps', 'last_message'])
+    # Queryset update so auto_now does not overwrite the carried-over activity time
+    latest_activity = Conversation.objects.filter(id__in=all_ids).aggregate(latest=Max('updated_at'))['latest']
+    Conversation.objects.filter(id=keep_id).update(updated_at=latest_activity)
+
+    Conversation.objects.filter(id__in=duplicate_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0014_conversation_activity_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='pair_key',
+            field=models.CharField(blank=True, max_length=41, null=True),
+        ),
+        migrations.RunPython(merge_duplicate_conversations, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='conversation',
+            name='pair_key',
+            field=models.CharField(blank=True, max_length=41, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,148 @@
+# Generated by Django 5.1.6 on 2026-10-17 08:40
+
+import django.utils.timezone
+from datetime import datetime
+
+from django.db import migrations, models
+
+
+def copy_membership_state(apps, schema_editor):
+    """Move deleted_by / deletion_timestamps onto the membership rows"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    ConversationMembership = apps.get_model('chat', 'ConversationMembership')
+    Participant = Conversation.participants.through
+    DeletedBy = Conversation.deleted_by.through
+
+    # Memberships are kept in step with participants since 0012; cover any stragglers
+    ConversationMembership.objects.bulk_create(
+        [
+            ConversationMembership(conversation_id=conversation_id, profile_id=profile_id)
+            for conversation_id, profile_id in Participant.objects.values_list('conversation_id', 'userprofile_id')
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+    # Memberships of people who are no longer participants would otherwise become participants
+    participant_pairs = set(Participant.objects.values_list('conversation_id', 'userprofile_id'))
+    stale = [
+        membership_id
+        for membership_id, conversation_id, profile_id in ConversationMembership.objects.values_list(
+            'id', 'conversation_id', 'profile_id'
+        )
+        if (conversation_id, profile_id) not in participant_pairs
+    ]
+    ConversationMembership.objects.filter(id__in=stale).delete()
+
+    for conversation_id, profile_id in DeletedBy.objects.values_list('conversation_id', 'userprofile_id'):
+        ConversationMembership.objects.filter(
+            conversation_id=conversation_id, profile_id=profile_id
+        ).update(hidden=True)
+
+    for conversation in Conversation.objects.only('id', 'created_at', 'deletion_timestamps').iterator(chunk_size=500):
+        ConversationMembership.objects.filter(conversation_id=conversation.id).update(
+            joined_at=conversation.created_at
+        )
+        for profile_id, deleted_at in (conversation.deletion_timestamps or {}).items():
+            ConversationMembership.objects.filter(
+                conversation_id=conversation.id, profile_id=int(profile_id)
+            ).update(cleared_before=datetime.fromisoformat(deleted_at))
+
+
+def copy_membership_state_back(apps, schema_editor):
+    Conversation = apps.get_model('chat', 'Conversation')
+    ConversationMembership = apps.get_model('chat', 'ConversationMembership')
+    DeletedBy = Conversation.deleted_by.through
+
+    DeletedBy.objects.bulk_create(
+        [
+            DeletedBy(conversation_id=conversation_id, userprofile_id=profile_id)
+            for conversation_id, profile_id in ConversationMembership.objects.filter(
+                hidden=True
+            ).values_list('conversation_id', 'profile_id')
+        ],
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+    timestamps = {}
+    for conversation_id, profile_id, cleared_before in ConversationMembership.objects.filter(
+        cleared_before__isnull=False
+    ).values_list('conversation_id', 'profile_id', 'cleared_before'):
+        timestamps.setdefault(conversation_id, {})[str(profile_id)] = cleared_before.isoformat()
+    for conversation_id, deletion_timestamps in timestamps.items():
+        Conversation.objects.filter(id=conversation_id).update(deletion_timestamps=deletion_timestamps)
+
+
+def drop_participants_table(apps, schema_editor):
+    """Participants now go through ConversationMembership; the auto-created table is redundant"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    schema_editor.delete_model(Conversation.participants.through)
+
+
+def recreate_participants_table(apps, schema_editor):
+    Conversation = apps.get_model('chat', 'Conversation')
+    ConversationMembership = apps.get_model('chat', 'ConversationMembership')
+    Participant = Conversation.participants.through
+    schema_editor.create_model(Participant)
+    Participant.objects.bulk_create(
+        [
+            Participant(conversation_id=conversation_id, userprofile_id=profile_id)
+            for conversation_id, profile_id in ConversationMembership.objects.values_list('conversation_id', 'profile_id')
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0015_conversation_pair_key'),
+        ('users', '0007_auto_20250815_1049'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationmembership',
+            name='hidden',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='conversationmembership',
+            name='cleared_before',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversationmembership',
+            name='joined_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='conversationmembership',
+            index=models.Index(fields=['profile', 'hidden', 'conversation'], name='chat_membership_visible_idx'),
+        ),
+        migrations.RunPython(copy_membership_state, copy_membership_state_back),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='conversation',
+                    name='participants',
+                    field=models.ManyToManyField(
+                        related_name='conversations',
+                        through='chat.ConversationMembership',
+                        through_fields=('conversation', 'profile'),
+                        to='users.userprofile',
+                    ),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(drop_participants_table, recreate_participants_table),
+            ],
+        ),
+        migrations.RemoveField(
+            model_name='conversation',
+            name='deleted_by',
+        ),
+        migrations.RemoveField(
+            model_name='conversation',
+            name='deletion_timestamps',
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.1.6 on 2026-10-17 08:03
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min
+
+
+def backfill_read_watermarks(apps, schema_editor):
+    """
+    Derive each membership's watermark from the per-message is_read flags: it
+    sits just before the participant's oldest unread message (or at the newest
+    message if they have read everything), and unread counts follow from it.
+    """
+    ConversationMembership = apps.get_model('chat', 'ConversationMembership')
+    Message = apps.get_model('chat', 'Message')
+
+    newest = dict(
+        Message.objects.values('conversation_id').annotate(newest=Max('id')).values_list('conversation_id', 'newest')
+    )
+    first_unread = {
+        (conversation_id, profile_id): message_id
+        for conversation_id, profile_id, message_id in Message.objects.filter(is_read=False).values(
+            'conversation_id', 'recipient_id'
+        ).annotate(first=Min('id')).values_list('conversation_id', 'recipient_id', 'first')
+    }
+
+    for membership in ConversationMembership.objects.only('id', 'conversation_id', 'profile_id').iterator(chunk_size=500):
+        unread_from = first_unread.get((membership.conversation_id, membership.profile_id))
+        if unread_from is None:
+            read_up_to = newest.get(membership.conversation_id, 0)
+        else:
+            read_up_to = Message.objects.filter(
+                conversation_id=membership.conversation_id, id__lt=unread_from
+            ).aggregate(last=Max('id'))['last'] or 0
+        unread_count = Message.objects.filter(
+            conversation_id=membership.conversation_id, recipient_id=membership.profile_id, id__gt=read_up_to
+        ).aggregate(count=Count('id'))['count']
+        ConversationMembership.objects.filter(id=membership.id).update(
+            read_up_to=read_up_to, unread_count=unread_count
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0016_membership_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationmembership',
+            name='read_up_to',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        # Going back only drops the column; is_read stays as sync_read_state left it
+        migrations.RunPython(backfill_read_watermarks, migrations.RunPython.noop),
+    ]
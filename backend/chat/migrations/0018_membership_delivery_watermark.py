@@ -0,0 +1,26 @@
+# Generated by Django 5.1.6 on 2026-10-17 08:06
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def start_at_read_watermarks(apps, schema_editor):
+    """Nothing was acknowledged before; everything read has been delivered"""
+    ConversationMembership = apps.get_model('chat', 'ConversationMembership')
+    ConversationMembership.objects.update(delivered_up_to=F('read_up_to'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0017_membership_read_watermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationmembership',
+            name='delivered_up_to',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(start_at_read_watermarks, migrations.RunPython.noop),
+    ]
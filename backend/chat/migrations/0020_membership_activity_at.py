@@ -0,0 +1,35 @@
+# Generated by Django 5.1.6 on 2026-10-17 09:18
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_conversation_activity(apps, schema_editor):
+    """Give every membership its conversation's updated_at"""
+    Conversation = apps.get_model('chat', 'Conversation')
+    ConversationMembership = apps.get_model('chat', 'ConversationMembership')
+    ConversationMembership.objects.update(
+        activity_at=Subquery(Conversation.objects.filter(pk=OuterRef('conversation_id')).values('updated_at')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0019_message_timestamp_default'),
+        ('users', '0008_reset_is_online'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationmembership',
+            name='activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(copy_conversation_activity, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='conversationmembership',
+            index=models.Index(condition=models.Q(('hidden', False)), fields=['profile', '-activity_at', '-conversation'], name='chat_membership_activity_idx'),
+        ),
+    ]
@@ -1,19 +1,247 @@
-from django.db import models
+import uuid
+from collections import defaultdict
+from django.db import models, transaction, IntegrityError
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, When
+from django.db.models.functions import Coalesce, Greatest
 from django.contrib.auth.models import User
+from django.utils import timezone
 from users.models import UserProfile
+from .conversation_cache import invalidate_conversation, invalidate_conversation_lists
 
 
     
+class ConversationQuerySet(models.QuerySet):
+    def with_summary(self, profile):
+        """
+        Load everything ConversationSerializer needs for ``profile`` up front, so a
+        page of conversations costs a fixed number of queries.
+        """
+        # Read and delivery state of the last message, from its recipient's watermarks
+        recipient_membership = ConversationMembership.objects.filter(
+            conversation=OuterRef('pk'), profile=OuterRef('last_message__recipient')
+        )
+        return self.select_related(
+            'last_message__sender__userprofile',
+            'last_message__recipient',
+        ).annotate(
+            last_message_read_up_to=Subquery(recipient_membership.values('read_up_to')[:1]),
+            last_message_delivered_up_to=Subquery(recipient_membership.values('delivered_up_to')[:1]),
+        ).prefetch_related(
+            'participants__user',
+            models.Prefetch(
+                'memberships',
+                queryset=ConversationMembership.objects.filter(profile=profile),
+                to_attr='viewer_memberships',
+            ),
+        )
+
+    def get_or_create_direct(self, profile_a, profile_b):
+        """
+        Return ``(conversation, created)`` for the 1:1 conversation between two
+        profiles. Lookup is a single probe on the unique pair key; a concurrent
+        creator loses on the constraint and picks up the winner's row.
+        """
+        pair_key = Conversation.pair_key_for(profile_a, profile_b)
+        conversation = self.filter(pair_key=pair_key).first()
+        if conversation:
+            return conversation, False
+        try:
+            with transaction.atomic():
+                conversation = self.create(pair_key=pair_key)
+                conversation.participants.add(profile_a, profile_b)
+        except IntegrityError:
+            return self.get(pair_key=pair_key), False
+        return conversation, True
+
+
 class Conversation(models.Model):
-    participants = models.ManyToManyField(UserProfile, related_name='conversations')
-    deleted_by = models.ManyToManyField(UserProfile, related_name='deleted_conversations', blank=True)
-    # Track when each user deleted the conversation
-    deletion_timestamps = models.JSONField(default=dict, blank=True)  # {user_id: timestamp}
+    # Per-participant state (hidden, cleared_before, unread count) lives on the membership rows
+    participants = models.ManyToManyField(
+        UserProfile,
+        related_name='conversations',
+        through='ConversationMembership',
+        through_fields=('conversation', 'profile'),
+    )
+    # Sorted participant profile ids ("<low>:<high>") for 1:1 conversations, see pair_key_for
+    pair_key = models.CharField(max_length=41, unique=True, null=True, blank=True)
+    # Denormalized summary, maintained by record_message in the same transaction as each send
+    last_message = models.ForeignKey(
+        'Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ConversationQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Serves keyset pagination of conversation lists by activity
+            models.Index(fields=['-updated_at', '-id'], name='chat_conv_updated_id_idx'),
+        ]
+
     def __str__(self):
         return f'Conversation: {[p.phone_number for p in self.participants.all()]}'
+
+    @staticmethod
+    def pair_key_for(profile_a, profile_b):
+        low, high = sorted((getattr(profile_a, 'pk', profile_a), getattr(profile_b, 'pk', profile_b)))
+        return f'{low}:{high}'
+
+    def record_message(self, message, participant_ids=None):
+        """
+        Point the summary at a newly created message, bump the recipient's
+        unread counter and un-hide the conversation for everyone who deleted it
+        (cleared_before is kept, so they only see what came after). Call inside
+        the transaction that created the message. Callers that already know the
+        participants can pass their ids to skip looking them up for cache invalidation.
+        """
+        self.record_messages([message], participant_ids)
+
+    def record_messages(self, messages, participant_ids=None):
+        """
+        record_message for a batch of new messages of this conversation, in the
+        same two statements however many there are (see chat.write_behind)
+        """
+        last = max(messages, key=lambda message: message.id)
+        # A batch replayed late must not move the summary back to older messages
+        moved = Conversation.objects.filter(
+            Q(last_message__isnull=True) | Q(last_message_id__lt=last.id), id=self.id
+        ).update(last_message=last, updated_at=last.timestamp)
+        if moved:
+            self.last_message = last
+            self.updated_at = last.timestamp
+        received = defaultdict(list)
+        for message in messages:
+            received[message.recipient_id].append(message.id)
+        # One statement for the recipients' counters, every hidden membership and,
+        # when the conversation moved, everyone's copy of its activity time
+        memberships = self.memberships.all()
+        changes = {}
+        if moved:
+            changes['activity_at'] = last.timestamp
+        else:
+            memberships = memberships.filter(Q(profile_id__in=received) | Q(hidden=True))
+        memberships.update(
+            **changes,
+            hidden=False,
+            # Only messages past the recipient's read watermark are unread: a batch
+            # written behind can arrive after its messages were read from the broadcast
+            unread_count=Case(
+                *[
+                    When(profile_id=profile_id, read_up_to__lt=message_id, then=F('unread_count') + len(ids) - i)
+                    for profile_id, ids in received.items()
+                    for i, message_id in enumerate(sorted(ids))
+                ],
+                default=F('unread_count'),
+                output_field=models.PositiveIntegerField(),
+            ),
+        )
+        if participant_ids is None:
+            invalidate_conversation(self.id)
+        else:
+            invalidate_conversation_lists(participant_ids)
+
+    def hide_for(self, profile):
+        """
+        Remove the conversation from ``profile``'s list and clear their history up
+        to now. It comes back on the next message, without the cleared messages.
+        """
+        self.memberships.filter(profile=profile).update(hidden=True, cleared_before=timezone.now())
+        invalidate_conversation_lists([getattr(profile, 'pk', profile)])
+
+    def mark_read_up_to(self, profile, message_id):
+        """
+        Move ``profile``'s read watermark up to the newest message at or before
+        ``message_id`` and recount their unread messages from it, in a single
+        UPDATE that matches nothing if the watermark is already there. Returns
+        the new watermark, or None if it did not move.
+        """
+        read_up_to = self.messages.filter(id__lte=message_id).order_by('-id').values_list('id', flat=True).first()
+        if read_up_to is None:
+            return None
+        unread = Message.objects.filter(
+            conversation=self, recipient=profile, id__gt=read_up_to
+        ).order_by().values('conversation').annotate(count=Count('id')).values('count')
+        moved = self.memberships.filter(profile=profile, read_up_to__lt=read_up_to).update(
+            read_up_to=read_up_to,
+            unread_count=Coalesce(Subquery(unread), 0),
+            # Whatever has been read has been delivered
+            delivered_up_to=Greatest(F('delivered_up_to'), read_up_to),
+        )
+        if not moved:
+            return None
+        # The sender's list shows the read state of the last message too
+        invalidate_conversation(self.id)
+        return read_up_to
+
+    def mark_delivered_up_to(self, profile, message_id):
+        """
+        Move ``profile``'s delivery watermark up to the newest message at or
+        before ``message_id``. One UPDATE, matching nothing if it is already
+        there. Returns the new watermark, or None if it did not move.
+        """
+        delivered_up_to = self.messages.filter(id__lte=message_id).order_by('-id').values_list('id', flat=True).first()
+        if delivered_up_to is None:
+            return None
+        moved = self.memberships.filter(profile=profile, delivered_up_to__lt=delivered_up_to).update(
+            delivered_up_to=delivered_up_to
+        )
+        if not moved:
+            return None
+        # The sender's list shows the delivery state of the last message too
+        invalidate_conversation(self.id)
+        return delivered_up_to
+
+    def release_unread(self, message):
+        """Take a deleted message off its recipient's unread counter if it was past their watermark"""
+        released = self.memberships.filter(
+            profile_id=message.recipient_id, read_up_to__lt=message.id
+        ).update(unread_count=Greatest(F('unread_count') - 1, 0))
+        if released:
+            invalidate_conversation(self.id)
+
+    def refresh_last_message(self):
+        """Re-point last_message at the newest remaining message, e.g. after a delete"""
+        latest = self.messages.order_by('-timestamp', '-id').values_list('id', flat=True).first()
+        Conversation.objects.filter(id=self.id).update(last_message_id=latest)
+        self.last_message_id = latest
+        invalidate_conversation(self.id)
+
+
+class ConversationMembership(models.Model):
+    """Per-participant conversation state, kept in step with message writes and reads"""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='memberships')
+    profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='conversation_memberships')
+    unread_count = models.PositiveIntegerField(default=0)
+    # Id of the newest message this participant has read; their messages up to it count as read
+    read_up_to = models.PositiveBigIntegerField(default=0)
+    # Id of the newest message acknowledged by this participant's client; never behind read_up_to
+    delivered_up_to = models.PositiveBigIntegerField(default=0)
+    # Deleted from this participant's list; cleared again by record_message when a new message arrives
+    hidden = models.BooleanField(default=False)
+    # Messages at or before this time are not shown to this participant
+    cleared_before = models.DateTimeField(null=True, blank=True)
+    joined_at = models.DateTimeField(default=timezone.now)
+    # Copy of conversation.updated_at, so the list can filter and order on this table alone
+    activity_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'profile'], name='unique_conversation_membership'),
+        ]
+        indexes = [
+            # A profile's visible conversations, as counted and joined by the offset list
+            models.Index(fields=['profile', 'hidden', 'conversation'], name='chat_membership_visible_idx'),
+            # Visible rows in list order, so a page is an index range scan with no sort
+            models.Index(
+                fields=['profile', '-activity_at', '-conversation'],
+                condition=Q(hidden=False),
+                name='chat_membership_activity_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.profile} in conversation {self.conversation_id}'
     
 
 class Message(models.Model):
@@ -25,15 +253,71 @@ class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     recipient = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='received_messages')
     content = models.TextField(null=True, blank=True)
-    audio_data = models.BinaryField(null=True, blank=True)
+    # Audio lives in content-addressed storage (see chat.storage); the row only keeps a reference
+    audio_sha256 = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    audio_size = models.PositiveIntegerField(null=True, blank=True)
+    audio_mime_type = models.CharField(max_length=100, blank=True)
+    # Summary computed once at ingest (chat.audio_metadata) so clients can render without the audio
+    audio_duration = models.FloatField(null=True, blank=True)
+    audio_sample_rate = models.PositiveIntegerField(null=True, blank=True)
+    audio_peaks = models.JSONField(null=True, blank=True)
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPE_CHOICES, default='text')
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the message is built rather than on insert, so write-behind batches keep the send time
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     is_delivered = models.BooleanField(default=False)
     is_read = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # Serves keyset pagination of a conversation's history
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='chat_msg_conv_ts_id_idx'),
+        ]
+
     def __str__(self):
         return f'Message from {self.sender.username} to {self.recipient.phone_number} at {self.timestamp}'
 
+    def has_been_read(self):
+        """is_read is only synced lazily; the recipient's read watermark is authoritative"""
+        return self.is_read or ConversationMembership.objects.filter(
+            conversation_id=self.conversation_id, profile_id=self.recipient_id, read_up_to__gte=self.id
+        ).exists()
+
+    @property
+    def has_audio(self):
+        return self.message_type == 'audio' and bool(self.audio_sha256)
+
+    def attachment_metadata(self):
+        """Reference-only description of the attachment, safe to put in channel-layer events"""
+        if self.has_audio:
+            return {
+                'audio_size': self.audio_size,
+                'audio_mime_type': self.audio_mime_type,
+                'audio_duration': self.audio_duration,
+                'audio_sample_rate': self.audio_sample_rate,
+                'audio_peaks': self.audio_peaks,
+            }
+        return {}
+
+
+class AudioUpload(models.Model):
+    """A resumable, chunked voice-note upload; chunk bytes live in chat.uploads temp storage"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='audio_uploads')
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='audio_uploads')
+    content = models.TextField(blank=True)
+    mime_type = models.CharField(max_length=100, blank=True)
+    # Set when the upload is committed, which makes commit safe to retry
+    message = models.OneToOneField(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='upload')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at']),
+        ]
+
+    def __str__(self):
+        return f'Audio upload {self.id} by {self.uploader.username}'
+
 
 class EmailNotification(models.Model):
     STATUS_CHOICES = [
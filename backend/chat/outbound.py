@@ -0,0 +1,178 @@
+"""
+Per-connection outbound scheduling for chat sockets.
+
+Handlers never write to the socket themselves: they put frames on the
+connection's OutboundQueue and a single writer task drains it. That keeps
+the channel-layer receive loop fast (so channels_redis does not hit its
+per-channel capacity and drop events while a socket is slow) and lets the
+queue decide what to send first and what to give up on:
+
+* durable frames (messages, edits, deletes, watermarks, list updates) always
+  go before ephemeral ones (typing);
+* a frame with a coalesce key replaces a pending frame with the same key and
+  moves to the back, so superseded updates are never sent;
+* when the queue is full, the oldest ephemeral frame is dropped; if only
+  durable frames are left, or one write has been stuck for
+  CHAT_OUTBOUND_STALL_SECONDS, the client is too slow and is disconnected
+  (it reconnects and catches up over REST).
+"""
+import asyncio
+import itertools
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import metrics
+
+# Close code sent to clients that cannot keep up
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# Live queues in this process by channel name, for the metrics view
+_queues = {}
+
+
+class OutboundQueue:
+    def __init__(self, write, name, user_id=None):
+        self.write = write
+        self.name = name
+        self.user_id = user_id
+        # Frames are (text_data, bytes_data); keys are coalesce keys or unique sequence numbers
+        self.durable = OrderedDict()
+        self.ephemeral = OrderedDict()
+        self.dropped = 0
+        self.coalesced = 0
+        self.writing_since = None
+        self._sequence = itertools.count()
+        self._ready = asyncio.Event()
+        self._task = None
+
+    @property
+    def depth(self):
+        return len(self.durable) + len(self.ephemeral)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+        _queues[self.name] = self
+
+    def stop(self):
+        _queues.pop(self.name, None)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def put(self, frame, ephemeral=False, coalesce_key=None):
+        """
+        Queue a frame. Returns False if the client is too slow to keep and
+        should be disconnected.
+        """
+        if self.writing_since is not None and time.monotonic() - self.writing_since > settings.CHAT_OUTBOUND_STALL_SECONDS:
+            return False
+
+        lane = self.ephemeral if ephemeral else self.durable
+        if coalesce_key is not None and coalesce_key in lane:
+            del lane[coalesce_key]
+            lane[coalesce_key] = frame
+            self.coalesced += 1
+            metrics.increment(metrics.OUTBOUND_FRAMES_COALESCED)
+            return True
+
+        if self.depth >= settings.CHAT_OUTBOUND_QUEUE_LIMIT:
+            if not self.ephemeral and not ephemeral:
+                return False  # Only durable frames left: the client is not keeping up
+            # Make room by giving up the oldest ephemeral frame, which may be this one
+            self.dropped += 1
+            metrics.increment(metrics.OUTBOUND_EPHEMERAL_DROPPED)
+            if not self.ephemeral:
+                return True
+            self.ephemeral.popitem(last=False)
+
+        lane[coalesce_key if coalesce_key is not None else next(self._sequence)] = frame
+        self._ready.set()
+        return True
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            lane = self.durable or self.ephemeral
+            if not lane:
+                self._ready.clear()
+                continue
+            _, (text_data, bytes_data) = lane.popitem(last=False)
+            self.writing_since = time.monotonic()
+            try:
+                await self.write(text_data, bytes_data)
+            finally:
+                self.writing_since = None
+
+
+def queue_depths(limit=100):
+    """The deepest outbound queues in this process, deepest first"""
+    queues = sorted((queue for queue in _queues.values() if queue.depth), key=lambda queue: -queue.depth)
+    return {
+        'connections': len(_queues),
+        'backlogged': [
+            {
+                'channel': queue.name,
+                'user_id': queue.user_id,
+                'depth': queue.depth,
+                'durable': len(queue.durable),
+                'ephemeral': len(queue.ephemeral),
+                'dropped': queue.dropped,
+                'coalesced': queue.coalesced,
+            }
+            for queue in queues[:limit]
+        ],
+    }
+
+
+class OutboundQueueMixin:
+    """
+    Route a consumer's send() through an OutboundQueue once the socket is
+    accepted. Handlers may pass ``ephemeral`` and ``coalesce_key`` (group
+    events carry them, see chat.utils.frame_event).
+    """
+
+    outbound = None
+    # Set once the server closes the socket; later sends are dropped
+    outbound_closed = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        user = self.scope.get('user')
+        self.outbound = OutboundQueue(self.write_frame, self.channel_name, getattr(user, 'id', None))
+        self.outbound.start()
+
+    async def write_frame(self, text_data, bytes_data):
+        await super().send(text_data=text_data, bytes_data=bytes_data)
+
+    async def send(self, text_data=None, bytes_data=None, close=False, ephemeral=False, coalesce_key=None):
+        if self.outbound_closed:
+            return
+        if self.outbound is None or close:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        if not self.outbound.put((text_data, bytes_data), ephemeral, coalesce_key):
+            metrics.increment(metrics.SLOW_CONSUMERS_DISCONNECTED)
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    async def send_event_frame(self, event):
+        """Queue the pre-encoded frame of a group event with the event's scheduling hints"""
+        await self.send(
+            text_data=event['frame'],
+            ephemeral=event.get('ephemeral', False),
+            coalesce_key=event.get('coalesce_key'),
+        )
+
+    async def close(self, code=None, reason=None):
+        self.outbound_closed = True
+        if self.outbound is not None:
+            self.outbound.stop()
+            self.outbound = None
+        await super().close(code, reason)
+
+    async def websocket_disconnect(self, message):
+        if self.outbound is not None:
+            self.outbound.stop()
+            self.outbound = None
+        await super().websocket_disconnect(message)
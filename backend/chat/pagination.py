@@ -0,0 +1,44 @@
+"""
+Keyset (cursor) pagination helpers for the chat list endpoints.
+
+A cursor is an opaque, URL-safe encoding of the ``(timestamp, id)`` of the
+last row a client has seen, so fetching the next page is an index range scan
+no matter how deep the client has scrolled.
+"""
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+
+def encode_cursor(timestamp, pk):
+    raw = f'{timestamp.isoformat()}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (timestamp, pk) for a cursor; raises ValueError if it is malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (TypeError, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f'Invalid cursor: {cursor}') from e
+
+
+def keyset_filter(field, cursor, direction, pk_field='id'):
+    """
+    Q object selecting rows strictly before (older than) or after (newer than)
+    ``cursor`` in ``(field, pk_field)`` order.
+    """
+    timestamp, pk = decode_cursor(cursor)
+    op = 'lt' if direction == 'before' else 'gt'
+    return Q(**{f'{field}__{op}': timestamp}) | Q(**{field: timestamp, f'{pk_field}__{op}': pk})
+
+
+def parse_page_size(value, default, maximum=100):
+    try:
+        page_size = int(value) if value is not None else default
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(page_size, maximum))
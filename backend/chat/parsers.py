@@ -0,0 +1,14 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+
+from . import codec
+
+
+class CodecJSONParser(JSONParser):
+    """JSONParser that decodes through chat.codec"""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return codec.loads(stream.read())
+        except ValueError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
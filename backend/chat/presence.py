@@ -0,0 +1,376 @@
+"""
+Who is online, tracked per socket outside the database.
+
+Every open socket registers itself as a connection of its user with an expiry
+CHAT_PRESENCE_TTL_SECONDS ahead, and PresenceMixin refreshes it while the
+socket lives. A user is online while any connection is unexpired, so closing
+one tab leaves the others counting, and a process that dies without
+disconnecting its sockets only keeps their users online until the TTL runs out.
+
+Users whose sockets vanish without disconnecting are taken offline by
+expire_presence (the chat.tasks.expire_presence beat task, every
+CHAT_PRESENCE_SWEEP_SECONDS). Each user's newest expiry is also kept in one
+time-ordered index, so a sweep reads only the users whose time is up, never
+everyone online. Going online or offline, by either route, is broadcast to the
+user's conversations as a presence_changed event (chat.utils.send_presence_changed).
+
+Connects, heartbeats and disconnects (and logins and logouts, through
+note_seen) also note when each user was last seen.
+flush_last_seen (run by the chat.tasks.flush_presence beat task) writes those
+to UserProfile.last_seen and is_online in one batch, so heartbeats cost no
+database writes. The columns are a mirror for the admin and reporting. Code
+that needs to know whether someone is online asks this module.
+
+The backend is CHAT_PRESENCE_BACKEND: RedisPresence in deployments,
+InMemoryPresence for tests and single-process development.
+"""
+import asyncio
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+import redis
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from users.models import UserProfile
+from .utils import send_presence_changed
+
+logger = logging.getLogger(__name__)
+
+_backend = None
+_backend_path = None
+
+
+# Atomically settle users found due in the expiry index: prune their expired
+# connections and drop them from the index if none are left, returning those that
+# this sweep took offline (not those a clean disconnect already did). Every key it
+# touches comes in KEYS, one connections set per user id in ARGV, so it runs on
+# Redis Cluster (the keys share the {presence} hash slot).
+EXPIRE_SCRIPT = """
+local expiry_key, seen_key = KEYS[1], KEYS[2]
+local now, ttl = tonumber(ARGV[1]), tonumber(ARGV[2])
+local offline = {}
+for i = 3, #ARGV do
+    local user_id, key = ARGV[i], KEYS[i]
+    local newest = redis.call('ZRANGE', key, -1, -1, 'WITHSCORES')
+    local expired = redis.call('ZREMRANGEBYSCORE', key, '-inf', now)
+    local latest = redis.call('ZRANGE', key, -1, -1, 'WITHSCORES')
+    if latest[2] then
+        redis.call('ZADD', expiry_key, latest[2], user_id)
+    else
+        redis.call('ZREM', expiry_key, user_id)
+        if expired > 0 then
+            redis.call('HSET', seen_key, user_id, tonumber(newest[2]) - ttl)
+            table.insert(offline, user_id)
+        end
+    end
+end
+return offline
+"""
+
+# Forget last-seen times once they are written, unless they moved on meanwhile:
+# ARGV holds user id and seen time pairs as read before the write
+FORGET_SEEN_SCRIPT = """
+local forgotten = 0
+for i = 1, #ARGV, 2 do
+    if tonumber(redis.call('HGET', KEYS[1], ARGV[i])) == tonumber(ARGV[i + 1]) then
+        forgotten = forgotten + redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+return forgotten
+"""
+
+
+class RedisPresence:
+    """
+    Connections live in one sorted set per user, scored by expiry, and each
+    user's newest expiry in the expiry index; last-seen times accumulate in
+    one hash until flushed. All keys share the {presence} hash tag, so the
+    multi-key pipelines and scripts stay on one Redis Cluster slot.
+    """
+
+    seen_key = '{presence}:seen'
+    expiry_key = '{presence}:expiry'
+    connections_prefix = '{presence}:connections:'
+
+    def __init__(self):
+        self.redis = redis.Redis.from_url(settings.CHAT_PRESENCE_REDIS_URL)
+        self.expire_script = self.redis.register_script(EXPIRE_SCRIPT)
+        self.forget_seen_script = self.redis.register_script(FORGET_SEEN_SCRIPT)
+
+    def connections_key(self, user_id):
+        return f'{self.connections_prefix}{user_id}'
+
+    def touch(self, user_id, connection):
+        """Register or refresh a connection. Returns True if it brought the user online."""
+        now = time.time()
+        ttl = settings.CHAT_PRESENCE_TTL_SECONDS
+        key = self.connections_key(user_id)
+        with self.redis.pipeline() as pipe:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zadd(key, {connection: now + ttl})
+            pipe.zcard(key)
+            # Only garbage collection: long enough for the sweep to see the connection expire
+            pipe.expire(key, math.ceil(2 * ttl + settings.CHAT_PRESENCE_SWEEP_SECONDS))
+            pipe.zadd(self.expiry_key, {user_id: now + ttl}, gt=True)
+            pipe.hset(self.seen_key, user_id, now)
+            _, added, live, _, _, _ = pipe.execute()
+        return bool(added) and live == 1
+
+    def disconnect(self, user_id, connection):
+        """Drop a connection. Returns True if it was the user's last one."""
+        now = time.time()
+        key = self.connections_key(user_id)
+        with self.redis.pipeline() as pipe:
+            pipe.zrem(key, connection)
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zcard(key)
+            pipe.hset(self.seen_key, user_id, now)
+            removed, _, live, _ = pipe.execute()
+        return bool(removed) and live == 0
+
+    def note_seen(self, user_id):
+        self.redis.hset(self.seen_key, user_id, time.time())
+
+    def clear(self, user_id):
+        """Drop all of a user's connections at once, as if they had all expired"""
+        with self.redis.pipeline() as pipe:
+            pipe.delete(self.connections_key(user_id))
+            pipe.zrem(self.expiry_key, user_id)
+            pipe.execute()
+
+    def online_user_ids(self, user_ids):
+        user_ids = list(user_ids)
+        now = time.time()
+        with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zcount(self.connections_key(user_id), now, '+inf')
+            counts = pipe.execute()
+        return {user_id for user_id, count in zip(user_ids, counts) if count}
+
+    def read_seen(self):
+        """Last-seen times noted and not yet forgotten, by user id"""
+        seen = self.redis.hgetall(self.seen_key)
+        return {int(user_id): float(seen_at) for user_id, seen_at in seen.items()}
+
+    def forget_seen(self, seen):
+        """Drop the ``seen`` times read by read_seen, except those noted again since"""
+        if seen:
+            args = [value for user_id, seen_at in seen.items() for value in (user_id, repr(seen_at))]
+            self.forget_seen_script(keys=[self.seen_key], args=args)
+
+    def expire(self, limit):
+        """Settle up to ``limit`` users due in the expiry index; returns the ids taken offline"""
+        now = time.time()
+        due = self.redis.zrangebyscore(self.expiry_key, '-inf', now, start=0, num=limit)
+        if not due:
+            return []
+        # A user refreshed between the read and the script is re-indexed by it, not taken offline
+        offline = self.expire_script(
+            keys=[self.expiry_key, self.seen_key, *(self.connections_key(int(user_id)) for user_id in due)],
+            args=[now, settings.CHAT_PRESENCE_TTL_SECONDS, *due],
+        )
+        return [int(user_id) for user_id in offline]
+
+
+class InMemoryPresence:
+    """RedisPresence for one process, for tests and development"""
+
+    def __init__(self):
+        self.connections = {}
+        self.seen = {}
+        self.lock = threading.Lock()
+
+    def _live(self, user_id, now):
+        """The user's unexpired connections, pruning the rest"""
+        connections = self.connections.get(user_id, {})
+        for connection in [c for c, expires_at in connections.items() if expires_at <= now]:
+            del connections[connection]
+        return connections
+
+    def touch(self, user_id, connection):
+        now = time.time()
+        with self.lock:
+            connections = self.connections.setdefault(user_id, {})
+            self._live(user_id, now)
+            added = connection not in connections
+            connections[connection] = now + settings.CHAT_PRESENCE_TTL_SECONDS
+            self.seen[user_id] = now
+            return added and len(connections) == 1
+
+    def disconnect(self, user_id, connection):
+        now = time.time()
+        with self.lock:
+            connections = self._live(user_id, now)
+            removed = connections.pop(connection, None) is not None
+            if not connections:
+                self.connections.pop(user_id, None)
+            self.seen[user_id] = now
+            return removed and not connections
+
+    def note_seen(self, user_id):
+        with self.lock:
+            self.seen[user_id] = time.time()
+
+    def clear(self, user_id):
+        with self.lock:
+            self.connections.pop(user_id, None)
+
+    def online_user_ids(self, user_ids):
+        now = time.time()
+        with self.lock:
+            return {
+                user_id for user_id in user_ids
+                if any(expires_at > now for expires_at in self.connections.get(user_id, {}).values())
+            }
+
+    def read_seen(self):
+        with self.lock:
+            return dict(self.seen)
+
+    def forget_seen(self, seen):
+        with self.lock:
+            for user_id, seen_at in seen.items():
+                if self.seen.get(user_id) == seen_at:
+                    del self.seen[user_id]
+
+    def expire(self, limit):
+        now = time.time()
+        offline = []
+        with self.lock:
+            for user_id, connections in list(self.connections.items()):
+                if len(offline) >= limit:
+                    break
+                if not connections:
+                    del self.connections[user_id]
+                    continue
+                if max(connections.values()) > now:
+                    continue
+                newest = max(connections.values())
+                del self.connections[user_id]
+                self.seen[user_id] = newest - settings.CHAT_PRESENCE_TTL_SECONDS
+                offline.append(user_id)
+        return offline
+
+
+def get_presence():
+    """The CHAT_PRESENCE_BACKEND instance of this process"""
+    global _backend, _backend_path
+    if _backend_path != settings.CHAT_PRESENCE_BACKEND:
+        _backend = import_string(settings.CHAT_PRESENCE_BACKEND)()
+        _backend_path = settings.CHAT_PRESENCE_BACKEND
+    return _backend
+
+
+def online_user_ids(user_ids):
+    """
+    Which of ``user_ids`` are online. If presence cannot be reached they count
+    as offline, so notifications err on the side of being sent.
+    """
+    try:
+        return get_presence().online_user_ids(user_ids)
+    except Exception as e:
+        logger.warning(f"Presence lookup failed, treating users as offline: {str(e)}")
+        return set()
+
+
+def is_online(user_id):
+    return user_id in online_user_ids([user_id])
+
+
+def note_seen(user_id):
+    """
+    Note that a user was just active without a socket (say, logging in or out),
+    for the next flush_last_seen. Their online state is left to their sockets.
+    """
+    try:
+        get_presence().note_seen(user_id)
+    except Exception as e:
+        logger.warning(f"Presence note_seen failed for user {user_id}: {str(e)}")
+
+
+def flush_last_seen():
+    """
+    Write the last-seen times noted since the previous flush, and whether each
+    of those users is online now, to UserProfile in one batch. Returns how
+    many profiles were updated. The times are forgotten only once written, so
+    a failed write leaves them for the next flush.
+    """
+    backend = get_presence()
+    seen = backend.read_seen()
+    if not seen:
+        return 0
+    online = online_user_ids(seen)
+    profiles = list(UserProfile.objects.filter(user_id__in=seen).only('id', 'user_id'))
+    for profile in profiles:
+        profile.last_seen = datetime.fromtimestamp(seen[profile.user_id], tz=dt_timezone.utc)
+        profile.is_online = profile.user_id in online
+    UserProfile.objects.bulk_update(profiles, ['is_online', 'last_seen'], batch_size=500)
+    backend.forget_seen(seen)
+    return len(profiles)
+
+
+def expire_presence():
+    """
+    Take offline the users whose every connection has expired, and tell their
+    conversations. Returns how many went offline.
+    """
+    backend = get_presence()
+    total = 0
+    while True:
+        offline = backend.expire(settings.CHAT_PRESENCE_SWEEP_BATCH_SIZE)
+        if offline:
+            send_presence_changed(offline, False)
+            total += len(offline)
+        if len(offline) < settings.CHAT_PRESENCE_SWEEP_BATCH_SIZE:
+            return total
+
+
+def _call(method, user_id, connection):
+    try:
+        return getattr(get_presence(), method)(user_id, connection)
+    except Exception as e:
+        # Presence is best effort; a chat socket must not fail because of it
+        logger.warning(f"Presence {method} failed for user {user_id}: {str(e)}")
+        return False
+
+
+# Redis round trips run off the event loop, outside the database thread
+_acall = sync_to_async(_call, thread_sensitive=False)
+asend_presence_changed = database_sync_to_async(send_presence_changed)
+
+
+class PresenceMixin:
+    """
+    Count a consumer's socket toward its user's presence from join_presence()
+    until it disconnects, refreshing it every third of the TTL. Client pings
+    and heartbeats call touch_presence().
+    """
+
+    presence_refresh = None
+
+    async def join_presence(self):
+        await self.touch_presence()
+        self.presence_refresh = asyncio.ensure_future(self.refresh_presence())
+
+    async def refresh_presence(self):
+        while True:
+            await asyncio.sleep(settings.CHAT_PRESENCE_TTL_SECONDS / 3)
+            await self.touch_presence()
+
+    async def touch_presence(self):
+        if await _acall('touch', self.user.id, self.channel_name):
+            await asend_presence_changed([self.user.id], True)
+
+    async def websocket_disconnect(self, message):
+        if self.presence_refresh is not None:
+            self.presence_refresh.cancel()
+            self.presence_refresh = None
+            if await _acall('disconnect', self.user.id, self.channel_name):
+                await asend_presence_changed([self.user.id], False)
+        await super().websocket_disconnect(message)
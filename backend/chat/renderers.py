@@ -0,0 +1,19 @@
+from rest_framework.renderers import JSONRenderer
+
+from . import codec
+
+
+class CodecJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that encodes through chat.codec. Indented output, as asked
+    for by the browsable API, still goes through DRF's own encoder.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        # Escape the line separators JavaScript would choke on if the JSON is
+        # embedded in a script, as DRF's JSONRenderer does
+        return codec.dumps_bytes(data).replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
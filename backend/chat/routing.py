@@ -4,4 +4,5 @@ from . import consumers
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<conversation_id>\d+)/$', consumers.ChatConsumer.as_asgi()),
     re_path(r'ws/conversations/$', consumers.ConversationListConsumer.as_asgi()),
+    re_path(r'ws/multiplex/$', consumers.MultiplexConsumer.as_asgi()),
 ]
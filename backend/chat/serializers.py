@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import Message, Conversation
+from .authentication import build_audio_url
 from users.models import UserProfile
 from django.contrib.auth.models import User
 
@@ -26,18 +27,34 @@ class MessageSerializer(serializers.ModelSerializer):
     sender_username = serializers.CharField(source='sender.username')
     sender_profile_picture = serializers.SerializerMethodField()
     recipient_profile_picture = serializers.SerializerMethodField()
-    audio_data_base64 = serializers.SerializerMethodField()
+    audio_url = serializers.SerializerMethodField()
+    is_read = serializers.SerializerMethodField()
+    is_delivered = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
         fields = ['id', 'content', 'timestamp', 'is_delivered', 'is_read', 
                  'sender_username', 'sender_profile_picture', 'recipient_profile_picture',
-                 'message_type', 'audio_data_base64']
+                 'message_type', 'audio_url', 'audio_size', 'audio_mime_type',
+                 'audio_duration', 'audio_sample_rate', 'audio_peaks']
     
-    def get_audio_data_base64(self, obj):
-        if obj.message_type == 'audio' and obj.audio_data:
-            import base64
-            return base64.b64encode(obj.audio_data).decode('utf-8')
+    def get_is_read(self, obj):
+        # Read watermarks ({profile id: read_up_to}) are authoritative; the stored flag is synced lazily
+        watermarks = self.context.get('read_watermarks') or {}
+        if obj.recipient_id in watermarks:
+            return obj.id <= watermarks[obj.recipient_id]
+        return obj.is_read
+
+    def get_is_delivered(self, obj):
+        # Delivery watermarks ({profile id: delivered_up_to}) work like read_watermarks
+        watermarks = self.context.get('delivery_watermarks') or {}
+        if obj.recipient_id in watermarks:
+            return obj.id <= watermarks[obj.recipient_id]
+        return obj.is_delivered
+
+    def get_audio_url(self, obj):
+        if obj.has_audio:
+            return build_audio_url(obj, self.context['request'])
         return None
 
     def get_sender_profile_picture(self, obj):
@@ -60,11 +77,25 @@ class ConversationSerializer(serializers.ModelSerializer):
         fields = ['id', 'participants', 'created_at', 'updated_at', 'last_message', 'unread_count']
 
     def get_last_message(self, obj):
-        last_message = obj.messages.order_by('-timestamp').first()
-        if last_message:
-            return MessageSerializer(last_message, context=self.context).data
+        if obj.last_message_id:
+            context = self.context
+            # Conversation.objects.with_summary() annotates the recipient's watermarks
+            read_up_to = getattr(obj, 'last_message_read_up_to', None)
+            if read_up_to is not None:
+                recipient_id = obj.last_message.recipient_id
+                context = {
+                    **context,
+                    'read_watermarks': {recipient_id: read_up_to},
+                    'delivery_watermarks': {recipient_id: obj.last_message_delivered_up_to},
+                }
+            return MessageSerializer(obj.last_message, context=context).data
         return None
 
     def get_unread_count(self, obj):
-        user = self.context['request'].user
-        return obj.messages.filter(recipient__user=user, is_read=False).count()
\ No newline at end of file
+        # Conversation.objects.with_summary() prefetches the viewer's membership
+        memberships = getattr(obj, 'viewer_memberships', None)
+        if memberships is None:
+            user = self.context['request'].user
+            memberships = obj.memberships.filter(profile__user=user)
+        membership = next(iter(memberships), None)
+        return membership.unread_count if membership else 0
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""
+Message creation and read tracking shared by the REST views and the WebSocket consumer.
+
+Every send goes through create_message: one transaction inserts the message
+and updates the conversation summary and memberships (see
+Conversation.record_message), and the side effects (conversation_update
+broadcast, email notification via chat.signals) run only once it commits.
+
+Reads go through mark_read, which moves the reader's watermark
+(ConversationMembership.read_up_to) with one write and broadcasts one
+read_up_to event, however many messages it covers. Delivery acks work the
+same way through mark_delivered, batched per socket by the consumer.
+"""
+import logging
+
+from channels.db import database_sync_to_async
+from django.db import transaction
+
+from .models import Message
+from .tasks import sync_read_state
+from .utils import send_conversation_update, send_delivered_up_to, send_read_up_to
+
+logger = logging.getLogger(__name__)
+
+
+def get_recipient(conversation, sender_profile):
+    """The other participant of a 1:1 conversation, with its user loaded, or None"""
+    return conversation.participants.select_related('user').exclude(id=sender_profile.id).first()
+
+
+def create_message(conversation, sender, recipient, content, message_type='text',
+                   stored_audio=None, is_new_conversation=False, request=None, participant_ids=None):
+    """
+    Insert a message from ``sender`` (a User) to ``recipient`` (a UserProfile)
+    and return it. ``stored_audio`` is a chat.storage.StoredAudio for voice notes;
+    ``participant_ids`` may be passed by callers that already hold the participant set.
+    """
+    audio_fields = stored_audio.message_fields() if stored_audio else {}
+    with transaction.atomic():
+        message = Message.objects.create(
+            conversation=conversation,
+            sender=sender,
+            recipient=recipient,
+            content=content,
+            message_type=message_type,
+            **audio_fields
+        )
+        # Also restores the conversation for participants who deleted it
+        conversation.record_message(message, participant_ids)
+        transaction.on_commit(
+            lambda: send_conversation_update(conversation, is_new=is_new_conversation, request=request)
+        )
+    return message
+
+
+# Entry point for consumers; runs the whole transaction in one thread hop
+acreate_message = database_sync_to_async(create_message)
+
+
+def mark_read(conversation, reader, reader_profile, message_id):
+    """
+    Mark everything up to ``message_id`` read for ``reader`` (a User, with
+    ``reader_profile`` its UserProfile). Once committed, participants get one
+    read_up_to event and is_read plus pending emails are settled by
+    chat.tasks.sync_read_state. Returns the new watermark, or None if it did not move.
+    """
+    with transaction.atomic():
+        read_up_to = conversation.mark_read_up_to(reader_profile, message_id)
+        if read_up_to is not None:
+            transaction.on_commit(
+                lambda: send_read_up_to(conversation.id, reader.username, read_up_to)
+            )
+            transaction.on_commit(
+                lambda: schedule_read_state_sync(conversation.id, reader_profile.id, read_up_to)
+            )
+    return read_up_to
+
+
+def schedule_read_state_sync(conversation_id, profile_id, read_up_to):
+    try:
+        sync_read_state.delay(conversation_id, profile_id, read_up_to)
+    except Exception as e:
+        # The watermark is already committed; is_read just stays stale until the next read
+        logger.warning(f"Failed to schedule read state sync for conversation {conversation_id}: {str(e)}")
+
+
+amark_read = database_sync_to_async(mark_read)
+
+
+def mark_delivered(conversation, recipient, recipient_profile, message_id):
+    """
+    Record that ``recipient``'s client has everything up to ``message_id`` and,
+    once committed, tell the conversation with one delivered_up_to event.
+    Returns the new watermark, or None if it did not move.
+    """
+    delivered_up_to = conversation.mark_delivered_up_to(recipient_profile, message_id)
+    if delivered_up_to is not None:
+        transaction.on_commit(
+            lambda: send_delivered_up_to(conversation.id, recipient.username, delivered_up_to)
+        )
+    return delivered_up_to
+
+
+amark_delivered = database_sync_to_async(mark_delivered)
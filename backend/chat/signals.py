@@ -1,6 +1,16 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
-from .models import Message
+from django.contrib.auth.models import User
+from users.models import UserProfile
+from .models import Conversation, ConversationMembership, Message
+from .conversation_cache import invalidate_conversation, invalidate_contacts_of, invalidate_conversation_lists
+from .utils import send_membership_changed
+from . import presence
+
+# Fields that change on every connect/heartbeat but never appear in conversation lists
+PRESENCE_FIELDS = {'is_online', 'last_seen', 'last_login'}
 
 
 @receiver(post_save, sender=Message)
@@ -11,31 +21,48 @@ def trigger_email_notification(sender, instance, created, **kwargs):
     logger.info(f"[SIGNAL] Message post_save signal triggered: Message {instance.id}, created={created}")
     
     if created:  # Only for new messages
+        # Decide once the message is committed, so a rolled-back send never emails anyone
+        transaction.on_commit(lambda: schedule_email_for_new_message(instance))
+
+
+def schedule_email_for_new_message(instance):
+    """Queue an email for a committed message if its recipient is offline"""
+    schedule_emails_for_new_messages([instance])
+
+
+def schedule_emails_for_new_messages(messages):
+    """
+    Queue emails for committed messages whose recipients are offline, looking up
+    every recipient in one query (chat.write_behind commits messages in batches)
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+    # Check if recipients are offline (chat.presence) and have email
+    recipients = {
+        profile_id: (user_id, email)
+        for profile_id, user_id, email in UserProfile.objects.filter(
+            id__in={message.recipient_id for message in messages}
+        ).values_list('id', 'user_id', 'user__email')
+    }
+    online = presence.online_user_ids({user_id for user_id, _ in recipients.values()})
+
+    # Import here to avoid circular imports
+    from .tasks import create_and_schedule_email_notification
+
+    for instance in messages:
         logger.info(f"[SIGNAL] Processing new message {instance.id}")
-        # Check if recipient is offline and has email
-        recipient_profile = instance.recipient
-        is_recipient_online = recipient_profile.is_online
-        recipient_email = recipient_profile.user.email
-        
+        recipient_user_id, recipient_email = recipients.get(instance.recipient_id, (None, None))
+        is_recipient_online = recipient_user_id in online
+
         if not is_recipient_online and recipient_email:
-            # Import here to avoid circular imports
             try:
-                from .tasks import create_and_schedule_email_notification
-                
                 # Schedule email notification
                 result = create_and_schedule_email_notification.delay(instance.id)
-                
-                import logging
-                logger = logging.getLogger(__name__)
                 logger.info(f"[SIGNAL] Email notification scheduled for message {instance.id} to {recipient_email} - Task ID: {result.id}")
-                
+
             except Exception as e:
-                import logging
-                logger = logging.getLogger(__name__)
                 logger.error(f"[SIGNAL] Failed to schedule email notification for message {instance.id}: {str(e)}")
         else:
-            import logging
-            logger = logging.getLogger(__name__)
             logger.info(f"[SIGNAL] Skipping email for message {instance.id} - Recipient online: {is_recipient_online}, Has email: {bool(recipient_email)}")
 
 
@@ -57,3 +84,89 @@ def cancel_email_notification_on_read(sender, instance, created, **kwargs):
             import logging
             logger = logging.getLogger(__name__)
             logger.error(f"[SIGNAL] Failed to cancel email notifications for message {instance.id}: {str(e)}")
+
+
+@receiver(post_delete, sender=Message)
+def update_conversation_summary_on_delete(sender, instance, **kwargs):
+    """Re-point last_message and release the unread slot of a deleted message"""
+    conversation = Conversation.objects.filter(id=instance.conversation_id).first()
+    if conversation is None:
+        return  # The whole conversation is being deleted
+    if conversation.last_message_id is None:
+        conversation.refresh_last_message()
+    conversation.release_unread(instance)
+
+
+@receiver(post_save, sender=Message)
+def invalidate_conversation_lists_on_edit(sender, instance, created, **kwargs):
+    """Edits and read/delivery changes can alter the last message shown in conversation lists"""
+    if not created:  # New messages are covered by Conversation.record_message
+        invalidate_conversation(instance.conversation_id)
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def invalidate_conversation_lists_on_membership_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Joining or leaving a conversation changes whose lists show it"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        invalidate_conversation_lists([instance.id])
+        for conversation_id in pk_set or ():
+            invalidate_conversation(conversation_id)
+    else:
+        invalidate_conversation(instance.id)
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def copy_activity_to_new_memberships(sender, instance, action, reverse, pk_set, **kwargs):
+    """New members take the conversation's activity time, so it keeps its place in their list"""
+    if action != 'post_add' or not pk_set:
+        return
+    if reverse:
+        ConversationMembership.objects.filter(profile=instance, conversation_id__in=pk_set).update(
+            activity_at=Subquery(
+                Conversation.objects.filter(pk=OuterRef('conversation_id')).values('updated_at')[:1]
+            )
+        )
+    else:
+        ConversationMembership.objects.filter(conversation=instance, profile_id__in=pk_set).update(
+            activity_at=instance.updated_at
+        )
+
+
+@receiver(post_save, sender=UserProfile)
+def invalidate_conversation_lists_on_profile_change(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= PRESENCE_FIELDS:
+        return
+    invalidate_contacts_of(instance.id)
+
+
+@receiver(post_save, sender=User)
+def invalidate_conversation_lists_on_user_change(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields and set(update_fields) <= PRESENCE_FIELDS):
+        return
+    profile_id = UserProfile.objects.filter(user=instance).values_list('id', flat=True).first()
+    if profile_id:
+        invalidate_contacts_of(profile_id)
+
+
+def notify_chat_sockets(conversation_ids):
+    """Have open chat sockets reload their cached membership once this transaction commits"""
+    conversation_ids = list(conversation_ids)
+    if conversation_ids:
+        transaction.on_commit(lambda: send_membership_changed(conversation_ids))
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def notify_chat_sockets_on_membership_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    notify_chat_sockets((pk_set or ()) if reverse else [instance.id])
+
+
+@receiver(post_save, sender=UserProfile)
+def notify_chat_sockets_on_profile_change(sender, instance, created, update_fields=None, **kwargs):
+    """Sockets cache participant profiles (e.g. for picture URLs in broadcasts)"""
+    if created or (update_fields and set(update_fields) <= PRESENCE_FIELDS):
+        return
+    notify_chat_sockets(instance.conversation_memberships.values_list('conversation_id', flat=True))
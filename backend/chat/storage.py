@@ -0,0 +1,121 @@
+"""
+Content-addressed storage for voice-note audio.
+
+Audio bytes are written once to the ``audio`` entry of ``settings.STORAGES``
+under their SHA-256 digest, so identical uploads share a single blob. Messages
+only keep the digest, size, MIME type and the ingest summary.
+"""
+import hashlib
+import io
+import os
+from typing import NamedTuple, Optional
+
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import storages
+
+from .audio_metadata import AudioMetadata, analyze_audio
+
+AUDIO_STORAGE_ALIAS = 'audio'
+DEFAULT_AUDIO_MIME_TYPE = 'application/octet-stream'
+
+
+class StoredAudio(NamedTuple):
+    sha256: str
+    size: int
+    mime_type: str
+    # Ingest summary from chat.audio_metadata, when the format could be decoded
+    metadata: Optional[AudioMetadata] = None
+
+    def message_fields(self):
+        """Field values to set on a Message that references this blob"""
+        fields = {
+            'audio_sha256': self.sha256,
+            'audio_size': self.size,
+            'audio_mime_type': self.mime_type,
+        }
+        if self.metadata:
+            fields.update({
+                'audio_duration': self.metadata.duration,
+                'audio_sample_rate': self.metadata.sample_rate,
+                'audio_peaks': self.metadata.peaks,
+            })
+        return fields
+
+
+def get_audio_storage():
+    return storages[AUDIO_STORAGE_ALIAS]
+
+
+def audio_blob_name(sha256):
+    """Storage name for a digest, fanned out so no directory grows unbounded"""
+    return f'{sha256[:2]}/{sha256[2:4]}/{sha256}'
+
+
+def guess_audio_mime_type(data):
+    """Sniff the container format from the first bytes of a clip"""
+    header = bytes(data[:12])
+    if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+        return 'audio/wav'
+    if header[:4] == b'OggS':
+        return 'audio/ogg'
+    if header[:4] == b'\x1a\x45\xdf\xa3':
+        return 'audio/webm'
+    if header[:3] == b'ID3' or header[:2] in (b'\xff\xfb', b'\xff\xf3', b'\xff\xf2'):
+        return 'audio/mpeg'
+    if header[4:8] == b'ftyp':
+        return 'audio/mp4'
+    return DEFAULT_AUDIO_MIME_TYPE
+
+
+def store_audio(data, mime_type=None):
+    """
+    Write audio bytes to storage (once per distinct content) and return
+    the reference a Message should keep.
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    storage = get_audio_storage()
+    name = audio_blob_name(sha256)
+    if not storage.exists(name):
+        storage.save(name, ContentFile(data))
+    mime_type = mime_type or guess_audio_mime_type(data)
+    return StoredAudio(
+        sha256=sha256,
+        size=len(data),
+        mime_type=mime_type,
+        metadata=analyze_audio(io.BytesIO(data), mime_type),
+    )
+
+
+def store_audio_file(audio_file, mime_type=None):
+    """
+    Same as store_audio for a seekable file object (e.g. a spooled upload),
+    hashed and copied in blocks so the clip is never held in memory whole.
+    """
+    audio_file.seek(0)
+    head = audio_file.read(16)
+    audio_file.seek(0)
+    sha256 = hashlib.file_digest(audio_file, 'sha256').hexdigest()
+    size = audio_file.seek(0, os.SEEK_END)
+
+    storage = get_audio_storage()
+    name = audio_blob_name(sha256)
+    if not storage.exists(name):
+        audio_file.seek(0)
+        storage.save(name, File(audio_file))
+    mime_type = mime_type or guess_audio_mime_type(head)
+    return StoredAudio(
+        sha256=sha256,
+        size=size,
+        mime_type=mime_type,
+        metadata=analyze_audio(audio_file, mime_type),
+    )
+
+
+def open_audio(sha256):
+    """Open a stored blob for binary reading"""
+    return get_audio_storage().open(audio_blob_name(sha256), 'rb')
+
+
+def read_audio(sha256):
+    with open_audio(sha256) as audio_file:
+        return audio_file.read()
@@ -6,8 +6,8 @@ from django.contrib.auth.models import User
 from datetime import timedelta
 import logging
 
-from .models import Message, EmailNotification
-from users.models import UserProfile
+from .models import Message, EmailNotification, AudioUpload
+from . import presence, uploads
 
 logger = logging.getLogger(__name__)
 
@@ -20,14 +20,13 @@ def send_email_notification(self, email_notification_id):
         email_notification = EmailNotification.objects.get(id=email_notification_id)
         
         # Check if message has been read since scheduling
-        if email_notification.message.is_read:
+        if email_notification.message.has_been_read():
             logger.info(f"Message {email_notification.message.id} has been read, cancelling email")
             email_notification.cancel()
             return f"Email cancelled - message {email_notification.message.id} already read"
         
         # Check if recipient is now online
-        recipient_profile = UserProfile.objects.get(user=email_notification.recipient)
-        if recipient_profile.is_online:
+        if presence.is_online(email_notification.recipient_id):
             logger.info(f"Recipient {email_notification.recipient.username} is now online, cancelling email")
             email_notification.cancel()
             return f"Email cancelled - recipient {email_notification.recipient.username} is online"
@@ -83,13 +82,12 @@ def schedule_follow_up_reminder(message_id):
         message = Message.objects.get(id=message_id)
         
         # Check if message has been read
-        if message.is_read:
+        if message.has_been_read():
             logger.info(f"Message {message_id} has been read, skipping follow-up reminder")
             return f"Follow-up cancelled - message {message_id} already read"
         
         # Check if recipient is online
-        recipient_profile = UserProfile.objects.get(user=message.recipient.user)
-        if recipient_profile.is_online:
+        if presence.is_online(message.recipient.user_id):
             logger.info(f"Recipient {message.recipient.user.username} is online, skipping follow-up reminder")
             return f"Follow-up cancelled - recipient is online"
         
@@ -149,8 +147,7 @@ def create_and_schedule_email_notification(message_id):
         message = Message.objects.get(id=message_id)
         
         # Double-check recipient is offline and message is unread
-        recipient_profile = UserProfile.objects.get(user=message.recipient.user)
-        if recipient_profile.is_online or message.is_read:
+        if presence.is_online(message.recipient.user_id) or message.has_been_read():
             logger.info(f"Skipping email for message {message_id} - recipient online or message read")
             return f"Email skipped for message {message_id}"
         
@@ -233,6 +230,38 @@ def cancel_pending_notifications_for_message(message_id):
         logger.error(f"Error cancelling notifications for message {message_id}: {str(exc)}")
         return f"Error cancelling notifications: {str(exc)}"
 
+@shared_task
+def sync_read_state(conversation_id, profile_id, read_up_to):
+    """
+    Bring is_read in line with a reader's new watermark and cancel the email
+    notifications it made moot. Runs once per watermark move, however many
+    messages it covers.
+    """
+    try:
+        read_messages = Message.objects.filter(
+            conversation_id=conversation_id, recipient_id=profile_id, id__lte=read_up_to
+        )
+        updated = read_messages.filter(is_read=False).update(is_read=True, is_delivered=True)
+
+        pending_notifications = EmailNotification.objects.filter(
+            message__in=read_messages, status='pending'
+        )
+        task_ids = [task_id for task_id in pending_notifications.values_list('celery_task_id', flat=True) if task_id]
+        cancelled_count = pending_notifications.update(status='cancelled')
+        if task_ids:
+            from backend.celery import app
+            app.control.revoke(task_ids, terminate=True)
+
+        logger.info(
+            f"Synced {updated} read messages and cancelled {cancelled_count} notifications "
+            f"for profile {profile_id} in conversation {conversation_id}"
+        )
+        return f"Synced {updated} messages, cancelled {cancelled_count} notifications"
+
+    except Exception as exc:
+        logger.error(f"Error syncing read state for conversation {conversation_id}: {str(exc)}")
+        return f"Error syncing read state: {str(exc)}"
+
 @shared_task
 def cleanup_old_email_notifications():
     """
@@ -250,3 +279,76 @@ def cleanup_old_email_notifications():
     except Exception as exc:
         logger.error(f"Cleanup task failed: {str(exc)}")
         return f"Cleanup failed: {str(exc)}"
+
+@shared_task
+def cleanup_stale_audio_uploads():
+    """
+    Periodic task to purge resumable audio uploads that were never committed
+    """
+    try:
+        cutoff = timezone.now() - timedelta(hours=settings.CHAT_UPLOAD_EXPIRY_HOURS)
+        stale_uploads = AudioUpload.objects.filter(created_at__lt=cutoff, message__isnull=True)
+        stale_ids = list(stale_uploads.values_list('id', flat=True))
+        for upload_id in stale_ids:
+            uploads.discard_chunks(upload_id)
+        deleted_count = AudioUpload.objects.filter(id__in=stale_ids).delete()[0]
+
+        logger.info(f"Cleaned up {deleted_count} stale audio uploads")
+        return f"Cleaned up {deleted_count} stale audio uploads"
+
+    except Exception as exc:
+        logger.error(f"Audio upload cleanup failed: {str(exc)}")
+        return f"Audio upload cleanup failed: {str(exc)}"
+
+
+@shared_task
+def replay_message_journal():
+    """
+    Periodic task to store write-behind messages whose writer died before
+    flushing them (see chat.write_behind)
+    """
+    if not settings.CHAT_WRITE_BEHIND:
+        return "Write-behind is off"
+    if not settings.CHAT_WRITE_BEHIND_JOURNAL_URL:
+        return "No write-behind journal configured"
+    try:
+        # Import here to avoid circular imports
+        from .write_behind import replay_journal
+
+        replayed = replay_journal()
+        if replayed:
+            logger.warning(f"Replayed {replayed} journaled messages")
+        return f"Replayed {replayed} journaled messages"
+
+    except Exception as exc:
+        logger.error(f"Message journal replay failed: {str(exc)}")
+        return f"Message journal replay failed: {str(exc)}"
+
+
+@shared_task
+def flush_presence():
+    """
+    Periodic task to write last-seen times noted by chat.presence to user profiles
+    """
+    try:
+        updated = presence.flush_last_seen()
+        return f"Flushed presence of {updated} users"
+
+    except Exception as exc:
+        logger.error(f"Presence flush failed: {str(exc)}")
+        return f"Presence flush failed: {str(exc)}"
+
+
+@shared_task
+def expire_presence():
+    """
+    Periodic task to take offline users whose sockets vanished without
+    disconnecting (see chat.presence)
+    """
+    try:
+        expired = presence.expire_presence()
+        return f"Expired presence of {expired} users"
+
+    except Exception as exc:
+        logger.error(f"Presence expiry failed: {str(exc)}")
+        return f"Presence expiry failed: {str(exc)}"
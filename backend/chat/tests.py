@@ -0,0 +1,1582 @@
+import asyncio
+import base64
+import importlib
+import io
+import json
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import uuid
+import wave
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import skipUnless
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DatabaseError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils.translation import gettext_lazy
+from rest_framework.renderers import JSONRenderer
+from rest_framework_simplejwt.tokens import AccessToken
+from users.models import UserProfile
+
+from . import codec, metrics, presence, routing, uploads, write_behind
+from .audio_metadata import analyze_audio
+
+from .authentication import audio_url_signer, signed_audio_path
+from .consumers import ChatConsumer, parse_audio_frame
+from .conversation_cache import (
+    cache_conversation_list, get_conversation_list_generation, invalidate_conversation_lists
+)
+from .models import AudioUpload, Conversation, ConversationMembership, ConversationQuerySet, Message
+from .outbound import SLOW_CONSUMER_CLOSE_CODE, OutboundQueue
+from .pagination import encode_cursor, keyset_filter
+from .renderers import CodecJSONRenderer
+from .services import acreate_message, create_message
+from .signals import schedule_emails_for_new_messages
+from .storage import store_audio
+from .tasks import replay_message_journal, sync_read_state
+from .utils import event_within_size_limit, frame_event, send_conversation_update
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+IN_MEMORY_PRESENCE = 'chat.presence.InMemoryPresence'
+
+
+class TemporaryAudioStorageMixin:
+    """Point the audio storage and upload staging at a directory removed after each test"""
+
+    def setUp(self):
+        super().setUp()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.enterContext(override_settings(
+            STORAGES={
+                'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+                'audio': {
+                    'BACKEND': 'django.core.files.storage.FileSystemStorage',
+                    'OPTIONS': {'location': f'{root}/audio'},
+                },
+            },
+            CHAT_UPLOAD_TEMP_ROOT=f'{root}/uploads',
+        ))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE)
+class MessageAudioTests(TemporaryAudioStorageMixin, TestCase):
+    audio = b'OggS' + bytes(range(256)) * 4
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user('sender', password='x')
+        cls.recipient = User.objects.create_user('recipient', password='x')
+        cls.outsider = User.objects.create_user('outsider', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.recipient.userprofile
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.message = Message.objects.create(
+            conversation=self.conversation, sender=self.sender, recipient=self.recipient.userprofile,
+            message_type='audio', **store_audio(self.audio).message_fields()
+        )
+
+    def get(self, path, **headers):
+        response = self.client.get(path, headers=headers)
+        if response.status_code in (200, 206):
+            response.body = b''.join(response.streaming_content)
+        return response
+
+    def test_sent_audio_is_stored_once_by_content(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.sender)}'
+        url = f'/chat/api/conversation/{self.conversation.id}/send-message/'
+        body = {'message_type': 'audio', 'audio_data_base64': base64.b64encode(self.audio).decode()}
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.client.post(url, body, content_type='application/json').data
+            second = self.client.post(url, body, content_type='application/json').data
+
+        self.assertEqual((first['audio_size'], first['audio_mime_type']), (len(self.audio), 'audio/ogg'))
+        self.assertNotIn('audio_data', first)
+        digests = set(Message.objects.filter(id__in=[first['id'], second['id']]).values_list('audio_sha256', flat=True))
+        self.assertEqual(digests, {self.message.audio_sha256})
+        self.assertEqual(self.get(first['audio_url']).body, self.audio)
+
+    def test_ranges_and_conditional_requests(self):
+        path = signed_audio_path(self.message.id, self.recipient)
+        size = len(self.audio)
+        etag = f'"{self.message.audio_sha256}"'
+
+        full = self.get(path)
+        self.assertEqual((full.status_code, full.body, full['ETag']), (200, self.audio, etag))
+        self.assertEqual((full['Accept-Ranges'], full['Content-Type']), ('bytes', 'audio/ogg'))
+
+        partial = self.get(path, Range='bytes=10-19')
+        self.assertEqual((partial.status_code, partial.body), (206, self.audio[10:20]))
+        self.assertEqual((partial['Content-Range'], partial['Content-Length']), (f'bytes 10-19/{size}', '10'))
+        self.assertEqual(self.get(path, Range='bytes=-4').body, self.audio[-4:])
+        self.assertEqual(self.get(path, Range=f'bytes={size - 2}-').body, self.audio[-2:])
+        # Ranges past the end are clamped; malformed ones serve the whole clip
+        self.assertEqual(self.get(path, Range=f'bytes=0-{size * 2}').body, self.audio)
+        self.assertEqual(self.get(path, Range='bytes=abc').status_code, 200)
+
+        unsatisfiable = self.get(path, Range=f'bytes={size}-')
+        self.assertEqual((unsatisfiable.status_code, unsatisfiable['Content-Range']), (416, f'bytes */{size}'))
+
+        self.assertEqual(self.get(path, **{'If-None-Match': etag}).status_code, 304)
+        # A Range for an older version of the clip gets the whole current one
+        self.assertEqual(self.get(path, Range='bytes=0-3', **{'If-Range': '"stale"'}).status_code, 200)
+
+    def test_audio_requires_a_participant(self):
+        path = reverse('message_audio', args=[self.message.id])
+        self.assertEqual(self.get(path).status_code, 401)
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.outsider)}'
+        self.assertEqual(self.get(path).status_code, 404)
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.recipient)}'
+        self.assertEqual(self.get(path).body, self.audio)
+
+    def test_signed_link_is_stable_within_a_window(self):
+        window = 24 * 60 * 60
+        with override_settings(CHAT_AUDIO_URL_WINDOW_SECONDS=window):
+            with patch('time.time', return_value=10 * window + 60):
+                first = signed_audio_path(self.message.id, self.recipient)
+            with patch('time.time', return_value=11 * window - 60):
+                self.assertEqual(signed_audio_path(self.message.id, self.recipient), first)
+                self.assertEqual(self.get(first).status_code, 200)
+            with patch('time.time', return_value=11 * window + 60):
+                self.assertNotEqual(signed_audio_path(self.message.id, self.recipient), first)
+                # Still accepted a window later, so a link handed out late in its window
+                # gets at least a full window of use
+                self.assertEqual(self.get(first).status_code, 200)
+            with patch('time.time', return_value=12 * window + 60):
+                self.assertEqual(self.get(first).status_code, 401)
+
+    def test_signed_link_is_bound_to_message_and_membership(self):
+        other = Message.objects.create(
+            conversation=self.conversation, sender=self.sender, recipient=self.recipient.userprofile,
+            message_type='audio', **store_audio(b'OggS other').message_fields()
+        )
+        path = signed_audio_path(self.message.id, self.recipient)
+        self.assertEqual(self.get(path.replace(f'/{self.message.id}/', f'/{other.id}/')).status_code, 401)
+        self.assertEqual(self.get(signed_audio_path(self.message.id, self.outsider)).status_code, 404)
+        self.assertEqual(self.get(path.replace('sig=', 'sig=x')).status_code, 401)
+
+
+def audio_frame(header, payload=b''):
+    """A binary WebSocket frame as parse_audio_frame expects it"""
+    encoded = json.dumps(header).encode() if isinstance(header, dict) else header
+    return struct.pack('!I', len(encoded)) + encoded + payload
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE)
+class BinaryAudioFrameTests(TemporaryAudioStorageMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user('sender', password='x')
+        cls.recipient = User.objects.create_user('recipient', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.recipient.userprofile
+        )
+
+    def test_parse_audio_frame(self):
+        header, payload = parse_audio_frame(audio_frame({'upload_id': 'a', 'final': True}, b'OggS'))
+        self.assertEqual((header, bytes(payload)), ({'upload_id': 'a', 'final': True}, b'OggS'))
+        self.assertEqual(bytes(parse_audio_frame(audio_frame({}))[1]), b'')
+
+        for frame in (
+            b'\x00\x00',                                       # shorter than the length prefix
+            struct.pack('!I', 50) + b'{}',                     # header runs past the frame
+            audio_frame({'pad': 'x' * 5000}),                  # header over the limit
+            audio_frame(b'[1, 2]'),                            # header is not an object
+            audio_frame(b'{"upload_id": '),                    # header is not JSON
+            audio_frame(b'\xff\xfe'),                          # header is not UTF-8
+        ):
+            with self.subTest(frame=frame[:12]), self.assertRaises(ValueError):
+                parse_audio_frame(frame)
+
+    def test_frames_are_assembled_into_one_audio_message(self):
+        async def run():
+            communicator = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+            )
+            communicator.scope['user'] = self.sender
+            await communicator.connect()
+            await communicator.send_to(bytes_data=audio_frame(b'nonsense'))
+            invalid = await communicator.receive_json_from()
+            await communicator.send_to(bytes_data=audio_frame({'upload_id': 'u1', 'content': 'voice'}, b'OggS'))
+            await communicator.send_to(bytes_data=audio_frame({'upload_id': 'u1', 'final': True}, b'rest'))
+            message = await communicator.receive_json_from()
+            with override_settings(CHAT_AUDIO_MAX_BYTES=6):
+                await communicator.send_to(bytes_data=audio_frame({'upload_id': 'u2'}, b'OggS'))
+                await communicator.send_to(bytes_data=audio_frame({'upload_id': 'u2', 'final': True}, b'more'))
+                too_large = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return invalid, message, too_large
+
+        with self.captureOnCommitCallbacks(execute=False):
+            invalid, message, too_large = async_to_sync(run)()
+        self.assertEqual(invalid, {'error': 'Invalid binary frame header'})
+        self.assertEqual((message['content'], message['message_type']), ('voice', 'audio'))
+        stored = Message.objects.get(conversation=self.conversation)
+        self.assertEqual((stored.audio_size, stored.audio_mime_type), (8, 'audio/ogg'))
+        self.assertEqual(too_large['error'], 'Audio message is too large')
+        self.assertEqual(too_large['upload_id'], 'u2')
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE)
+class ChannelLayerEventTests(TemporaryAudioStorageMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user('sender', password='x')
+        cls.recipient = User.objects.create_user('recipient', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.recipient.userprofile
+        )
+
+    def communicator(self, user):
+        communicator = WebsocketCommunicator(
+            URLRouter(routing.websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+        )
+        communicator.scope['user'] = user
+        return communicator
+
+    @override_settings(CHANNEL_LAYER_MAX_EVENT_BYTES=1024)
+    def test_oversized_events_are_not_broadcast(self):
+        async def run():
+            sender = self.communicator(self.sender)
+            recipient = self.communicator(self.recipient)
+            await sender.connect()
+            await recipient.connect()
+            self.assertEqual((await sender.receive_json_from())['action_type'], 'presence')
+            await sender.send_json_to({'content': 'x' * 2000})
+            error = await sender.receive_json_from()
+            nothing_delivered = await recipient.receive_nothing(timeout=0.2)
+            await sender.disconnect()
+            await recipient.disconnect()
+            return error, nothing_delivered
+
+        rejected = metrics.get(metrics.OVERSIZED_EVENTS_REJECTED)
+        with self.captureOnCommitCallbacks(execute=False), self.assertLogs('chat.utils', 'WARNING'):
+            error, nothing_delivered = async_to_sync(run)()
+        message = Message.objects.get(conversation=self.conversation)
+        self.assertEqual((error['error'], error['id']), ('Message saved but too large to broadcast', message.id))
+        self.assertTrue(nothing_delivered)
+        self.assertEqual(metrics.get(metrics.OVERSIZED_EVENTS_REJECTED) - rejected, 1)
+
+    def test_audio_is_broadcast_as_a_reference_signed_per_receiver(self):
+        async def run():
+            sender = self.communicator(self.sender)
+            recipient = self.communicator(self.recipient)
+            await sender.connect()
+            await recipient.connect()
+            self.assertEqual((await sender.receive_json_from())['action_type'], 'presence')
+            with patch('chat.utils.event_within_size_limit', wraps=event_within_size_limit) as checked:
+                await sender.send_to(bytes_data=audio_frame({'upload_id': 'u', 'final': True}, b'OggS' * 100))
+                frames = [await sender.receive_json_from(), await recipient.receive_json_from()]
+            await sender.disconnect()
+            await recipient.disconnect()
+            return frames, checked.call_args.args[1]
+
+        with self.captureOnCommitCallbacks(execute=False):
+            frames, event = async_to_sync(run)()
+        self.assertNotIn('OggS', json.dumps(event))
+        self.assertEqual({frame['audio_size'] for frame in frames}, {400})
+        signed_for = [
+            audio_url_signer.unsign_object(frame['audio_url'].split('sig=')[1], max_age=None)['user']
+            for frame in frames
+        ]
+        self.assertEqual(signed_for, [self.sender.id, self.recipient.id])
+
+    def test_conversation_update_is_filled_in_per_viewer(self):
+        message = Message.objects.create(
+            conversation=self.conversation, sender=self.sender, recipient=self.recipient.userprofile,
+            message_type='audio', audio_sha256='0' * 64,
+        )
+        self.conversation.record_message(message)
+
+        async def run():
+            sockets = []
+            for user in (self.sender, self.recipient):
+                communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), '/ws/conversations/')
+                communicator.scope['user'] = user
+                await communicator.connect()
+                sockets.append(communicator)
+            # No request, as from write-behind: the shared frame is built for nobody
+            await database_sync_to_async(send_conversation_update)(self.conversation)
+            frames = [(await socket.receive_json_from())['conversation'] for socket in sockets]
+            for socket in sockets:
+                await socket.disconnect()
+            return frames
+
+        frames = async_to_sync(run)()
+        self.assertEqual([frame['unread_count'] for frame in frames], [0, 1])
+        signed_for = [
+            audio_url_signer.unsign_object(frame['last_message']['audio_url'].split('sig=')[1], max_age=None)['user']
+            for frame in frames
+        ]
+        self.assertEqual(signed_for, [self.sender.id, self.recipient.id])
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE,
+    CHAT_AUDIO_MAX_BYTES=10, CHAT_UPLOAD_MAX_CHUNK_BYTES=4,
+)
+class AudioUploadTests(TemporaryAudioStorageMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user('sender', password='x')
+        cls.recipient = User.objects.create_user('recipient', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.recipient.userprofile
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.sender)}'
+        response = self.client.post(
+            '/chat/api/uploads/', {'conversation_id': self.conversation.id}, content_type='application/json'
+        )
+        self.upload_id = response.data['upload_id']
+
+    def put_chunk(self, index, data):
+        return self.client.put(
+            f'/chat/api/uploads/{self.upload_id}/chunks/{index}/', data, content_type='application/octet-stream'
+        )
+
+    def commit(self, chunk_count):
+        return self.client.post(
+            f'/chat/api/uploads/{self.upload_id}/commit/', {'chunk_count': chunk_count}, content_type='application/json'
+        )
+
+    def test_resume_and_commit_once(self):
+        self.assertEqual(self.put_chunk(1, b'1234').status_code, 200)
+        self.assertEqual(self.commit(3).status_code, 400)
+        self.put_chunk(0, b'OggS')
+        self.put_chunk(2, b'xx')
+        # Re-sending a chunk replaces it
+        status = self.put_chunk(2, b'56').data
+        self.assertEqual((status['received_chunks'], status['received_bytes']), ([0, 1, 2], 10))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.commit(3)
+        self.assertEqual(first.status_code, 201)
+        retry = self.commit(3)
+        self.assertEqual((retry.status_code, retry.data['id']), (200, first.data['id']))
+        message = Message.objects.get(id=first.data['id'])
+        self.assertEqual((message.audio_size, message.audio_mime_type), (10, 'audio/ogg'))
+        self.assertEqual(Message.objects.filter(conversation=self.conversation).count(), 1)
+        self.assertEqual(self.put_chunk(0, b'OggS').status_code, 409)
+        self.assertEqual(uploads.received_chunks(self.upload_id), {})
+
+    def test_chunk_and_total_limits(self):
+        self.assertEqual(self.put_chunk(0, b'12345').status_code, 413)
+        # ceil(10 / 4) chunks at most
+        self.assertEqual(self.put_chunk(3, b'1').status_code, 400)
+        self.put_chunk(0, b'1234')
+        self.put_chunk(1, b'1234')
+        self.assertEqual(self.put_chunk(2, b'123').status_code, 413)
+        self.assertEqual(self.put_chunk(2, b'12').status_code, 200)
+
+    def test_empty_chunk_is_rejected(self):
+        response = self.put_chunk(0, b'')
+        self.assertEqual((response.status_code, response.data['error']), (400, 'Chunk is empty.'))
+        self.assertEqual(uploads.received_chunks(self.upload_id), {})
+
+    def test_concurrent_chunks_cannot_exceed_the_total(self):
+        receive_chunk = uploads.receive_chunk
+
+        def receive_while_another_lands(upload_id, stream, max_bytes):
+            received = receive_chunk(upload_id, stream, max_bytes)
+            # A parallel request stores chunk 0 after this one passed the streaming check
+            part_path, _ = receive_chunk(upload_id, io.BytesIO(b'1234'), max_bytes)
+            uploads.store_chunk(upload_id, 0, part_path)
+            return received
+
+        self.put_chunk(1, b'1234')
+        with patch('chat.uploads.receive_chunk', receive_while_another_lands):
+            self.assertEqual(self.put_chunk(2, b'123').status_code, 413)
+        self.assertEqual(uploads.received_chunks(self.upload_id), {0: 4, 1: 4})
+        self.assertFalse(AudioUpload.objects.get(id=self.upload_id).message_id)
+
+
+def wav_bytes(frames, sample_width, channels=1, sample_rate=8000):
+    """A PCM WAV file of raw little-endian ``frames``"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(sample_width)
+        wav.setframerate(sample_rate)
+        wav.writeframes(frames)
+    return buffer.getvalue()
+
+
+class AudioMetadataTests(TemporaryAudioStorageMixin, TestCase):
+    def test_16_bit_mono(self):
+        # Half a second of silence, then half a second at full scale
+        clip = wav_bytes(struct.pack('<4000h', *[0] * 4000) + struct.pack('<4000h', *[32767] * 4000), 2)
+        metadata = analyze_audio(io.BytesIO(clip), 'audio/wav')
+        self.assertEqual((metadata.duration, metadata.sample_rate), (1.0, 8000))
+        self.assertEqual(metadata.peaks, [0] * 32 + [255] * 32)
+
+    def test_8_bit_is_unsigned(self):
+        clip = wav_bytes(bytes([128] * 100 + [0] * 100), 1)
+        self.assertEqual(analyze_audio(io.BytesIO(clip), 'audio/wav').peaks, [0] * 32 + [255] * 32)
+
+    def test_24_bit_stereo_takes_the_loudest_channel(self):
+        # Ten frames: the left channel is silent, the right one rises to full negative scale
+        frames = b''.join(
+            (0).to_bytes(3, 'little', signed=True) + (-(2 ** 23) * i // 9).to_bytes(3, 'little', signed=True)
+            for i in range(10)
+        )
+        metadata = analyze_audio(io.BytesIO(wav_bytes(frames, 3, channels=2, sample_rate=10)), 'audio/wav')
+        self.assertEqual(metadata.duration, 1.0)
+        self.assertEqual(metadata.peaks, [round(255 * i / 9) for i in range(10)])
+
+    def test_other_formats_have_no_summary(self):
+        self.assertIsNone(analyze_audio(io.BytesIO(b'RIFF....WAVEjunk'), 'audio/wav'))
+        self.assertIsNone(analyze_audio(io.BytesIO(wav_bytes(b'\x00' * 8, 2)), 'audio/ogg'))
+        self.assertIsNone(store_audio(b'OggS' + b'\x00' * 10).metadata)
+
+    def test_summary_is_stored_with_the_clip(self):
+        fields = store_audio(wav_bytes(b'\x00\x00' * 8000, 2)).message_fields()
+        self.assertEqual(fields['audio_mime_type'], 'audio/wav')
+        self.assertEqual((fields['audio_duration'], fields['audio_sample_rate']), (1.0, 8000))
+        self.assertEqual(fields['audio_peaks'], [0] * 64)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE)
+class ConversationSummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user('sender', password='x')
+        cls.recipient = User.objects.create_user('recipient', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.recipient.userprofile
+        )
+
+    def summary(self):
+        self.conversation.refresh_from_db()
+        membership = ConversationMembership.objects.get(
+            conversation=self.conversation, profile=self.recipient.userprofile
+        )
+        return self.conversation.last_message_id, membership.unread_count
+
+    def test_summary_follows_sends_deletes_and_reads(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first, second, third = [
+                create_message(self.conversation, self.sender, self.recipient.userprofile, f'm{i}') for i in range(3)
+            ]
+        self.assertEqual(self.summary(), (third.id, 3))
+
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.sender)}'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.delete(f'/chat/api/message/{third.id}/delete/').status_code, 200)
+        self.assertEqual(self.summary(), (second.id, 2))
+
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.recipient)}'
+        url = f'/chat/api/conversation/{self.conversation.id}/read/'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(url, {'message_id': first.id}, content_type='application/json')
+        self.assertEqual(self.summary(), (second.id, 1))
+        # Deleting a message the recipient already read leaves their counter alone
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(self.summary(), (second.id, 1))
+
+        response = self.client.get('/chat/api/conversations/')
+        conversation = response.data['conversations'][0]
+        self.assertEqual((conversation['last_message']['id'], conversation['unread_count']), (second.id, 1))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE)
+class MessageHistoryPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user('sender', password='x')
+        cls.recipient = User.objects.create_user('recipient', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.recipient.userprofile
+        )
+        cls.ids = [
+            create_message(cls.conversation, cls.sender, cls.recipient.userprofile, f'm{i}').id for i in range(5)
+        ]
+        # Equal timestamps, so pages are told apart by id alone
+        Message.objects.update(timestamp=datetime(2026, 1, 1, tzinfo=dt_timezone.utc))
+
+    def setUp(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.sender)}'
+
+    def page(self, **params):
+        response = self.client.get(f'/chat/api/conversation/{self.conversation.id}/messages/', params)
+        self.assertEqual(response.status_code, 200)
+        return [message['id'] for message in response.data['messages']], response.data['pagination']
+
+    def test_walks_back_through_history_and_forward_again(self):
+        ids, pagination = self.page(page_size=2)
+        self.assertEqual(ids, self.ids[3:])
+        pages = [ids]
+        while pagination['has_next']:
+            ids, pagination = self.page(page_size=2, before=pagination['next_cursor'])
+            pages.append(ids)
+        self.assertEqual(pages, [self.ids[3:], self.ids[1:3], self.ids[:1]])
+        self.assertIsNone(pagination['next_cursor'])
+
+        ids, pagination = self.page(page_size=3, after=pagination['oldest_cursor'])
+        self.assertEqual((ids, pagination['has_next']), (self.ids[1:4], True))
+        ids, pagination = self.page(page_size=3, after=pagination['next_cursor'])
+        self.assertEqual((ids, pagination['has_next']), (self.ids[4:], False))
+
+    def test_malformed_cursors_are_rejected(self):
+        url = f'/chat/api/conversation/{self.conversation.id}/messages/'
+        for params in ({'before': 'not-a-cursor'}, {'after': 'bm90fGE'}, {'before': '!!!'}):
+            with self.subTest(params=params):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('Invalid cursor', response.data['error'])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE)
+class ConversationListPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('user', password='x')
+        cls.conversations = [
+            Conversation.objects.get_or_create_direct(
+                cls.user.userprofile, User.objects.create_user(f'contact{i}', password='x').userprofile
+            )[0]
+            for i in range(4)
+        ]
+        # Equal activity times, so pages are told apart by id alone
+        Conversation.objects.update(updated_at=datetime(2026, 1, 1, tzinfo=dt_timezone.utc))
+        ConversationMembership.objects.update(activity_at=datetime(2026, 1, 1, tzinfo=dt_timezone.utc))
+        cls.conversations[0].hide_for(cls.user.userprofile)
+
+    def setUp(self):
+        cache.clear()
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.user)}'
+
+    def page(self, **params):
+        response = self.client.get('/chat/api/conversations/', params)
+        self.assertEqual(response.status_code, 200)
+        return [conversation['id'] for conversation in response.data['conversations']], response.data['pagination']
+
+    def test_walks_the_list_by_activity(self):
+        visible = [conversation.id for conversation in reversed(self.conversations[1:])]
+        ids, pagination = self.page(page_size=1, include_total='1')
+        self.assertEqual((ids, pagination['total_conversations']), (visible[:1], 3))
+        seen = list(ids)
+        # A conversation becoming active mid-scroll moves above the cursor rather than repeating
+        ConversationMembership.objects.filter(conversation_id=visible[-1]).update(
+            activity_at=datetime(2026, 2, 1, tzinfo=dt_timezone.utc)
+        )
+        while pagination['has_next']:
+            ids, pagination = self.page(page_size=1, cursor=pagination['next_cursor'])
+            seen.extend(ids)
+        self.assertEqual(seen, visible[:2])
+        self.assertEqual(self.page()[0], [visible[-1], *visible[:2]])
+
+    def test_new_messages_move_the_conversation_for_every_member(self):
+        conversation = self.conversations[1]
+        message = Message.objects.create(
+            conversation=conversation, sender=conversation.participants.exclude(user=self.user).get().user,
+            recipient=self.user.userprofile, content='hi',
+        )
+        conversation.record_message(message)
+        self.assertEqual(
+            set(conversation.memberships.values_list('activity_at', flat=True)), {message.timestamp}
+        )
+        self.assertEqual(self.page()[0][0], conversation.id)
+
+    @skipUnless(connection.vendor == 'sqlite', 'reads the SQLite query plan')
+    def test_page_is_an_index_range_scan(self):
+        memberships = self.user.userprofile.conversation_memberships.filter(hidden=False)
+        position = encode_cursor(datetime(2026, 1, 1, tzinfo=dt_timezone.utc), self.conversations[3].id)
+        for query in (memberships, memberships.filter(
+            keyset_filter('activity_at', position, 'before', pk_field='conversation_id')
+        )):
+            query = query.order_by('-activity_at', '-conversation_id').values_list('conversation_id', 'activity_at')[:9]
+            sql, params = query.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                plan = ' / '.join(row[-1] for row in cursor.fetchall())
+            with self.subTest(plan=plan):
+                self.assertIn('chat_membership_activity_idx', plan)
+                self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_malformed_cursor_is_rejected(self):
+        response = self.client.get('/chat/api/conversations/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Invalid cursor', response.data['error'])
+
+
+class DirectConversationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='x').userprofile
+        cls.bob = User.objects.create_user('bob', password='x').userprofile
+
+    def test_one_conversation_per_pair_in_either_order(self):
+        conversation, created = Conversation.objects.get_or_create_direct(self.alice, self.bob)
+        self.assertTrue(created)
+        self.assertEqual(conversation.pair_key, f'{min(self.alice.id, self.bob.id)}:{max(self.alice.id, self.bob.id)}')
+        with self.assertNumQueries(1):
+            self.assertEqual(Conversation.objects.get_or_create_direct(self.bob, self.alice), (conversation, False))
+
+    def test_losing_a_creation_race_returns_the_winner(self):
+        winner, _ = Conversation.objects.get_or_create_direct(self.alice, self.bob)
+        # The probe ran before the winner committed, so this caller tries to create too
+        with patch.object(ConversationQuerySet, 'first', return_value=None):
+            conversation, created = Conversation.objects.get_or_create_direct(self.bob, self.alice)
+        self.assertEqual((conversation, created), (winner, False))
+        self.assertEqual(Conversation.objects.count(), 1)
+        self.assertEqual(
+            set(winner.memberships.values_list('profile_id', flat=True)), {self.alice.id, self.bob.id}
+        )
+
+
+class PairKeyMigrationTests(TransactionTestCase):
+    """0015 folds duplicate 1:1 conversations into the oldest one"""
+
+    def migrate(self, *targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(list(targets))
+        return MigrationExecutor(connection).loader.project_state(list(targets)).apps
+
+    def setUp(self):
+        self.addCleanup(lambda: self.migrate(*MigrationExecutor(connection).loader.graph.leaf_nodes()))
+        apps = self.migrate(('chat', '0014_conversation_activity_index'))
+        User = apps.get_model('auth', 'User')
+        UserProfile = apps.get_model('users', 'UserProfile')
+        Conversation = apps.get_model('chat', 'Conversation')
+        ConversationMembership = apps.get_model('chat', 'ConversationMembership')
+        Message = apps.get_model('chat', 'Message')
+
+        self.alice, self.bob = [
+            UserProfile.objects.create(user=User.objects.create(username=username)) for username in ('alice', 'bob')
+        ]
+        self.keep, self.duplicate = Conversation.objects.create(), Conversation.objects.create()
+        for conversation, unread in ((self.keep, 2), (self.duplicate, 3)):
+            conversation.participants.set([self.alice, self.bob])
+            ConversationMembership.objects.create(conversation=conversation, profile=self.alice, unread_count=unread)
+            ConversationMembership.objects.create(conversation=conversation, profile=self.bob)
+
+        start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        self.messages = {}
+        for name, conversation, minute in (('old', self.keep, 0), ('early', self.duplicate, 5),
+                                           ('mid', self.keep, 20), ('late', self.duplicate, 30)):
+            message = Message.objects.create(
+                conversation=conversation, sender=self.bob.user, recipient=self.alice, content=name
+            )
+            Message.objects.filter(id=message.id).update(timestamp=start + timedelta(minutes=minute))
+            self.messages[name] = message.id
+        # Alice cleared the kept copy after "old"; Bob cleared the duplicate after "early",
+        # while "old" in the kept copy is still visible to him
+        self.keep.deletion_timestamps = {str(self.alice.id): (start + timedelta(minutes=1)).isoformat()}
+        self.keep.save()
+        self.duplicate.deletion_timestamps = {str(self.bob.id): (start + timedelta(minutes=10)).isoformat()}
+        self.duplicate.save()
+        self.duplicate.deleted_by.add(self.bob)
+
+    def visible_to(self, apps, profile):
+        Conversation = apps.get_model('chat', 'Conversation')
+        conversation = Conversation.objects.get(id=self.keep.id)
+        messages = conversation.messages.all()
+        cutoff = conversation.deletion_timestamps.get(str(profile.id))
+        if cutoff:
+            messages = messages.filter(timestamp__gt=datetime.fromisoformat(cutoff))
+        return set(messages.values_list('content', flat=True))
+
+    def test_duplicates_are_merged_keeping_clears(self):
+        apps = self.migrate(('chat', '0015_conversation_pair_key'))
+        Conversation = apps.get_model('chat', 'Conversation')
+        ConversationMembership = apps.get_model('chat', 'ConversationMembership')
+
+        self.assertEqual(list(Conversation.objects.values_list('id', flat=True)), [self.keep.id])
+        keep = Conversation.objects.get(id=self.keep.id)
+        self.assertEqual(keep.pair_key, f'{self.alice.id}:{self.bob.id}')
+        self.assertEqual(keep.last_message_id, self.messages['late'])
+        self.assertEqual(
+            ConversationMembership.objects.get(conversation=keep, profile_id=self.alice.id).unread_count, 5
+        )
+        # Bob only deleted one copy, so the merged conversation stays listed for him
+        self.assertFalse(keep.deleted_by.exists())
+
+        # Alice's clear still hides what it hid
+        self.assertEqual(self.visible_to(apps, self.alice), {'early', 'mid', 'late'})
+        # Bob's clear cannot hide "old", which he could still see, so the cutoff stops
+        # short of it; nothing visible to him before the merge is hidden after it
+        self.assertEqual(self.visible_to(apps, self.bob), {'old', 'early', 'mid', 'late'})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE)
+class ConversationListCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='x')
+        cls.bob = User.objects.create_user('bob', password='x')
+        cls.carol = User.objects.create_user('carol', password='x')
+        cls.with_bob, _ = Conversation.objects.get_or_create_direct(cls.alice.userprofile, cls.bob.userprofile)
+        cls.with_carol, _ = Conversation.objects.get_or_create_direct(cls.alice.userprofile, cls.carol.userprofile)
+
+    def setUp(self):
+        cache.clear()
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.alice)}'
+
+    def conversation_ids(self, **params):
+        response = self.client.get('/chat/api/conversations/', params)
+        return [conversation['id'] for conversation in response.data['conversations']]
+
+    def test_first_page_is_cached_per_page_size(self):
+        hits = metrics.get(metrics.CONVERSATION_LIST_CACHE_HITS)
+        misses = metrics.get(metrics.CONVERSATION_LIST_CACHE_MISSES)
+        self.conversation_ids()
+        self.conversation_ids(page_size=1)
+        self.assertEqual(self.conversation_ids(), [self.with_carol.id, self.with_bob.id])
+        self.assertEqual(self.conversation_ids(page_size=1), [self.with_carol.id])
+        self.assertEqual(metrics.get(metrics.CONVERSATION_LIST_CACHE_MISSES) - misses, 2)
+        self.assertEqual(metrics.get(metrics.CONVERSATION_LIST_CACHE_HITS) - hits, 2)
+
+    def test_new_message_invalidates_every_page_size(self):
+        self.conversation_ids()
+        self.conversation_ids(page_size=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            create_message(self.with_bob, self.bob, self.alice.userprofile, 'hello')
+        self.assertEqual(self.conversation_ids(), [self.with_bob.id, self.with_carol.id])
+        self.assertEqual(self.conversation_ids(page_size=1), [self.with_bob.id])
+
+    def test_list_built_before_an_invalidation_is_never_served_after_it(self):
+        profile_id = self.alice.userprofile.id
+        # A request reads the generation and queries, then a write commits before it caches
+        generation = get_conversation_list_generation(profile_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_conversation_lists([profile_id])
+        cache_conversation_list(profile_id, generation, 8, {'conversations': [{'id': -1}]})
+        self.assertEqual(self.conversation_ids(), [self.with_carol.id, self.with_bob.id])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE)
+class ConversationMembershipStateTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', password='x')
+        cls.bob = User.objects.create_user('bob', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(cls.alice.userprofile, cls.bob.userprofile)
+        cls.old = create_message(cls.conversation, cls.bob, cls.alice.userprofile, 'before the delete')
+
+    def setUp(self):
+        cache.clear()
+
+    def as_user(self, user):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(user)}'
+
+    def listed(self):
+        return [conversation['id'] for conversation in self.client.get('/chat/api/conversations/').data['conversations']]
+
+    def history(self):
+        response = self.client.get(f'/chat/api/conversation/{self.conversation.id}/messages/')
+        return [message['content'] for message in response.data['messages']]
+
+    def test_deleting_hides_and_clears_for_one_participant_only(self):
+        self.as_user(self.alice)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(f'/chat/api/conversation/{self.conversation.id}/delete/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((self.listed(), self.history()), ([], []))
+
+        self.as_user(self.bob)
+        self.assertEqual((self.listed(), self.history()), ([self.conversation.id], ['before the delete']))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_message(self.conversation, self.bob, self.alice.userprofile, 'after the delete')
+        self.as_user(self.alice)
+        self.assertEqual((self.listed(), self.history()), ([self.conversation.id], ['after the delete']))
+
+    def test_send_restores_every_hidden_member_in_one_update(self):
+        self.conversation.hide_for(self.alice.userprofile)
+        self.conversation.hide_for(self.bob.userprofile)
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            if sql.startswith('UPDATE') and ConversationMembership._meta.db_table in sql:
+                statements.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            create_message(self.conversation, self.bob, self.alice.userprofile, 'hello again')
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(
+            dict(self.conversation.memberships.values_list('profile_id', 'hidden')),
+            {self.alice.userprofile.id: False, self.bob.userprofile.id: False},
+        )
+        self.assertEqual(self.conversation.memberships.get(profile=self.alice.userprofile).unread_count, 2)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE)
+class CreateMessageQueryCountTests(TestCase):
+    """Pin the cost of a send so regressions in the shared path show up here"""
+
+    @classmethod
+    def setUpTestData(cls):
+        # Profiles are created by users.signals; no email keeps Celery out of the picture
+        cls.sender = User.objects.create_user('sender', password='x')
+        cls.recipient = User.objects.create_user('recipient', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.recipient.userprofile
+        )
+        cls.conversation.hide_for(cls.recipient.userprofile)
+
+    def assert_sent(self, message):
+        membership = ConversationMembership.objects.get(
+            conversation=self.conversation, profile=self.recipient.userprofile
+        )
+        self.assertFalse(membership.hidden)
+        self.assertEqual(membership.unread_count, 1)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, message.id)
+
+    def test_create_message(self):
+        recipient = User.objects.select_related('userprofile').get(id=self.recipient.id).userprofile
+        # savepoint, insert, conversation summary, memberships, participant ids for cache
+        # invalidation, release; then on commit the conversation update (participants, their
+        # users, unread count) and the recipient's presence and email for the email check
+        with self.assertNumQueries(10), self.captureOnCommitCallbacks(execute=True):
+            message = create_message(self.conversation, self.sender, recipient, 'hello')
+        self.assert_sent(message)
+
+    def test_acreate_message(self):
+        recipient = User.objects.select_related('userprofile').get(id=self.recipient.id).userprofile
+        with self.assertNumQueries(10), self.captureOnCommitCallbacks(execute=True):
+            message = async_to_sync(acreate_message)(self.conversation, self.sender, recipient, 'hello')
+        self.assert_sent(message)
+
+    def test_send_message_in_conversation_view(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.sender)}'
+        url = f'/chat/api/conversation/{self.conversation.id}/send-message/'
+        # The 10 above plus auth user, sender profile, conversation and recipient lookups
+        with self.assertNumQueries(14), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'content': 'hello'}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assert_sent(Message.objects.get(id=response.data['id']))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE)
+class ChatConsumerMembershipTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user('sender', password='x')
+        cls.recipient = User.objects.create_user('recipient', password='x')
+        cls.outsider = User.objects.create_user('outsider', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.recipient.userprofile
+        )
+
+    def communicator(self, user):
+        communicator = WebsocketCommunicator(
+            URLRouter(routing.websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+        )
+        communicator.scope['user'] = user
+        return communicator
+
+    def test_outsider_is_rejected(self):
+        async def run():
+            communicator = self.communicator(self.outsider)
+            connected, code = await communicator.connect()
+            self.assertFalse(connected)
+            self.assertEqual(code, 4003)
+
+        async_to_sync(run)()
+
+    def test_broadcast_is_encoded_once_for_every_tab(self):
+        async def run():
+            sender = self.communicator(self.sender)
+            tabs = [self.communicator(self.recipient) for _ in range(3)]
+            for communicator in (sender, *tabs):
+                await communicator.connect()
+            # The recipient's first tab brings them online
+            self.assertEqual((await sender.receive_json_from())['action_type'], 'presence')
+            with patch.object(codec, 'dumps', wraps=codec.dumps) as dumps:
+                await sender.send_json_to({'content': 'hi'})
+                frames = [await communicator.receive_json_from() for communicator in (sender, *tabs)]
+                encodes = dumps.call_count
+            for communicator in (sender, *tabs):
+                await communicator.disconnect()
+            return frames, encodes
+
+        with self.captureOnCommitCallbacks(execute=False):
+            frames, encodes = async_to_sync(run)()
+        self.assertEqual(encodes, 1)
+        self.assertEqual({frame['content'] for frame in frames}, {'hi'})
+        self.assertEqual({frame['conversation_id'] for frame in frames}, {self.conversation.id})
+
+    def test_steady_state_send_inserts_once(self):
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            statements.append(sql.split()[0])
+            return execute(sql, params, many, context)
+
+        async def run():
+            communicator = self.communicator(self.sender)
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            del statements[:]
+            # The payload's sender_username is ignored in favour of the authenticated user
+            await communicator.send_to(text_data=json.dumps({'content': 'hi', 'sender_username': 'recipient'}))
+            event = json.loads(await communicator.receive_from())
+            send_statements = list(statements)
+            await communicator.disconnect()
+            return event, send_statements
+
+        # On-commit side effects (conversation update, email check) are not part of the send
+        with self.captureOnCommitCallbacks(execute=False), connection.execute_wrapper(record):
+            event, send_statements = async_to_sync(run)()
+        self.assertEqual(event['sender_username'], 'sender')
+        self.assertEqual(send_statements.count('INSERT'), 1)
+        self.assertNotIn('SELECT', send_statements)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE)
+class MultiplexConsumerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user('sender', password='x')
+        cls.recipient = User.objects.create_user('recipient', password='x')
+        cls.outsider = User.objects.create_user('outsider', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.recipient.userprofile
+        )
+        cls.other_conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.outsider.userprofile
+        )
+
+    def communicator(self, user):
+        communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), '/ws/multiplex/')
+        communicator.scope['user'] = user
+        return communicator
+
+    def test_frames_are_routed_by_conversation_id(self):
+        async def run():
+            sender = self.communicator(self.sender)
+            recipient = self.communicator(self.recipient)
+            self.assertTrue((await sender.connect())[0])
+            self.assertTrue((await recipient.connect())[0])
+            for communicator in (sender, recipient):
+                await communicator.send_json_to({'action_type': 'subscribe', 'conversation_id': self.conversation.id})
+                self.assertEqual(
+                    await communicator.receive_json_from(),
+                    {'type': 'subscribed', 'conversation_id': self.conversation.id},
+                )
+            await sender.send_json_to({'action_type': 'subscribe', 'conversation_id': self.other_conversation.id})
+            await sender.receive_json_from()
+            # The recipient is not a participant of the other conversation
+            await recipient.send_json_to({'action_type': 'subscribe', 'conversation_id': self.other_conversation.id})
+            refused = await recipient.receive_json_from()
+
+            await sender.send_json_to({'conversation_id': self.conversation.id, 'content': 'hi'})
+            received = await recipient.receive_json_from()
+            echoed = await sender.receive_json_from()
+
+            await sender.send_json_to({'action_type': 'unsubscribe', 'conversation_id': self.conversation.id})
+            await sender.receive_json_from()
+            await sender.send_json_to({'conversation_id': self.conversation.id, 'content': 'again'})
+            not_subscribed = await sender.receive_json_from()
+            await sender.disconnect()
+            await recipient.disconnect()
+            return refused, received, echoed, not_subscribed
+
+        with self.captureOnCommitCallbacks(execute=False):
+            refused, received, echoed, not_subscribed = async_to_sync(run)()
+        self.assertEqual(refused['conversation_id'], self.other_conversation.id)
+        self.assertIn('error', refused)
+        for frame in (received, echoed):
+            self.assertEqual(frame['conversation_id'], self.conversation.id)
+            self.assertEqual(frame['content'], 'hi')
+        self.assertEqual(not_subscribed['error'], 'Not subscribed to this conversation')
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE,
+    CHAT_TYPING_THROTTLE_SECONDS=60, CHAT_TYPING_TTL_SECONDS=0.2,
+)
+class TypingIndicatorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user('sender', password='x')
+        cls.recipient = User.objects.create_user('recipient', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.recipient.userprofile
+        )
+
+    def communicator(self, user):
+        communicator = WebsocketCommunicator(
+            URLRouter(routing.websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+        )
+        communicator.scope['user'] = user
+        return communicator
+
+    def test_keystrokes_are_coalesced_and_expire(self):
+        async def run():
+            sender = self.communicator(self.sender)
+            recipient = self.communicator(self.recipient)
+            await sender.connect()
+            await recipient.connect()
+            for _ in range(10):
+                await sender.send_json_to({'action_type': 'typing'})
+            frames = [await recipient.receive_json_from()]
+            # No stop_typing is sent: the TTL produces it
+            frames.append(await recipient.receive_json_from(timeout=2))
+            nothing_else = await recipient.receive_nothing(timeout=0.3)
+            await sender.disconnect()
+            await recipient.disconnect()
+            return frames, nothing_else
+
+        frames, nothing_else = async_to_sync(run)()
+        self.assertEqual([frame['is_typing'] for frame in frames], [True, False])
+        self.assertTrue(nothing_else)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE)
+class ReadWatermarkTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user('sender', password='x')
+        cls.recipient = User.objects.create_user('recipient', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.recipient.userprofile
+        )
+        cls.messages = [
+            create_message(cls.conversation, cls.sender, cls.recipient.userprofile, f'm{i}') for i in range(5)
+        ]
+
+    def membership(self):
+        return ConversationMembership.objects.get(conversation=self.conversation, profile=self.recipient.userprofile)
+
+    def communicator(self, user):
+        communicator = WebsocketCommunicator(
+            URLRouter(routing.websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+        )
+        communicator.scope['user'] = user
+        return communicator
+
+    def test_mark_read_writes_once_and_broadcasts_once(self):
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            statements.append(sql.split()[0])
+            return execute(sql, params, many, context)
+
+        async def run():
+            sender = self.communicator(self.sender)
+            recipient = self.communicator(self.recipient)
+            await sender.connect()
+            await recipient.connect()
+            self.assertEqual((await sender.receive_json_from())['action_type'], 'presence')
+            del statements[:]
+            await recipient.send_json_to({'action_type': 'mark_read', 'message_id': self.messages[3].id})
+            event = await sender.receive_json_from()
+            nothing_else = await sender.receive_nothing(timeout=0.2)
+            read_statements = list(statements)
+            await sender.disconnect()
+            await recipient.disconnect()
+            return event, nothing_else, read_statements
+
+        # The test transaction never commits, so run on-commit work straight away
+        with patch('django.db.transaction.on_commit', lambda callback, *args, **kwargs: callback()), \
+                patch('chat.services.sync_read_state') as sync_task, connection.execute_wrapper(record):
+            event, nothing_else, read_statements = async_to_sync(run)()
+        self.assertEqual(event, {
+            'action_type': 'read_up_to', 'message_id': self.messages[3].id, 'reader_username': 'recipient',
+            'conversation_id': self.conversation.id,
+        })
+        self.assertTrue(nothing_else)
+        self.assertEqual(read_statements.count('UPDATE'), 1)
+        sync_task.delay.assert_called_once_with(
+            self.conversation.id, self.recipient.userprofile.id, self.messages[3].id
+        )
+        membership = self.membership()
+        self.assertEqual(membership.read_up_to, self.messages[3].id)
+        self.assertEqual(membership.unread_count, 1)
+
+    def test_rest_endpoint_and_history_use_the_watermark(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.recipient)}'
+        url = f'/chat/api/conversation/{self.conversation.id}/read/'
+        response = self.client.post(url, {'message_id': self.messages[1].id}, content_type='application/json')
+        self.assertEqual(response.data['read_up_to'], self.messages[1].id)
+        # Watermarks never move back
+        response = self.client.post(url, {'message_id': self.messages[0].id}, content_type='application/json')
+        self.assertEqual(response.data, {
+            'conversation_id': self.conversation.id, 'read_up_to': self.messages[1].id, 'updated': False,
+        })
+
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.sender)}'
+        response = self.client.get(f'/chat/api/conversation/{self.conversation.id}/messages/')
+        self.assertEqual([m['is_read'] for m in response.data['messages']], [True, True, False, False, False])
+        # The sender opening the conversation leaves the recipient's watermark alone
+        self.assertEqual(self.membership().read_up_to, self.messages[1].id)
+
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.recipient)}'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(f'/chat/api/conversation/{self.conversation.id}/messages/')
+        membership = self.membership()
+        self.assertEqual((membership.read_up_to, membership.unread_count), (self.messages[-1].id, 0))
+
+    def test_read_state_sync_settles_is_read(self):
+        sync_read_state(self.conversation.id, self.recipient.userprofile.id, self.messages[2].id)
+        self.assertEqual(
+            list(Message.objects.filter(conversation=self.conversation).order_by('id').values_list('is_read', flat=True)),
+            [True, True, True, False, False],
+        )
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE,
+    CHAT_DELIVERY_ACK_FLUSH_SECONDS=0.05,
+)
+class DeliveryAckTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user('sender', password='x')
+        cls.recipient = User.objects.create_user('recipient', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.recipient.userprofile
+        )
+        cls.messages = [
+            create_message(cls.conversation, cls.sender, cls.recipient.userprofile, f'm{i}') for i in range(3)
+        ]
+
+    def communicator(self, user):
+        communicator = WebsocketCommunicator(
+            URLRouter(routing.websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+        )
+        communicator.scope['user'] = user
+        return communicator
+
+    def test_acks_are_batched_into_one_watermark(self):
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            statements.append(sql.split()[0])
+            return execute(sql, params, many, context)
+
+        async def run():
+            sender = self.communicator(self.sender)
+            recipient = self.communicator(self.recipient)
+            await sender.connect()
+            await recipient.connect()
+            self.assertEqual((await sender.receive_json_from())['action_type'], 'presence')
+            del statements[:]
+            for message in self.messages:
+                await recipient.send_json_to({'action_type': 'ack', 'message_id': message.id})
+            event = await sender.receive_json_from()
+            nothing_else = await sender.receive_nothing(timeout=0.2)
+            ack_statements = list(statements)
+            await sender.disconnect()
+            await recipient.disconnect()
+            return event, nothing_else, ack_statements
+
+        with patch('django.db.transaction.on_commit', lambda callback, *args, **kwargs: callback()), \
+                connection.execute_wrapper(record):
+            event, nothing_else, ack_statements = async_to_sync(run)()
+        self.assertEqual(event, {
+            'action_type': 'delivered_up_to', 'message_id': self.messages[-1].id, 'recipient_username': 'recipient',
+            'conversation_id': self.conversation.id,
+        })
+        self.assertTrue(nothing_else)
+        self.assertEqual(ack_statements.count('UPDATE'), 1)
+
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.sender)}'
+        response = self.client.get(f'/chat/api/conversation/{self.conversation.id}/messages/')
+        self.assertEqual(
+            [(m['is_delivered'], m['is_read']) for m in response.data['messages']], [(True, False)] * 3
+        )
+
+    def test_ack_refreshes_the_senders_cached_list(self):
+        self.client.defaults['HTTP_AUTHORIZATION'] = f'Bearer {AccessToken.for_user(self.sender)}'
+
+        def last_message_delivered():
+            response = self.client.get('/chat/api/conversations/')
+            return response.data['conversations'][0]['last_message']['is_delivered']
+
+        self.assertFalse(last_message_delivered())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.conversation.mark_delivered_up_to(self.recipient.userprofile, self.messages[-1].id)
+        self.assertTrue(last_message_delivered())
+
+
+class OutboundQueueTests(TestCase):
+    def drain(self, queue):
+        written = []
+
+        async def write(text_data, bytes_data):
+            written.append(text_data)
+
+        async def run():
+            queue.write = write
+            queue.start()
+            while queue.depth:
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            queue.stop()
+
+        async_to_sync(run)()
+        return written
+
+    def test_durable_frames_go_first_and_superseded_frames_are_replaced(self):
+        queue = OutboundQueue(None, 'test')
+        queue.put(('typing on', None), ephemeral=True, coalesce_key='typing:1:a')
+        queue.put(('read 5', None), coalesce_key='read_up_to:1:a')
+        queue.put(('message 6', None))
+        queue.put(('typing off', None), ephemeral=True, coalesce_key='typing:1:a')
+        queue.put(('read 6', None), coalesce_key='read_up_to:1:a')
+        self.assertEqual(queue.coalesced, 2)
+        self.assertEqual(self.drain(queue), ['message 6', 'read 6', 'typing off'])
+
+    @override_settings(CHAT_OUTBOUND_QUEUE_LIMIT=2)
+    def test_overflow_drops_ephemeral_frames_then_gives_up(self):
+        queue = OutboundQueue(None, 'test')
+        self.assertTrue(queue.put(('typing', None), ephemeral=True))
+        self.assertTrue(queue.put(('message 1', None)))
+        # Full: the typing frame makes room, then a new one is dropped on arrival
+        self.assertTrue(queue.put(('message 2', None)))
+        self.assertTrue(queue.put(('typing', None), ephemeral=True))
+        self.assertEqual(queue.dropped, 2)
+        # Only durable frames left
+        self.assertFalse(queue.put(('message 3', None)))
+        self.assertEqual(self.drain(queue), ['message 1', 'message 2'])
+
+    @override_settings(
+        CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE,
+        CHAT_OUTBOUND_STALL_SECONDS=0,
+    )
+    def test_stalled_socket_is_disconnected(self):
+        sender = User.objects.create_user('sender', password='x')
+        recipient = User.objects.create_user('recipient', password='x')
+        conversation, _ = Conversation.objects.get_or_create_direct(sender.userprofile, recipient.userprofile)
+
+        async def stalled_write(consumer, text_data, bytes_data):
+            await asyncio.Event().wait()
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns), f'/ws/chat/{conversation.id}/'
+            )
+            communicator.scope['user'] = recipient
+            await communicator.connect()
+            event = frame_event('read_up_to', {'action_type': 'read_up_to'}, conversation_id=conversation.id)
+            await get_channel_layer().group_send(f'chat_{conversation.id}', event)
+            await asyncio.sleep(0.05)
+            await get_channel_layer().group_send(f'chat_{conversation.id}', event)
+            closed = await communicator.receive_output()
+            await communicator.disconnect()
+            return closed
+
+        with patch.object(ChatConsumer, 'write_frame', stalled_write):
+            closed = async_to_sync(run)()
+        self.assertEqual(closed, {'type': 'websocket.close', 'code': SLOW_CONSUMER_CLOSE_CODE})
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE,
+    CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_JOURNAL_URL='', CHAT_WRITE_BEHIND_FLUSH_SECONDS=0.2,
+)
+class WriteBehindTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create_user('sender', password='x')
+        cls.recipient = User.objects.create_user('recipient', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(
+            cls.sender.userprofile, cls.recipient.userprofile
+        )
+        # Ids are reserved past existing rows
+        cls.earlier = create_message(cls.conversation, cls.sender, cls.recipient.userprofile, 'earlier')
+
+    def communicator(self, user):
+        communicator = WebsocketCommunicator(
+            URLRouter(routing.websocket_urlpatterns), f'/ws/chat/{self.conversation.id}/'
+        )
+        communicator.scope['user'] = user
+        return communicator
+
+    def test_messages_are_broadcast_first_and_inserted_in_one_batch(self):
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+
+        async def run():
+            sender = self.communicator(self.sender)
+            recipient = self.communicator(self.recipient)
+            await sender.connect()
+            await recipient.connect()
+            for i in range(5):
+                await sender.send_json_to({'content': f'm{i}'})
+            frames = [await recipient.receive_json_from() for _ in range(5)]
+            stored_before_flush = await database_sync_to_async(Message.objects.filter(id__in=[f['id'] for f in frames]).count)()
+            await write_behind.get_writer().drain()
+            await sender.disconnect()
+            await recipient.disconnect()
+            return frames, stored_before_flush
+
+        with connection.execute_wrapper(record):
+            frames, stored_before_flush = async_to_sync(run)()
+
+        ids = [frame['id'] for frame in frames]
+        self.assertEqual([frame['content'] for frame in frames], [f'm{i}' for i in range(5)])
+        self.assertEqual(ids, sorted(ids))
+        self.assertGreater(ids[0], self.earlier.id)
+        self.assertEqual(stored_before_flush, 0)
+        self.assertEqual(
+            list(self.conversation.messages.filter(id__in=ids).order_by('id').values_list('content', flat=True)),
+            [f'm{i}' for i in range(5)],
+        )
+        self.assertEqual(sum(sql.startswith('INSERT INTO "chat_message"') for sql in statements), 1)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, ids[-1])
+        self.assertEqual(
+            ConversationMembership.objects.get(conversation=self.conversation, profile=self.recipient.userprofile).unread_count,
+            6,
+        )
+
+    def test_replaying_a_journal_record_is_idempotent(self):
+        message = Message(
+            id=write_behind.reserve_message_id(), conversation=self.conversation, sender=self.sender,
+            recipient=self.recipient.userprofile, content='journaled',
+        )
+        encoded = codec.dumps(write_behind.message_record(message, [self.sender.userprofile.id]))
+        for _ in range(2):
+            replayed, participant_ids = write_behind.message_from_record(codec.loads(encoded))
+            write_behind.persist_batch([replayed], {self.conversation.id: participant_ids})
+
+        stored = Message.objects.get(id=message.id)
+        self.assertEqual((stored.content, stored.timestamp), ('journaled', message.timestamp))
+        self.assertEqual(
+            ConversationMembership.objects.get(conversation=self.conversation, profile=self.recipient.userprofile).unread_count,
+            2,
+        )
+
+    def test_messages_read_before_their_batch_lands_stay_read(self):
+        messages = [
+            Message(
+                id=write_behind.reserve_message_id(), conversation=self.conversation, sender=self.sender,
+                recipient=self.recipient.userprofile, content=content,
+            )
+            for content in ('seen', 'unseen')
+        ]
+        # The recipient read the first from the broadcast before the writer flushed
+        membership = ConversationMembership.objects.filter(conversation=self.conversation, profile=self.recipient.userprofile)
+        membership.update(read_up_to=messages[0].id, unread_count=0)
+        write_behind.persist_batch(messages, {self.conversation.id: [self.sender.userprofile.id]})
+        self.assertEqual(membership.get().unread_count, 1)
+
+    @override_settings(CHAT_WRITE_BEHIND=False)
+    def test_journal_is_not_replayed_with_write_behind_off(self):
+        with patch('chat.write_behind.replay_journal') as replay_journal:
+            self.assertEqual(replay_message_journal(), 'Write-behind is off')
+        replay_journal.assert_not_called()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CACHES=LOCMEM_CACHES, CHAT_PRESENCE_BACKEND=IN_MEMORY_PRESENCE)
+class PresenceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('user', password='x', email='user@example.com')
+        cls.other = User.objects.create_user('other', password='x')
+        cls.conversation, _ = Conversation.objects.get_or_create_direct(cls.user.userprofile, cls.other.userprofile)
+
+    def setUp(self):
+        self.presence = presence.get_presence()
+        self.presence.connections.clear()
+        self.presence.seen.clear()
+
+    def communicator(self, path, user=None):
+        communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), path)
+        communicator.scope['user'] = user or self.user
+        return communicator
+
+    def test_user_stays_online_until_their_last_socket_closes(self):
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+
+        async def run():
+            chat = self.communicator(f'/ws/chat/{self.conversation.id}/')
+            conversation_list = self.communicator('/ws/conversations/')
+            await chat.connect()
+            await conversation_list.connect()
+            del statements[:]
+            for _ in range(3):
+                await conversation_list.send_json_to({'type': 'ping'})
+                await conversation_list.receive_json_from()
+            heartbeat_statements = list(statements)
+            await chat.disconnect()
+            online_with_one_tab = presence.is_online(self.user.id)
+            await conversation_list.disconnect()
+            return heartbeat_statements, online_with_one_tab
+
+        with connection.execute_wrapper(record):
+            heartbeat_statements, online_with_one_tab = async_to_sync(run)()
+        self.assertEqual(heartbeat_statements, [])
+        self.assertTrue(online_with_one_tab)
+        self.assertFalse(presence.is_online(self.user.id))
+
+    @override_settings(CHAT_PRESENCE_TTL_SECONDS=0.05)
+    def test_connections_that_stop_refreshing_expire(self):
+        self.assertTrue(self.presence.touch(self.user.id, 'worker-that-dies'))
+        self.assertEqual(presence.online_user_ids([self.user.id, self.other.id]), {self.user.id})
+        time.sleep(0.1)
+        self.assertEqual(presence.online_user_ids([self.user.id]), set())
+
+    def test_sweep_takes_vanished_users_offline_and_tells_their_conversations(self):
+        async def run():
+            other = self.communicator(f'/ws/chat/{self.conversation.id}/', self.other)
+            await other.connect()
+            # A connection whose process died: it is never refreshed or disconnected
+            with override_settings(CHAT_PRESENCE_TTL_SECONDS=-1):
+                self.presence.touch(self.user.id, 'worker-that-died')
+            expired = await database_sync_to_async(presence.expire_presence)()
+            frame = await other.receive_json_from()
+            expired_again = await database_sync_to_async(presence.expire_presence)()
+            await other.disconnect()
+            return expired, frame, expired_again
+
+        expired, frame, expired_again = async_to_sync(run)()
+        self.assertEqual((expired, expired_again), (1, 0))
+        self.assertEqual(frame, {
+            'action_type': 'presence', 'username': 'user', 'is_online': False, 'conversation_id': self.conversation.id,
+        })
+        presence.flush_last_seen()
+        self.user.userprofile.refresh_from_db()
+        self.assertFalse(self.user.userprofile.is_online)
+        self.assertIsNotNone(self.user.userprofile.last_seen)
+
+    def test_last_seen_is_flushed_in_one_batch(self):
+        self.presence.touch(self.user.id, 'a')
+        self.presence.touch(self.other.id, 'b')
+        self.presence.disconnect(self.other.id, 'b')
+        with self.assertNumQueries(2):
+            self.assertEqual(presence.flush_last_seen(), 2)
+        self.user.userprofile.refresh_from_db()
+        self.other.userprofile.refresh_from_db()
+        self.assertEqual((self.user.userprofile.is_online, self.other.userprofile.is_online), (True, False))
+        self.assertIsNotNone(self.other.userprofile.last_seen)
+        self.assertEqual(presence.flush_last_seen(), 0)
+
+    def test_last_seen_survives_a_failed_flush(self):
+        self.presence.touch(self.user.id, 'a')
+        with patch.object(UserProfile.objects, 'bulk_update', side_effect=DatabaseError('down')):
+            with self.assertRaises(DatabaseError):
+                presence.flush_last_seen()
+        self.assertEqual(presence.flush_last_seen(), 1)
+        self.assertIsNotNone(UserProfile.objects.get(user=self.user).last_seen)
+
+    def test_times_noted_during_a_flush_are_kept_for_the_next(self):
+        self.presence.note_seen(self.user.id)
+        seen = self.presence.read_seen()
+        self.presence.seen[self.user.id] += 1  # Noted again while the first time was being written
+        self.presence.forget_seen(seen)
+        self.assertEqual(list(self.presence.read_seen()), [self.user.id])
+
+    def test_clear_takes_a_user_offline(self):
+        self.presence.touch(self.user.id, 'a')
+        self.presence.touch(self.user.id, 'b')
+        self.presence.clear(self.user.id)
+        self.assertFalse(presence.is_online(self.user.id))
+
+    def test_login_is_seen_but_only_sockets_bring_a_user_online(self):
+        response = self.client.post(
+            '/auth/api/manual-login/', {'email': 'user@example.com', 'password': 'x'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(presence.is_online(self.user.id))
+        presence.flush_last_seen()
+        self.user.userprofile.refresh_from_db()
+        self.assertFalse(self.user.userprofile.is_online)
+        self.assertIsNotNone(self.user.userprofile.last_seen)
+
+    def test_emails_are_only_scheduled_for_offline_recipients(self):
+        message = create_message(self.conversation, self.other, self.user.userprofile, 'hi')
+        with patch('chat.tasks.create_and_schedule_email_notification.delay') as delay:
+            self.presence.touch(self.user.id, 'a')
+            schedule_emails_for_new_messages([message])
+            self.presence.disconnect(self.user.id, 'a')
+            schedule_emails_for_new_messages([message])
+        delay.assert_called_once_with(message.id)
+
+
+class CodecTests(TestCase):
+    payload = {
+        'id': 7,
+        'content': 'café 👍 "quoted"',
+        'timestamp': datetime(2026, 10, 17, 8, 0, 0, 123456, tzinfo=dt_timezone.utc),
+        'amount': Decimal('1.50'),
+        'upload_id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+        'label': gettext_lazy('Audio message'),
+        'peaks': [0.0, 0.5, 1.0],
+        'nested': {'ok': True, 'none': None},
+        'big': 2 ** 70,
+        'separators': 'line\u2028paragraph\u2029',
+    }
+
+    def reload_codec(self, orjson_module):
+        with patch.dict(sys.modules, {'orjson': orjson_module}):
+            return importlib.reload(codec)
+
+    def tearDown(self):
+        importlib.reload(codec)
+
+    def test_backends_match_drf(self):
+        expected = json.loads(JSONRenderer().render(self.payload))
+        outputs = []
+        for orjson_module in (sys.modules.get('orjson'), None):
+            backend = self.reload_codec(orjson_module)
+            encoded = backend.dumps_bytes(self.payload)
+            self.assertEqual(json.loads(encoded), expected)
+            self.assertEqual(backend.loads(encoded), expected)
+            self.assertEqual(backend.dumps(self.payload), encoded.decode())
+            outputs.append(encoded)
+        # Both backends produce the same bytes
+        self.assertEqual(len(set(outputs)), 1)
+
+    def test_renderer_matches_drf(self):
+        expected = JSONRenderer().render(self.payload)
+        self.assertIn(b'\\u2028', expected)
+        for orjson_module in (sys.modules.get('orjson'), None):
+            self.reload_codec(orjson_module)
+            self.assertEqual(CodecJSONRenderer().render(self.payload), expected)
+
+    def test_nan_is_refused_like_drf_without_orjson(self):
+        with self.assertRaises(ValueError):
+            JSONRenderer().render({'value': float('nan')})
+        backend = self.reload_codec(None)
+        with self.assertRaises(ValueError):
+            backend.dumps({'value': float('nan')})
+        if sys.modules.get('orjson'):
+            # The documented difference: orjson writes null
+            self.assertEqual(self.reload_codec(sys.modules['orjson']).dumps({'value': float('nan')}), '{"value":null}')
+
+    def test_extend_adds_fields_to_an_encoded_object(self):
+        encoded = codec.dumps({'id': 1, 'content': 'é'})
+        self.assertEqual(
+            json.loads(codec.extend(encoded, {'audio_url': 'https://x/a?s=1'})),
+            {'id': 1, 'content': 'é', 'audio_url': 'https://x/a?s=1'},
+        )
+
+    def test_decode_errors_share_one_type(self):
+        for orjson_module in (sys.modules.get('orjson'), None):
+            backend = self.reload_codec(orjson_module)
+            with self.assertRaises(backend.DecodeError):
+                backend.loads('{"unterminated": ')
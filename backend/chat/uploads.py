@@ -0,0 +1,103 @@
+"""
+Temporary chunk storage for resumable voice-note uploads.
+
+Each upload gets a directory under ``settings.CHAT_UPLOAD_TEMP_ROOT``; chunk N
+is streamed to a ``.part`` file and renamed to ``<upload id>/N`` once complete
+and accepted, so the directory listing is the source of truth for what arrived.
+"""
+import math
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+class ChunkTooLarge(Exception):
+    pass
+
+
+def upload_dir(upload_id):
+    return os.path.join(settings.CHAT_UPLOAD_TEMP_ROOT, str(upload_id))
+
+
+def max_chunk_count():
+    """Most chunks an upload can need: a full-size clip split into maximum-size chunks"""
+    return math.ceil(settings.CHAT_AUDIO_MAX_BYTES / settings.CHAT_UPLOAD_MAX_CHUNK_BYTES)
+
+
+def receive_chunk(upload_id, stream, max_bytes):
+    """
+    Copy a request body stream into a new ``.part`` file of the upload, block
+    by block, without buffering it whole. Returns the part's path and size for
+    store_chunk. Raises ChunkTooLarge once more than ``max_bytes`` arrive.
+    """
+    directory = upload_dir(upload_id)
+    os.makedirs(directory, exist_ok=True)
+    fd, part_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    written = 0
+    try:
+        with os.fdopen(fd, 'wb') as part:
+            while True:
+                block = stream.read(STREAM_BLOCK_SIZE)
+                if not block:
+                    break
+                written += len(block)
+                if written > max_bytes:
+                    raise ChunkTooLarge(f'Chunk exceeds {max_bytes} bytes')
+                part.write(block)
+    except BaseException:
+        discard_part(part_path)
+        raise
+    return part_path, written
+
+
+def store_chunk(upload_id, index, part_path):
+    """Make a received part chunk ``index``; re-sending a chunk simply replaces it"""
+    os.replace(part_path, os.path.join(upload_dir(upload_id), str(index)))
+
+
+def discard_part(part_path):
+    """Remove a part that was not stored (a no-op once store_chunk renamed it)"""
+    try:
+        os.remove(part_path)
+    except FileNotFoundError:
+        pass
+
+
+def received_chunks(upload_id):
+    """Map of chunk index -> size for every fully written chunk"""
+    directory = upload_dir(upload_id)
+    if not os.path.isdir(directory):
+        return {}
+    chunks = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.isdigit():
+                chunks[int(entry.name)] = entry.stat().st_size
+    return chunks
+
+
+def assemble_chunks(upload_id, chunk_count):
+    """
+    Concatenate chunks 0..chunk_count-1 into a spooled temporary file.
+    Raises ValueError listing any missing chunks.
+    """
+    chunks = received_chunks(upload_id)
+    missing = [index for index in range(chunk_count) if index not in chunks]
+    if missing:
+        raise ValueError(f'Missing chunks: {missing}')
+
+    assembled = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    directory = upload_dir(upload_id)
+    for index in range(chunk_count):
+        with open(os.path.join(directory, str(index)), 'rb') as chunk:
+            shutil.copyfileobj(chunk, assembled, STREAM_BLOCK_SIZE)
+    assembled.seek(0)
+    return assembled
+
+
+def discard_chunks(upload_id):
+    shutil.rmtree(upload_dir(upload_id), ignore_errors=True)
@@ -7,7 +7,14 @@ from .views import (
     CreateConversationView,
     EditMessageView,
     DeleteMessageView,
-    DeleteConversationView
+    DeleteConversationView,
+    MarkConversationReadView,
+    MessageAudioView,
+    ChatMetricsView,
+    CreateAudioUploadView,
+    AudioUploadDetailView,
+    AudioUploadChunkView,
+    CommitAudioUploadView
 )
 
 urlpatterns = [
@@ -18,5 +25,12 @@ urlpatterns = [
     path('create-conversation/', CreateConversationView.as_view(), name='create_conversation'),
     path('message/<int:message_id>/edit/', EditMessageView.as_view(), name='edit_message'),
     path('message/<int:message_id>/delete/', DeleteMessageView.as_view(), name='delete_message'),
-    path('conversation/<int:conversation_id>/delete/', DeleteConversationView.as_view(), name='delete_conversation')
+    path('conversation/<int:conversation_id>/delete/', DeleteConversationView.as_view(), name='delete_conversation'),
+    path('conversation/<int:conversation_id>/read/', MarkConversationReadView.as_view(), name='mark_conversation_read'),
+    path('message/<int:message_id>/audio/', MessageAudioView.as_view(), name='message_audio'),
+    path('metrics/', ChatMetricsView.as_view(), name='chat_metrics'),
+    path('uploads/', CreateAudioUploadView.as_view(), name='create_audio_upload'),
+    path('uploads/<uuid:upload_id>/', AudioUploadDetailView.as_view(), name='audio_upload_detail'),
+    path('uploads/<uuid:upload_id>/chunks/<int:index>/', AudioUploadChunkView.as_view(), name='audio_upload_chunk'),
+    path('uploads/<uuid:upload_id>/commit/', CommitAudioUploadView.as_view(), name='commit_audio_upload'),
 ]
@@ -1,7 +1,78 @@
+import asyncio
+import logging
+from channels.exceptions import ChannelFull
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db.models import prefetch_related_objects
+from .models import ConversationMembership
 from .serializers import ConversationSerializer
 from django.contrib.auth.models import User
+from . import codec, metrics
+
+logger = logging.getLogger(__name__)
+
+
+def event_within_size_limit(group, event):
+    """
+    Check a channel-layer event against CHANNEL_LAYER_MAX_EVENT_BYTES.
+    Oversized events are counted and logged; callers must not send them.
+    """
+    # A pre-encoded frame is measured as it is rather than encoded again
+    fields = {key: value for key, value in event.items() if key != 'frame'}
+    size = len(codec.dumps_bytes(fields)) + len(event.get('frame', '').encode())
+    if size > settings.CHANNEL_LAYER_MAX_EVENT_BYTES:
+        metrics.increment(metrics.OVERSIZED_EVENTS_REJECTED)
+        logger.warning(
+            f"Rejected {event.get('type')} event for {group}: {size} bytes exceeds "
+            f"the {settings.CHANNEL_LAYER_MAX_EVENT_BYTES} byte limit"
+        )
+        return False
+    return True
+
+
+def frame_event(event_type, payload, ephemeral=False, coalesce_key=None, **fields):
+    """
+    A channel-layer event carrying ``payload`` already encoded as the client
+    frame. It is encoded once here, and every receiving socket writes it as is
+    (see ChatProtocolMixin and ConversationListEventsMixin). ``fields`` stay
+    decoded for the receivers' own routing and checks.
+
+    ``ephemeral`` and ``coalesce_key`` tell each socket's outbound queue how to
+    schedule the frame (see chat.outbound): ephemeral frames yield to all
+    others and may be dropped, and a pending frame is replaced by a newer one
+    with the same key.
+    """
+    event = {'type': event_type, 'frame': codec.dumps(payload), **fields}
+    if ephemeral:
+        event['ephemeral'] = True
+    if coalesce_key is not None:
+        event['coalesce_key'] = coalesce_key
+    return event
+
+
+async def group_send(channel_layer, group, event):
+    """channel_layer.group_send with the payload ceiling applied. Returns whether it was sent."""
+    if not event_within_size_limit(group, event):
+        return False
+    await channel_layer.group_send(group, event)
+    return True
+
+
+async def group_send_ephemeral(channel_layer, group, event):
+    """
+    group_send for events that are worthless once late, such as typing
+    indicators. If the layer is full or does not accept the event within
+    CHANNEL_LAYER_EPHEMERAL_SEND_TIMEOUT it is dropped and counted, not queued.
+    """
+    try:
+        return await asyncio.wait_for(
+            group_send(channel_layer, group, event),
+            settings.CHANNEL_LAYER_EPHEMERAL_SEND_TIMEOUT,
+        )
+    except (ChannelFull, asyncio.TimeoutError):
+        metrics.increment(metrics.EPHEMERAL_EVENTS_DROPPED)
+        return False
 
 
 def send_conversation_update(conversation, is_new=False, request=None):
@@ -13,25 +84,104 @@ def send_conversation_update(conversation, is_new=False, request=None):
     # Create a mock request object if not provided
     if not request:
         class MockRequest:
+            user = None
+
             def build_absolute_uri(self, path):
                 from django.conf import settings
                 return f"{settings.BASE_API_URL}{path}"
         request = MockRequest()
     
-    # Serialize the conversation
+    # Load participants (and their users) once for both the serializer and the fan-out
+    prefetch_related_objects([conversation], 'participants__user')
+
+    # Serialize and encode the conversation once for every participant. unread_count
+    # and the last message's audio_url depend on the viewer, so they travel beside
+    # the frame and each socket fills in its own (see ConversationListEventsMixin).
+    # Counts are keyed by str(user id), as channel layers serialize events with msgpack.
+    unread_counts = {
+        str(user_id): unread_count
+        for user_id, unread_count in conversation.memberships.values_list('profile__user_id', 'unread_count')
+    }
+    conversation.viewer_memberships = []  # The shared frame is for no one in particular
     serializer = ConversationSerializer(conversation, context={'request': request})
-    conversation_data = serializer.data
+    last_message = conversation.last_message if conversation.last_message_id else None
+    audio_fields = {'audio_message_id': last_message.id} if last_message and last_message.has_audio else {}
+    event = frame_event('conversation_update', {
+        'type': 'conversation_update',
+        'conversation': serializer.data,
+        'is_new': is_new
+    }, coalesce_key=f'conversation_update:{conversation.id}:{is_new}', unread_counts=unread_counts, **audio_fields)
     
     # Send update to all participants
     for participant in conversation.participants.all():
-        user_group_name = f'user_conversations_{participant.user.id}'
-        async_to_sync(channel_layer.group_send)(
-            user_group_name,
-            {
-                'type': 'conversation_update',
-                'conversation': conversation_data,
-                'is_new': is_new
-            }
+        user_group_name = f'user_conversations_{participant.user_id}'
+        async_to_sync(group_send)(channel_layer, user_group_name, event)
+
+
+def send_membership_changed(conversation_ids):
+    """
+    Tell open chat sockets of these conversations to reload the participants and
+    profiles they cached in connect()
+    """
+    channel_layer = get_channel_layer()
+    for conversation_id in conversation_ids:
+        async_to_sync(group_send)(
+            channel_layer,
+            f'chat_{conversation_id}',
+            {'type': 'membership_changed', 'conversation_id': conversation_id}
+        )
+
+
+def send_read_up_to(conversation_id, reader_username, read_up_to):
+    """Tell a conversation's sockets that ``reader_username`` has read everything up to ``read_up_to``"""
+    channel_layer = get_channel_layer()
+    async_to_sync(group_send)(
+        channel_layer,
+        f'chat_{conversation_id}',
+        frame_event('read_up_to', {
+            'action_type': 'read_up_to',
+            'message_id': read_up_to,
+            'reader_username': reader_username,
+            'conversation_id': conversation_id,
+        }, coalesce_key=f'read_up_to:{conversation_id}:{reader_username}', conversation_id=conversation_id)
+    )
+
+
+def send_delivered_up_to(conversation_id, recipient_username, delivered_up_to):
+    """Tell a conversation's sockets that ``recipient_username``'s client has everything up to ``delivered_up_to``"""
+    channel_layer = get_channel_layer()
+    async_to_sync(group_send)(
+        channel_layer,
+        f'chat_{conversation_id}',
+        frame_event('delivered_up_to', {
+            'action_type': 'delivered_up_to',
+            'message_id': delivered_up_to,
+            'recipient_username': recipient_username,
+            'conversation_id': conversation_id,
+        }, coalesce_key=f'delivered_up_to:{conversation_id}:{recipient_username}', conversation_id=conversation_id)
+    )
+
+
+def send_presence_changed(user_ids, is_online):
+    """
+    Tell the conversations of these users that they came online or went
+    offline (see chat.presence). Their conversations are found with one query.
+    """
+    channel_layer = get_channel_layer()
+    memberships = ConversationMembership.objects.filter(profile__user_id__in=user_ids).values_list(
+        'profile__user_id', 'profile__user__username', 'conversation_id'
+    )
+    for user_id, username, conversation_id in memberships:
+        async_to_sync(group_send)(
+            channel_layer,
+            f'chat_{conversation_id}',
+            frame_event('presence_changed', {
+                'action_type': 'presence',
+                'username': username,
+                'is_online': is_online,
+                'conversation_id': conversation_id,
+            }, ephemeral=True, coalesce_key=f'presence:{conversation_id}:{username}',
+                conversation_id=conversation_id, user_id=user_id)
         )
 
 
@@ -42,10 +192,11 @@ def send_conversation_delete(conversation_id, user_id):
     channel_layer = get_channel_layer()
     user_group_name = f'user_conversations_{user_id}'
     
-    async_to_sync(channel_layer.group_send)(
+    async_to_sync(group_send)(
+        channel_layer,
         user_group_name,
-        {
+        frame_event('conversation_delete', {
             'type': 'conversation_delete',
             'conversation_id': conversation_id
-        }
+        })
     )
@@ -1,18 +1,31 @@
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from django.contrib.auth.models import User
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from users.models import UserProfile
-from .models import Conversation, Message
+from .models import Conversation, ConversationMembership, Message, AudioUpload
 from .serializers import MessageSerializer, ConversationSerializer
+from .storage import store_audio, store_audio_file, open_audio
+from . import uploads
+from .pagination import encode_cursor, keyset_filter, parse_page_size
+from .conversation_cache import (
+    cache_conversation_list, get_cached_conversation_list, get_conversation_list_generation
+)
+from django.db import transaction
+from django.conf import settings
+from .authentication import AudioURLSignatureAuthentication
+from . import metrics, outbound, write_behind
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from django.http import HttpResponse, StreamingHttpResponse
+import re
 from django.shortcuts import get_object_or_404
-from .utils import send_conversation_update, send_conversation_delete
+from .utils import send_conversation_delete
+from .services import create_message, get_recipient, mark_read
 from .tasks import create_and_schedule_email_notification
 import json
-from django.utils import timezone
 class SendMessageView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -33,23 +46,14 @@ class SendMessageView(APIView):
             return Response({"error": "Recipient phone is required."}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            recipient_profile = UserProfile.objects.get(phone_number=recipient_phone)
+            recipient_profile = UserProfile.objects.select_related('user').get(phone_number=recipient_phone)
         except UserProfile.DoesNotExist:
             return Response({"error": "Recipient not found."}, status=status.HTTP_404_NOT_FOUND)
 
         # Get or create conversation between the two users
-        conversation = (
-            Conversation.objects
-            .filter(participants=sender.userprofile)
-            .filter(participants=recipient_profile)
-            .first()
+        conversation, is_new_conversation = Conversation.objects.get_or_create_direct(
+            sender.userprofile, recipient_profile
         )
-        is_new_conversation = False
-        if not conversation:
-            conversation = Conversation.objects.create()
-            conversation.participants.add(sender.userprofile, recipient_profile)
-            conversation.save()
-            is_new_conversation = True
 
         # Process audio data if present
         audio_data = None
@@ -60,26 +64,17 @@ class SendMessageView(APIView):
             except Exception as e:
                 return Response({"error": f"Invalid audio data: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Create the message
-        message = Message.objects.create(
-            conversation=conversation,
-            sender=sender,
-            recipient=recipient_profile,
-            content=content or "Audio message",
-            message_type=message_type,
-            audio_data=audio_data
+        # Participants get a conversation update once the message commits
+        message = create_message(
+            conversation,
+            sender,
+            recipient_profile,
+            content or "Audio message",
+            message_type,
+            stored_audio=store_audio(audio_data) if audio_data else None,
+            is_new_conversation=is_new_conversation,
+            request=request,
         )
-
-        # Auto-restore conversation for participants who deleted it
-        for participant in conversation.participants.all():
-            if participant in conversation.deleted_by.all():
-                conversation.deleted_by.remove(participant)
-                # DO NOT clear deletion timestamp - keep it so user only sees messages after deletion
-
-        # Email notifications are now handled automatically by Django signals
-        
-        # Send real-time conversation update to all participants
-        send_conversation_update(conversation, is_new=is_new_conversation, request=request)
         
         # Serialize response data
         message_serializer = MessageSerializer(message, context={'request': request})
@@ -99,26 +94,79 @@ class UserConversationsView(APIView):
 
     def get(self, request):
         user_profile = request.user.userprofile
+        page_size = parse_page_size(request.GET.get('page_size'), default=8)  # Default 8 conversations per page
         
-        # Get pagination parameters
+        if 'page' in request.GET and 'cursor' not in request.GET:
+            # Legacy offset pagination, kept for older clients
+            conversations_query = Conversation.objects.filter(
+                memberships__profile=user_profile, memberships__hidden=False
+            )
+            return self.paginate_by_page(request, conversations_query, user_profile, page_size)
+
+        # Keyset pagination on the viewer's membership (activity_at, conversation), newest
+        # activity first. A conversation that moves to the top mid-scroll lands before the
+        # cursor, so later pages never repeat or skip.
+        cursor = request.GET.get('cursor')
+        include_total = request.GET.get('include_total') in ('1', 'true')
+        # Only the plain first page is cached; deeper pages are cheap keyset probes
+        cacheable = not cursor and not include_total
+        if cacheable:
+            generation = get_conversation_list_generation(user_profile.id)
+            cached = get_cached_conversation_list(user_profile.id, generation, page_size)
+            if cached is not None:
+                return Response(cached)
+
+        # The page is read from chat_membership_activity_idx alone: the profile and hidden
+        # filters, the keyset and the order are all on ConversationMembership, so the
+        # database walks the index in order and stops after page_size + 1 rows
+        memberships = user_profile.conversation_memberships.filter(hidden=False)
+        if cursor:
+            try:
+                memberships = memberships.filter(
+                    keyset_filter('activity_at', cursor, 'before', pk_field='conversation_id')
+                )
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        page = list(
+            memberships.order_by('-activity_at', '-conversation_id')
+            .values_list('conversation_id', 'activity_at')[:page_size + 1]
+        )
+        has_next = len(page) > page_size
+        page = page[:page_size]
+        by_id = Conversation.objects.with_summary(user_profile).in_bulk(
+            [conversation_id for conversation_id, _ in page]
+        )
+        conversations = [by_id[conversation_id] for conversation_id, _ in page]
+
+        serializer = ConversationSerializer(conversations, many=True, context={'request': request})
+        pagination = {
+            'page_size': page_size,
+            'next_cursor': encode_cursor(page[-1][1], page[-1][0]) if has_next else None,
+            'has_next': has_next,
+        }
+        # Counting means a full anti-join over the user's conversations, so it is opt-in
+        if include_total:
+            pagination['total_conversations'] = user_profile.conversation_memberships.filter(hidden=False).count()
+
+        data = {
+            'conversations': serializer.data,
+            'pagination': pagination
+        }
+        if cacheable:
+            cache_conversation_list(user_profile.id, generation, page_size, data)
+        return Response(data)
+
+    def paginate_by_page(self, request, conversations_query, user_profile, page_size):
         page = int(request.GET.get('page', 1))
-        page_size = int(request.GET.get('page_size', 8))  # Default 8 conversations per page
         
         # Calculate offset
         offset = (page - 1) * page_size
         
-        # Base query for conversations
-        conversations_query = Conversation.objects.filter(
-            participants=user_profile
-        ).exclude(
-            deleted_by=user_profile
-        ).order_by('-updated_at')
-        
         # Get total count for pagination info
         total_conversations = conversations_query.count()
         
         # Get paginated conversations
-        conversations = conversations_query[offset:offset + page_size]
+        conversations = conversations_query.order_by('-updated_at', '-id').with_summary(user_profile)[offset:offset + page_size]
         
         serializer = ConversationSerializer(conversations, many=True, context={'request': request})
         
@@ -144,65 +192,125 @@ class ConversationMessagesView(APIView):
 
     def get(self, request, conversation_id):
         try:
-            conversation = Conversation.objects.get(id=conversation_id, participants=request.user.userprofile)
-            
-            # Get pagination parameters
-            page = int(request.GET.get('page', 1))
-            page_size = int(request.GET.get('page_size', 50))  # Default 50 messages per page
+            profile = request.user.userprofile
+            # Both participants' rows: the viewer's for access and history, everyone's watermark for is_read
+            memberships = {
+                membership.profile_id: membership
+                for membership in ConversationMembership.objects.select_related('conversation').filter(
+                    conversation_id=conversation_id
+                )
+            }
+            if profile.id not in memberships:
+                raise ConversationMembership.DoesNotExist
+            membership = memberships[profile.id]
+            conversation = membership.conversation
             
-            # Calculate offset
-            offset = (page - 1) * page_size
+            page_size = parse_page_size(request.GET.get('page_size'), default=50)
+            before = request.GET.get('before')
+            after = request.GET.get('after')
             
-            # Get messages based on user's deletion timestamp
             messages_query = Message.objects.filter(conversation=conversation)
             
-            # Check if user has a deletion timestamp
-            deletion_timestamps = conversation.deletion_timestamps or {}
-            user_deletion_time = deletion_timestamps.get(str(request.user.userprofile.id))
-            
-            if user_deletion_time:
+            if membership.cleared_before:
                 # User deleted the conversation, only show messages after deletion
-                from django.utils import timezone
-                deletion_datetime = timezone.datetime.fromisoformat(user_deletion_time)
-                messages_query = messages_query.filter(timestamp__gt=deletion_datetime)
-            
-            # Get total count for pagination info
-            total_messages = messages_query.count()
-            
-            # Order by timestamp descending for pagination (newest first for loading)
-            # Then reverse the results to show oldest first in UI
-            messages = list(messages_query.order_by('-timestamp')[offset:offset + page_size])
-            messages.reverse()  # Reverse to show chronological order
+                messages_query = messages_query.filter(timestamp__gt=membership.cleared_before)
+
+            messages_query = messages_query.select_related('sender__userprofile', 'recipient')
+
+            if 'page' in request.GET and not (before or after):
+                # Legacy offset pagination, kept for older clients
+                messages, pagination = self.paginate_by_page(request, messages_query, page_size)
+            else:
+                try:
+                    messages, pagination = self.paginate_by_cursor(messages_query, page_size, before, after)
+                except ValueError as e:
+                    return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
             
-            # Mark messages as read (only for current page)
-            message_ids = [msg.id for msg in messages]
-            Message.objects.filter(
-                id__in=message_ids,
-                recipient=request.user.userprofile,
-                is_read=False
-            ).update(is_read=True)
-            
-            serializer = MessageSerializer(messages, many=True, context={'request': request})
-            
-            # Calculate pagination metadata
-            total_pages = (total_messages + page_size - 1) // page_size
-            has_next = page < total_pages
-            has_previous = page > 1
+            # Reading a page moves the watermark only if it shows something newer; older pages cost no write
+            newest_received = max((msg.id for msg in messages if msg.recipient_id == profile.id), default=0)
+            if newest_received > membership.read_up_to:
+                read_up_to = mark_read(conversation, request.user, profile, newest_received)
+                if read_up_to is not None:
+                    membership.read_up_to = read_up_to
+
+            serializer = MessageSerializer(messages, many=True, context={
+                'request': request,
+                'read_watermarks': {profile_id: m.read_up_to for profile_id, m in memberships.items()},
+                'delivery_watermarks': {
+                    profile_id: max(m.delivered_up_to, m.read_up_to) for profile_id, m in memberships.items()
+                },
+            })
             
             return Response({
                 'messages': serializer.data,
-                'pagination': {
-                    'page': page,
-                    'page_size': page_size,
-                    'total_messages': total_messages,
-                    'total_pages': total_pages,
-                    'has_next': has_next,
-                    'has_previous': has_previous
-                }
+                'pagination': pagination
             })
-        except Conversation.DoesNotExist:
+        except ConversationMembership.DoesNotExist:
             return Response({"error": "Conversation not found or access denied."}, status=404)
 
+    def paginate_by_cursor(self, messages_query, page_size, before=None, after=None):
+        """
+        Keyset pagination on (timestamp, id), served by the
+        (conversation, timestamp, id) index. With no cursor the newest page is
+        returned; ``before`` walks back through history and ``after`` fetches
+        anything newer than the client has.
+        """
+        if after:
+            rows = list(
+                messages_query.filter(keyset_filter('timestamp', after, 'after'))
+                .order_by('timestamp', 'id')[:page_size + 1]
+            )
+            has_more = len(rows) > page_size
+            messages = rows[:page_size]
+        else:
+            if before:
+                messages_query = messages_query.filter(keyset_filter('timestamp', before, 'before'))
+            rows = list(messages_query.order_by('-timestamp', '-id')[:page_size + 1])
+            has_more = len(rows) > page_size
+            messages = rows[:page_size]
+            messages.reverse()  # Reverse to show chronological order
+
+        oldest, newest = (messages[0], messages[-1]) if messages else (None, None)
+        pagination = {
+            'page_size': page_size,
+            # Cursor for the next page in the direction being walked, or None at the end
+            'next_cursor': None,
+            'has_next': has_more,
+            'oldest_cursor': encode_cursor(oldest.timestamp, oldest.id) if oldest else None,
+            'newest_cursor': encode_cursor(newest.timestamp, newest.id) if newest else None,
+        }
+        if has_more:
+            pagination['next_cursor'] = pagination['newest_cursor'] if after else pagination['oldest_cursor']
+        return messages, pagination
+
+    def paginate_by_page(self, request, messages_query, page_size):
+        page = int(request.GET.get('page', 1))
+        
+        # Calculate offset
+        offset = (page - 1) * page_size
+        
+        # Get total count for pagination info
+        total_messages = messages_query.count()
+        
+        # Order by timestamp descending for pagination (newest first for loading)
+        # Then reverse the results to show oldest first in UI
+        messages = list(messages_query.order_by('-timestamp', '-id')[offset:offset + page_size])
+        messages.reverse()  # Reverse to show chronological order
+        
+        # Calculate pagination metadata
+        total_pages = (total_messages + page_size - 1) // page_size
+        has_next = page < total_pages
+        has_previous = page > 1
+        
+        return messages, {
+            'page': page,
+            'page_size': page_size,
+            'total_messages': total_messages,
+            'total_pages': total_pages,
+            'has_next': has_next,
+            'has_previous': has_previous
+        }
+
 class SendMessageInConversationView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -224,11 +332,10 @@ class SendMessageInConversationView(APIView):
         except Conversation.DoesNotExist:
             return Response({"error": "Conversation not found or access denied."}, status=status.HTTP_404_NOT_FOUND)
 
-        # Find recipient: all participants except the sender
-        recipients = conversation.participants.exclude(id=user_profile.id)
-        if not recipients.exists():
+        # Find recipient: the other participant (1-to-1 chats)
+        recipient_profile = get_recipient(conversation, user_profile)
+        if recipient_profile is None:
             return Response({"error": "No recipient found."}, status=status.HTTP_400_BAD_REQUEST)
-        recipient_profile = recipients.first()  # For 1-to-1 chats
 
         # Process audio data if present
         audio_data = None
@@ -239,26 +346,16 @@ class SendMessageInConversationView(APIView):
             except Exception as e:
                 return Response({"error": f"Invalid audio data: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
 
-        message = Message.objects.create(
-            conversation=conversation,
-            sender=user,
-            recipient=recipient_profile,
-            content=content,
-            message_type=message_type,
-            audio_data=audio_data
+        # Participants get a conversation update once the message commits
+        message = create_message(
+            conversation,
+            user,
+            recipient_profile,
+            content,
+            message_type,
+            stored_audio=store_audio(audio_data) if audio_data else None,
+            request=request,
         )
-
-        # Auto-restore conversation for participants who deleted it
-        for participant in conversation.participants.all():
-            if participant in conversation.deleted_by.all():
-                conversation.deleted_by.remove(participant)
-                # DO NOT clear deletion timestamp - keep it so user only sees messages after deletion
-                # The deletion timestamp should persist even after restoration
-
-        # Email notifications are now handled automatically by Django signals
-            
-        # Send real-time conversation update (not new, just update)
-        send_conversation_update(conversation, is_new=False, request=request)
         
         serializer = MessageSerializer(message, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -277,17 +374,8 @@ class CreateConversationView(APIView):
         except UserProfile.DoesNotExist:
             return Response({"error": "Recipient not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        # Check if conversation already exists
-        conversation = (
-            Conversation.objects
-            .filter(participants=user_profile)
-            .filter(participants=recipient_profile)
-            .first()
-        )
-        if not conversation:
-            conversation = Conversation.objects.create()
-            conversation.participants.add(user_profile, recipient_profile)
-            conversation.save()
+        # Reuse the existing conversation if there is one
+        conversation, _ = Conversation.objects.get_or_create_direct(user_profile, recipient_profile)
 
         serializer = ConversationSerializer(conversation, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -345,14 +433,8 @@ class DeleteConversationView(APIView):
             print(f"Conversation ID: {conversation_id}")
             
             conversation = Conversation.objects.get(id=conversation_id, participants=request.user.userprofile)
-            conversation.deleted_by.add(request.user.userprofile)
-            
-            # Store deletion timestamp
-
-            deletion_timestamps = conversation.deletion_timestamps or {}
-            deletion_timestamps[str(request.user.userprofile.id)] = timezone.now().isoformat()
-            conversation.deletion_timestamps = deletion_timestamps
-            conversation.save()
+            # Hide it and record when, so only later messages show up if it comes back
+            conversation.hide_for(request.user.userprofile)
             
             return Response({"success": True, "message": "Conversation deleted successfully"})
         except Conversation.DoesNotExist:
@@ -361,3 +443,306 @@ class DeleteConversationView(APIView):
         except Exception as e:
             print(f"Error in delete_conversation: {str(e)}")
             return Response({"error": f"Server error: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class MarkConversationReadView(APIView):
+    """
+    Move the caller's read watermark up to ``message_id``: one write and one
+    read_up_to broadcast however many messages it covers. Watermarks never move back.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, conversation_id):
+        try:
+            message_id = int(request.data.get('message_id'))
+        except (TypeError, ValueError):
+            return Response({"error": "message_id is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        profile = request.user.userprofile
+        try:
+            membership = ConversationMembership.objects.select_related('conversation').get(
+                conversation_id=conversation_id, profile=profile
+            )
+        except ConversationMembership.DoesNotExist:
+            return Response({"error": "Conversation not found or access denied."}, status=status.HTTP_404_NOT_FOUND)
+
+        read_up_to = mark_read(membership.conversation, request.user, profile, message_id)
+        return Response({
+            'conversation_id': membership.conversation_id,
+            'read_up_to': read_up_to if read_up_to is not None else membership.read_up_to,
+            'updated': read_up_to is not None,
+        })
+
+
+AUDIO_STREAM_BLOCK_SIZE = 64 * 1024
+RANGE_HEADER_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range_header(header, size):
+    """
+    Parse a single-range ``Range: bytes=...`` header into an inclusive
+    (start, end) pair. Returns None when the header is absent or malformed
+    (serve the whole file) and raises ValueError when it is unsatisfiable.
+    """
+    match = RANGE_HEADER_RE.match(header.strip()) if header else None
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the final N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('Range not satisfiable')
+    return start, end
+
+
+def stream_file_range(audio_file, start, length):
+    """Yield ``length`` bytes from ``start`` in fixed-size blocks, then close the file"""
+    try:
+        audio_file.seek(start)
+        remaining = length
+        while remaining > 0:
+            block = audio_file.read(min(AUDIO_STREAM_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    finally:
+        audio_file.close()
+
+
+class MessageAudioView(APIView):
+    """Stream a voice note's bytes with HTTP Range support to conversation participants"""
+    authentication_classes = [JWTAuthentication, AudioURLSignatureAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, message_id):
+        try:
+            message = Message.objects.only(
+                'id', 'message_type', 'audio_sha256', 'audio_size', 'audio_mime_type'
+            ).get(
+                id=message_id,
+                conversation__participants=request.user.userprofile,
+            )
+        except Message.DoesNotExist:
+            return Response({"error": "Message not found or access denied."}, status=status.HTTP_404_NOT_FOUND)
+
+        if not message.has_audio:
+            return Response({"error": "Message has no audio."}, status=status.HTTP_404_NOT_FOUND)
+
+        # Content-addressed blobs never change, so the digest is a strong validator
+        etag = f'"{message.audio_sha256}"'
+        cache_headers = {
+            'ETag': etag,
+            'Cache-Control': 'private, max-age=31536000, immutable',
+            'Accept-Ranges': 'bytes',
+        }
+
+        if etag in request.headers.get('If-None-Match', ''):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+            for header, value in cache_headers.items():
+                response[header] = value
+            return response
+
+        size = message.audio_size
+        range_header = request.headers.get('Range')
+        if range_header and request.headers.get('If-Range', etag) != etag:
+            range_header = None
+
+        try:
+            byte_range = parse_range_header(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+        start, end = byte_range or (0, size - 1)
+        length = end - start + 1
+        response = StreamingHttpResponse(
+            stream_file_range(open_audio(message.audio_sha256), start, length),
+            status=status.HTTP_206_PARTIAL_CONTENT if byte_range else status.HTTP_200_OK,
+            content_type=message.audio_mime_type or 'application/octet-stream',
+        )
+        response['Content-Length'] = str(length)
+        if byte_range:
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        for header, value in cache_headers.items():
+            response[header] = value
+        return response
+
+
+def audio_upload_status(upload):
+    chunks = uploads.received_chunks(upload.id)
+    return {
+        'upload_id': str(upload.id),
+        'conversation_id': upload.conversation_id,
+        'received_chunks': sorted(chunks),
+        'received_bytes': sum(chunks.values()),
+        'max_chunk_bytes': settings.CHAT_UPLOAD_MAX_CHUNK_BYTES,
+        'max_total_bytes': settings.CHAT_AUDIO_MAX_BYTES,
+        'committed': upload.message_id is not None,
+        'message_id': upload.message_id,
+    }
+
+
+class CreateAudioUploadView(APIView):
+    """Start a resumable voice-note upload in a conversation"""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        conversation_id = request.data.get('conversation_id')
+        if not conversation_id:
+            return Response({"error": "conversation_id is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            conversation = Conversation.objects.get(id=conversation_id, participants=request.user.userprofile)
+        except (Conversation.DoesNotExist, ValueError):
+            return Response({"error": "Conversation not found or access denied."}, status=status.HTTP_404_NOT_FOUND)
+
+        upload = AudioUpload.objects.create(
+            uploader=request.user,
+            conversation=conversation,
+            content=request.data.get('content') or 'Audio message',
+            mime_type=request.data.get('mime_type') or '',
+        )
+        return Response(audio_upload_status(upload), status=status.HTTP_201_CREATED)
+
+
+class AudioUploadDetailView(APIView):
+    """Report which chunks have arrived, so an interrupted client can resume"""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, upload_id):
+        upload = get_object_or_404(AudioUpload, id=upload_id, uploader=request.user)
+        return Response(audio_upload_status(upload))
+
+    def delete(self, request, upload_id):
+        upload = get_object_or_404(AudioUpload, id=upload_id, uploader=request.user)
+        uploads.discard_chunks(upload.id)
+        upload.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class AudioUploadChunkView(APIView):
+    """
+    PUT the raw bytes of chunk ``index`` (application/octet-stream). The body is
+    streamed to temporary storage rather than parsed, and re-sending a chunk
+    replaces it.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def put(self, request, upload_id, index):
+        upload = get_object_or_404(AudioUpload, id=upload_id, uploader=request.user)
+        if upload.message_id is not None:
+            return Response({"error": "Upload is already committed."}, status=status.HTTP_409_CONFLICT)
+        if index >= uploads.max_chunk_count():
+            return Response({"error": "Chunk index is out of range."}, status=status.HTTP_400_BAD_REQUEST)
+        # DRF has no stream for a body without a Content-Length (empty, or chunked encoding)
+        if request.stream is None:
+            return Response({"error": "Chunk is empty."}, status=status.HTTP_400_BAD_REQUEST)
+
+        too_large = Response(
+            {"error": "Chunk is too large or the upload exceeds the maximum audio size."},
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        )
+        # Reject an oversized body while it streams in...
+        chunks = uploads.received_chunks(upload.id)
+        other_bytes = sum(size for chunk_index, size in chunks.items() if chunk_index != index)
+        max_bytes = min(settings.CHAT_UPLOAD_MAX_CHUNK_BYTES, settings.CHAT_AUDIO_MAX_BYTES - other_bytes)
+        try:
+            part_path, chunk_bytes = uploads.receive_chunk(upload.id, request.stream, max_bytes)
+        except uploads.ChunkTooLarge:
+            return too_large
+
+        # ...and settle the total under the upload's row lock, so concurrent chunks
+        # (and a concurrent commit) cannot together go over the limit
+        try:
+            with transaction.atomic():
+                upload = AudioUpload.objects.select_for_update().get(id=upload.id)
+                if upload.message_id is not None:
+                    return Response({"error": "Upload is already committed."}, status=status.HTTP_409_CONFLICT)
+                chunks = uploads.received_chunks(upload.id)
+                other_bytes = sum(size for chunk_index, size in chunks.items() if chunk_index != index)
+                if other_bytes + chunk_bytes > settings.CHAT_AUDIO_MAX_BYTES:
+                    return too_large
+                uploads.store_chunk(upload.id, index, part_path)
+        finally:
+            uploads.discard_part(part_path)
+
+        return Response(audio_upload_status(upload))
+
+
+class CommitAudioUploadView(APIView):
+    """Assemble the chunks and create the audio Message; retrying returns the same message"""
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, upload_id):
+        try:
+            chunk_count = int(request.data.get('chunk_count'))
+        except (TypeError, ValueError):
+            return Response({"error": "chunk_count is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            try:
+                upload = (
+                    AudioUpload.objects.select_for_update()
+                    .select_related('conversation')
+                    .get(id=upload_id, uploader=request.user)
+                )
+            except AudioUpload.DoesNotExist:
+                return Response({"error": "Upload not found."}, status=status.HTTP_404_NOT_FOUND)
+
+            if upload.message_id is not None:
+                serializer = MessageSerializer(upload.message, context={'request': request})
+                return Response(serializer.data, status=status.HTTP_200_OK)
+
+            conversation = upload.conversation
+            recipient_profile = get_recipient(conversation, request.user.userprofile)
+            if recipient_profile is None:
+                return Response({"error": "No recipient found."}, status=status.HTTP_400_BAD_REQUEST)
+
+            try:
+                assembled = uploads.assemble_chunks(upload.id, chunk_count)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            with assembled:
+                stored_audio = store_audio_file(assembled, upload.mime_type or None)
+            if not stored_audio.size:
+                return Response({"error": "Upload is empty."}, status=status.HTTP_400_BAD_REQUEST)
+
+            # Nested in this transaction, so the conversation update also waits for the commit
+            message = create_message(
+                conversation,
+                request.user,
+                recipient_profile,
+                upload.content,
+                'audio',
+                stored_audio=stored_audio,
+                request=request,
+            )
+            upload.message = message
+            upload.save(update_fields=['message'])
+
+            transaction.on_commit(lambda: uploads.discard_chunks(upload.id))
+
+        serializer = MessageSerializer(message, context={'request': request})
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class ChatMetricsView(APIView):
+    """Report this worker's chat counters and its most backlogged sockets (staff only)"""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            'counters': metrics.snapshot(),
+            'outbound_queues': outbound.queue_depths(),
+            'write_behind_pending': write_behind.pending_count(),
+        })
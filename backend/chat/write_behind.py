@@ -0,0 +1,301 @@
+"""
+Write-behind persistence for messages sent over chat sockets (CHAT_WRITE_BEHIND).
+
+By default a socket send waits for create_message to insert the message and
+update the conversation summary before anything is broadcast. With
+write-behind on, the consumer instead:
+
+1. takes the message id from the database's own sequence (reserve_message_id),
+   so ids stay unique across processes and REST inserts;
+2. appends the message to the journal, a Redis stream, so it survives a crash
+   of this process;
+3. broadcasts it, and hands it to this process's MessageWriter.
+
+The writer inserts whatever has accumulated every
+CHAT_WRITE_BEHIND_FLUSH_SECONDS, or as soon as CHAT_WRITE_BEHIND_BATCH_SIZE
+messages are waiting, with one bulk_create and two summary updates per
+conversation (persist_messages), then deletes the batch from the journal.
+Journal entries still there after CHAT_WRITE_BEHIND_REPLAY_AFTER_SECONDS
+belong to a writer that died; chat.tasks.replay_message_journal inserts them.
+Because ids are assigned up front, persisting is idempotent and a replay never
+duplicates a message.
+
+Until its batch commits a message is broadcast but not yet readable over REST,
+editable, or counted by read/delivery watermarks (they clamp to stored
+messages and catch up on the next read or ack).
+"""
+import asyncio
+import logging
+import time
+import weakref
+from collections import defaultdict
+from datetime import datetime
+from functools import partial
+
+import redis
+import redis.asyncio
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection, transaction
+
+from . import codec, metrics
+from .models import Conversation, Message
+from .signals import schedule_emails_for_new_messages
+from .utils import send_conversation_update
+
+logger = logging.getLogger(__name__)
+
+# One writer per event loop, created on first use
+_writers = weakref.WeakKeyDictionary()
+
+
+def reserve_message_id():
+    """Take the next id from chat_message's own sequence without inserting a row"""
+    table = Message._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id'))", [table])
+            return cursor.fetchone()[0]
+        if connection.vendor == 'sqlite':
+            # AUTOINCREMENT tables draw ids from sqlite_sequence; bump it the way an INSERT would
+            with transaction.atomic():
+                newest = f'SELECT COALESCE(MAX(id), 0) FROM {connection.ops.quote_name(table)}'
+                cursor.execute(
+                    f'UPDATE sqlite_sequence SET seq = MAX(seq, ({newest})) + 1 WHERE name = %s', [table]
+                )
+                if not cursor.rowcount:
+                    cursor.execute(f'INSERT INTO sqlite_sequence (name, seq) SELECT %s, ({newest}) + 1', [table])
+                cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+                return cursor.fetchone()[0]
+    raise ImproperlyConfigured(f'CHAT_WRITE_BEHIND does not support the {connection.vendor} database backend')
+
+
+areserve_message_id = database_sync_to_async(reserve_message_id)
+
+
+def message_record(message, participant_ids=None):
+    """A JSON-safe journal record of an unsaved message"""
+    fields = {}
+    for field in Message._meta.concrete_fields:
+        value = field.value_from_object(message)
+        fields[field.attname] = value.isoformat() if isinstance(value, datetime) else value
+    return {'message': fields, 'participant_ids': participant_ids}
+
+
+def message_from_record(record):
+    """The unsaved Message and participant ids of a journal record"""
+    fields = {
+        field.attname: field.to_python(record['message'][field.attname])
+        for field in Message._meta.concrete_fields
+        if field.attname in record['message']
+    }
+    return Message(**fields), record.get('participant_ids')
+
+
+def persist_messages(messages, participant_ids=None):
+    """
+    Insert messages built with their ids already set, skipping any already
+    stored, and record them in their conversations' summaries: one INSERT for
+    the batch and two UPDATEs per conversation. ``participant_ids`` maps
+    conversation ids to participant ids where the caller has them. As with
+    create_message, conversation_update broadcasts and notification emails
+    follow once the transaction commits. Returns the messages inserted.
+    """
+    participant_ids = participant_ids or {}
+    with transaction.atomic():
+        stored = set(Message.objects.filter(id__in=[message.id for message in messages]).values_list('id', flat=True))
+        messages = [message for message in messages if message.id not in stored]
+        if not messages:
+            return []
+        Message.objects.bulk_create(messages)
+
+        by_conversation = defaultdict(list)
+        for message in messages:
+            by_conversation[message.conversation_id].append(message)
+        conversations = Conversation.objects.in_bulk(by_conversation)
+        for conversation_id, conversation_messages in by_conversation.items():
+            conversation = conversations[conversation_id]
+            conversation.record_messages(conversation_messages, participant_ids.get(conversation_id))
+            transaction.on_commit(partial(send_conversation_update, conversation))
+        transaction.on_commit(lambda: schedule_emails_for_new_messages(messages))
+    return messages
+
+
+def persist_batch(messages, participant_ids):
+    """
+    persist_messages for a writer or replay batch. If the batch fails, each
+    message is retried alone so one bad row (say, its conversation was deleted)
+    does not hold back the rest. Returns the indexes of the messages that are
+    settled (stored, or rejected by the database and never going to be) and
+    how many were inserted by this call.
+    """
+    try:
+        return list(range(len(messages))), len(persist_messages(messages, participant_ids))
+    except Exception:
+        logger.exception(f"Failed to persist a batch of {len(messages)} messages; retrying one by one")
+
+    settled = []
+    inserted = 0
+    for index, message in enumerate(messages):
+        try:
+            inserted += len(persist_messages([message], participant_ids))
+        except IntegrityError as e:
+            metrics.increment(metrics.WRITE_BEHIND_MESSAGES_REJECTED)
+            logger.error(f"Dropping message {message.id} of conversation {message.conversation_id}: {str(e)}")
+        except Exception as e:
+            # Stays in the journal for replay_journal to retry
+            logger.error(f"Failed to persist message {message.id}: {str(e)}")
+            continue
+        settled.append(index)
+    return settled, inserted
+
+
+class MessageWriter:
+    """Journals submitted messages and persists them in batches (see the module docstring)"""
+
+    def __init__(self):
+        # (message, participant_ids, journal entry id) in submission order
+        self.pending = []
+        self.journal = None
+        if settings.CHAT_WRITE_BEHIND_JOURNAL_URL:
+            self.journal = redis.asyncio.Redis.from_url(settings.CHAT_WRITE_BEHIND_JOURNAL_URL)
+        else:
+            logger.warning("CHAT_WRITE_BEHIND has no journal: unflushed messages are lost if this process dies")
+        self._ready = asyncio.Event()
+        self._full = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def submit(self, message, participant_ids=None):
+        """
+        Journal ``message`` and queue it for the next batch. Returns False if it
+        could not be journaled, in which case the caller must persist it itself.
+        """
+        journal_id = None
+        if self.journal is not None:
+            try:
+                journal_id = await self.journal.xadd(
+                    settings.CHAT_WRITE_BEHIND_JOURNAL_STREAM,
+                    {'record': codec.dumps_bytes(message_record(message, participant_ids))},
+                )
+            except Exception as e:
+                metrics.increment(metrics.WRITE_BEHIND_JOURNAL_ERRORS)
+                logger.warning(f"Failed to journal message {message.id}: {str(e)}")
+                return False
+
+        self.pending.append((message, participant_ids, journal_id))
+        self._idle.clear()
+        self._ready.set()
+        if len(self.pending) >= settings.CHAT_WRITE_BEHIND_BATCH_SIZE:
+            self._full.set()
+        return True
+
+    async def drain(self):
+        """Wait until every submitted message has been persisted"""
+        await self._idle.wait()
+
+    async def _run(self):
+        batch_size = settings.CHAT_WRITE_BEHIND_BATCH_SIZE
+        while True:
+            await self._ready.wait()
+            if not self._full.is_set():
+                try:
+                    await asyncio.wait_for(self._full.wait(), settings.CHAT_WRITE_BEHIND_FLUSH_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self.pending[:batch_size]
+            del self.pending[:batch_size]
+            if len(self.pending) < batch_size:
+                self._full.clear()
+            if not self.pending:
+                self._ready.clear()
+            await self.flush(batch)
+            if not self.pending:
+                self._idle.set()
+
+    async def flush(self, batch):
+        messages = [message for message, _, _ in batch]
+        participant_ids = {message.conversation_id: ids for message, ids, _ in batch if ids is not None}
+        settled, inserted = await database_sync_to_async(persist_batch)(messages, participant_ids)
+        metrics.increment(metrics.WRITE_BEHIND_BATCHES)
+        metrics.increment(metrics.WRITE_BEHIND_MESSAGES_PERSISTED, inserted)
+
+        journal_ids = [batch[index][2] for index in settled if batch[index][2] is not None]
+        if journal_ids:
+            try:
+                await self.journal.xdel(settings.CHAT_WRITE_BEHIND_JOURNAL_STREAM, *journal_ids)
+            except Exception as e:
+                # Harmless: replay finds these messages already stored and skips them
+                logger.warning(f"Failed to trim {len(journal_ids)} journal entries: {str(e)}")
+
+
+def get_writer():
+    """The MessageWriter of the running event loop"""
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        writer = _writers[loop] = MessageWriter()
+        writer.start()
+    return writer
+
+
+def pending_count():
+    """Messages submitted in this process and not persisted yet"""
+    return sum(len(writer.pending) for writer in list(_writers.values()))
+
+
+async def submit_message(conversation, sender, recipient, content, message_type='text',
+                         stored_audio=None, participant_ids=None):
+    """
+    Write-behind counterpart of acreate_message: returns the message with its
+    id and timestamp set as soon as it is journaled, before it is inserted.
+    """
+    audio_fields = stored_audio.message_fields() if stored_audio else {}
+    message = Message(
+        id=await areserve_message_id(),
+        conversation=conversation,
+        sender=sender,
+        recipient=recipient,
+        content=content,
+        message_type=message_type,
+        **audio_fields
+    )
+    if not await get_writer().submit(message, participant_ids):
+        # Without a journal entry a crash would lose it: store it before it is broadcast
+        await database_sync_to_async(persist_messages)([message], {conversation.id: participant_ids})
+    return message
+
+
+def replay_journal():
+    """
+    Persist journal entries older than CHAT_WRITE_BEHIND_REPLAY_AFTER_SECONDS,
+    left by writers that stopped before flushing them. Returns how many
+    messages were inserted (entries already stored are only trimmed).
+    """
+    journal = redis.Redis.from_url(settings.CHAT_WRITE_BEHIND_JOURNAL_URL)
+    stream = settings.CHAT_WRITE_BEHIND_JOURNAL_STREAM
+    cutoff = int((time.time() - settings.CHAT_WRITE_BEHIND_REPLAY_AFTER_SECONDS) * 1000)
+    replayed = 0
+    start = '-'
+    while True:
+        entries = journal.xrange(stream, start, cutoff, count=settings.CHAT_WRITE_BEHIND_BATCH_SIZE)
+        if not entries:
+            break
+        records = [message_from_record(codec.loads(fields[b'record'])) for _, fields in entries]
+        messages = [message for message, _ in records]
+        settled, inserted = persist_batch(
+            messages, {message.conversation_id: ids for message, ids in records if ids is not None}
+        )
+        replayed += inserted
+        settled_ids = [entries[index][0] for index in settled]
+        if settled_ids:
+            journal.xdel(stream, *settled_ids)
+        # Entries that failed again stay for the next run
+        start = '(' + entries[-1][0].decode()
+    metrics.increment(metrics.WRITE_BEHIND_MESSAGES_REPLAYED, replayed)
+    return replayed
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.6 on 2026-10-17 11:20
+
+from django.db import migrations
+
+
+def reset_is_online(apps, schema_editor):
+    """
+    Clear is_online on every profile. The flag used to be set at login and
+    cleared by a cleanup command that no longer exists, so rows left True are
+    stale; chat.presence.flush_last_seen sets it again for users whose sockets
+    are connected within one flush.
+    """
+    UserProfile = apps.get_model('users', 'UserProfile')
+    UserProfile.objects.filter(is_online=True).update(is_online=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_auto_20250815_1049'),
+    ]
+
+    operations = [
+        # is_online only mirrors chat.presence, so there is nothing to restore
+        migrations.RunPython(reset_is_online, migrations.RunPython.noop),
+    ]
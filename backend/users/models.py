@@ -1,6 +1,5 @@
 from django.db import models
 from django.contrib.auth.models import User
-from django.utils import timezone
 
 def user_directory_path(instance, filename):
     # Uploads to: MEDIA_ROOT/profile_pics/user_<id>/<filename>
@@ -21,25 +20,13 @@ class UserProfile(models.Model):
     date_of_birth = models.DateField(null=True, blank=True)
     gender = models.CharField(max_length=1, choices=GENDER_CHOICES, blank=True)
     
-    # User presence tracking fields
+    # Mirror of chat.presence, written in batches by its flush_last_seen
     is_online = models.BooleanField(default=False)
     last_seen = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.user.username}'s Profile"
     
-    def set_online(self):
-        """Mark user as online"""
-        self.is_online = True
-        self.last_seen = timezone.now()
-        self.save(update_fields=['is_online', 'last_seen'])
-    
-    def set_offline(self):
-        """Mark user as offline"""
-        self.is_online = False
-        self.last_seen = timezone.now()
-        self.save(update_fields=['is_online', 'last_seen'])
-
     @property
     def profile_picture_url(self):
         if self.profile_picture:
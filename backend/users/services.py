@@ -7,6 +7,7 @@ from django.shortcuts import redirect
 from django.contrib.auth.models import User
 from rest_framework_simplejwt.tokens import RefreshToken
 from .models import UserProfile
+from chat import presence
 
 
 
@@ -82,11 +83,8 @@ def get_user_data(validated_data):
     # Ensure profile exists even if user already existed
     profile, profile_created = UserProfile.objects.get_or_create(user=user)
     
-    # Mark user as online when logging in via Google
-    try:
-        profile.set_online()
-    except:
-        pass  # Handle any potential errors
+    # Online state follows the user's sockets; a login only counts as being seen
+    presence.note_seen(user.id)
 
     # Generate JWT tokens instead of session
     refresh = RefreshToken.for_user(user)
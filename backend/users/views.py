@@ -17,6 +17,7 @@ from django.views.decorators.csrf import csrf_exempt,ensure_csrf_cookie, csrf_pr
 from django.utils.decorators import method_decorator
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.exceptions import TokenError, InvalidToken
+from chat import presence
 
 
 def create_jwt_response(user, message="Success"):
@@ -106,12 +107,9 @@ class LogoutApi(APIView):
     
     def post(self, request, *args, **kwargs):
         try:
-            # Mark user as offline when logging out
-            try:
-                user_profile = request.user.userprofile
-                user_profile.set_offline()
-            except:
-                pass  # User profile doesn't exist or other error
+            # Online state follows the user's sockets (other devices may still be
+            # connected), so logging out only counts as being seen
+            presence.note_seen(request.user.id)
             
             # Try to blacklist the refresh token if provided
             refresh_token = request.data.get("refresh")
@@ -123,12 +121,7 @@ class LogoutApi(APIView):
             logout(request)
             return JsonResponse({'message': 'Logged out successfully'}, status=200)
         except (TokenError, InvalidToken):
-            # Mark user as offline even if token blacklisting fails
-            try:
-                user_profile = request.user.userprofile
-                user_profile.set_offline()
-            except:
-                pass  # User profile doesn't exist or other error
+            presence.note_seen(request.user.id)
             
             # Even if token blacklisting fails, still logout successfully
             logout(request)
@@ -215,12 +208,8 @@ class ManualLoginView(APIView):
         user = authenticate(request, username=user.username, password=password)
 
         if user is not None:
-            # Mark user as online when logging in
-            try:
-                user_profile = user.userprofile
-                user_profile.set_online()
-            except:
-                pass  # User profile doesn't exist or other error
+            # Online state follows the user's sockets; a login only counts as being seen
+            presence.note_seen(user.id)
             
             # Return JWT tokens instead of creating session
             return create_jwt_response(user, "Login successful")
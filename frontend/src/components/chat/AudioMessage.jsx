@@ -1,10 +1,11 @@
 import React, { useState, useRef, useEffect } from 'react';
 import { Play, Pause, Headphones } from 'lucide-react';
 
-const AudioMessage = ({ audioData, isCurrentUser, messageId }) => {
+const AudioMessage = ({ audioUrl, audioData, audioDuration, isCurrentUser, messageId }) => {
   const [isPlaying, setIsPlaying] = useState(false);
   const [currentTime, setCurrentTime] = useState(0);
-  const [duration, setDuration] = useState(0);
+  // Server-computed duration lets the player render before any audio is fetched
+  const [duration, setDuration] = useState(audioDuration || 0);
   const [isLoading, setIsLoading] = useState(true);
   const [hoverPosition, setHoverPosition] = useState(-1);
   const audioRef = useRef(null);
@@ -210,7 +211,7 @@ const AudioMessage = ({ audioData, isCurrentUser, messageId }) => {
       {/* Hidden Audio Element */}
       <audio
         ref={audioRef}
-        src={`data:audio/webm;base64,${audioData}`}
+        src={audioUrl || `data:audio/webm;base64,${audioData}`}
         onTimeUpdate={handleTimeUpdate}
         onLoadedMetadata={handleLoadedMetadata}
         onPlay={handlePlay}
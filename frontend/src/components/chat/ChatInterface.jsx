@@ -8,6 +8,9 @@ import EmojiPicker from 'emoji-picker-react';
 import usePagination from '../../hooks/usePagination';
 import AudioMessage from './AudioMessage';
 
+// Well inside the server's CHAT_TYPING_TTL_SECONDS
+const TYPING_REFRESH_MS = 2000;
+
 function ChatInterface({ 
   selectedConversation, 
   recipientPhone, 
@@ -42,14 +45,15 @@ function ChatInterface({
   const [typingUsers, setTypingUsers] = useState(new Set());
   const [isTyping, setIsTyping] = useState(false);
   const typingTimeoutRef = useRef(null);
+  const lastTypingSentRef = useRef(0);
   // Add state for tracking visible messages for read receipts
   const visibleMessagesRef = useRef(new Set());
   const lastReadMessageRef = useRef(null);
   
   // Pagination state for messages
   const {
-    currentPage: messagePage,
     hasNext: hasMoreMessages,
+    nextCursor: olderMessagesCursor,
     updatePaginationData: updateMessagePagination,
     nextPage: loadMoreMessages,
     loading: messagesLoading,
@@ -81,7 +85,7 @@ function ChatInterface({
         try {
           resetMessagePagination();
           const res = await axiosInstance.get(
-            `${ENV.BASE_API_URL}/chat/api/conversation/${selectedConversation.id}/messages/?page=1&page_size=15`
+            `${ENV.BASE_API_URL}/chat/api/conversation/${selectedConversation.id}/messages/?page_size=15`
           );
           if (res.status === 200) {
             console.log('Messages API Response:', res.data);
@@ -181,19 +185,29 @@ function ChatInterface({
                 });
               }
               return;
-            } else if (data.action_type === 'read_receipt') {
-              // Handle read receipt
+            } else if (data.action_type === 'delivered_up_to') {
+              // Delivery watermark: the recipient's client has everything up to message_id
+              const { message_id, recipient_username } = data;
+              setMessages((prev) => {
+                return prev.map(msg => {
+                  if (msg.sender_username !== recipient_username && msg.id <= message_id && !msg.is_delivered) {
+                    return { ...msg, is_delivered: true };
+                  }
+                  return msg;
+                });
+              });
+              return;
+            } else if (data.action_type === 'read_up_to') {
+              // Read watermark: everything up to message_id sent to the reader is read
               const { message_id, reader_username } = data;
-              if (reader_username !== currentUsername) {
-                setMessages((prev) => {
-                  return prev.map(msg => {
-                    if (msg.id == message_id) {
-                      return { ...msg, is_read: true };
-                    }
-                    return msg;
-                  });
+              setMessages((prev) => {
+                return prev.map(msg => {
+                  if (msg.sender_username !== reader_username && msg.id <= message_id && !msg.is_read) {
+                    return { ...msg, is_read: true, is_delivered: true };
+                  }
+                  return msg;
                 });
-              }
+              });
               return;
             } else if (data.action_type === 'new_message') {
               // Handle new message
@@ -202,10 +216,12 @@ function ChatInterface({
                 sender_username: data.sender_username,
                 timestamp: data.timestamp,
                 is_read: data.is_read,
+                is_delivered: data.is_delivered,
                 id: data.id,
                 sender_profile_picture: data.sender_profile_picture,
                 message_type: data.message_type || 'text',
-                audio_data_base64: data.audio_data_base64
+                audio_url: data.audio_url,
+                audio_duration: data.audio_duration
               };
 
               setMessages((prev) => {
@@ -213,6 +229,7 @@ function ChatInterface({
                 if (ids.has(newMessage.id)) return prev;
                 return [...prev, newMessage];
               });
+              acknowledgeMessage(newMessage);
 
               // Also update the conversation list in real-time
               if (typeof window.updateConversationList === 'function') {
@@ -228,10 +245,12 @@ function ChatInterface({
               sender_username: data.sender_username,
               timestamp: data.timestamp,
               is_read: data.is_read,
+              is_delivered: data.is_delivered,
               id: data.id,
               sender_profile_picture: data.sender_profile_picture,
               message_type: data.message_type || 'text',
-              audio_data_base64: data.audio_data_base64
+              audio_url: data.audio_url,
+              audio_duration: data.audio_duration
             };
 
             setMessages((prev) => {
@@ -239,6 +258,7 @@ function ChatInterface({
               if (ids.has(newMessage.id)) return prev;
               return [...prev, newMessage];
             });
+            acknowledgeMessage(newMessage);
           } catch (err) {
             console.error("Error parsing message", err);
             setError("Error parsing message from server");
@@ -315,21 +335,21 @@ function ChatInterface({
     if (selectedConversation) {
       if (ws.current && ws.current.readyState === WebSocket.OPEN) {
         if (audioBlob) {
-          // Send audio message
-          const reader = new FileReader();
-          reader.readAsDataURL(audioBlob);
-          reader.onloadend = () => {
-            // Extract base64 data from the DataURL
-            const base64Data = reader.result.split(',')[1];
-            const messageData = {
-              content: "Audio message", // Placeholder text for audio messages
-              sender_username: currentUsername,
-              message_type: 'audio',
-              audio_data_base64: base64Data
-            };
-            ws.current.send(JSON.stringify(messageData));
-            setAudioBlob(null);
-          };
+          // Send audio as a binary frame: 4-byte header length, JSON header, raw audio
+          const header = new TextEncoder().encode(JSON.stringify({
+            upload_id: `${Date.now()}`,
+            final: true,
+            content: "Audio message", // Placeholder text for audio messages
+            sender_username: currentUsername,
+            mime_type: audioBlob.type
+          }));
+          const audioBytes = new Uint8Array(await audioBlob.arrayBuffer());
+          const frame = new Uint8Array(4 + header.length + audioBytes.length);
+          new DataView(frame.buffer).setUint32(0, header.length);
+          frame.set(header, 4);
+          frame.set(audioBytes, 4 + header.length);
+          ws.current.send(frame.buffer);
+          setAudioBlob(null);
         } else {
           // Send text message
           const messageData = {
@@ -427,8 +447,10 @@ function ChatInterface({
   
   // Handle typing status
   const handleTyping = () => {
-    if (!isTyping) {
+    // Refresh periodically while typing; the server expires typing state that is not refreshed
+    if (!isTyping || Date.now() - lastTypingSentRef.current > TYPING_REFRESH_MS) {
       setIsTyping(true);
+      lastTypingSentRef.current = Date.now();
       if (ws.current && ws.current.readyState === WebSocket.OPEN) {
         const typingData = {
           action_type: 'typing',
@@ -492,16 +514,22 @@ function ChatInterface({
     }
   };
 
-  // Send read receipts for messages via WebSocket
+  // Acknowledge receipt of another user's message; the server batches acks into a delivery watermark
+  const acknowledgeMessage = (message) => {
+    if (message.id && message.sender_username !== currentUsername &&
+        ws.current && ws.current.readyState === WebSocket.OPEN) {
+      ws.current.send(JSON.stringify({ action_type: 'ack', message_id: message.id }));
+    }
+  };
+
+  // Move the read watermark up to the newest of these messages via WebSocket
   const markMessagesAsRead = (messageIds) => {
     if (ws.current && ws.current.readyState === WebSocket.OPEN && messageIds.length > 0) {
       const readData = {
         action_type: 'mark_read',
-        reader_username: currentUsername,
-        message_ids: messageIds
+        message_id: Math.max(...messageIds)
       };
       ws.current.send(JSON.stringify(readData));
-      console.log('Sent read receipts for messages:', messageIds);
     }
   };
 
@@ -605,7 +633,7 @@ function ChatInterface({
     
     try {
       const res = await axiosInstance.get(
-        `${ENV.BASE_API_URL}/chat/api/conversation/${selectedConversation.id}/messages/?page=${messagePage + 1}&page_size=15`
+        `${ENV.BASE_API_URL}/chat/api/conversation/${selectedConversation.id}/messages/?before=${olderMessagesCursor}&page_size=15`
       );
 
       if (res.status === 200) {
@@ -770,6 +798,8 @@ function ChatInterface({
                   )}
                   
                   <AudioMessage 
+                    audioUrl={msg.audio_url}
+                    audioDuration={msg.audio_duration}
                     audioData={msg.audio_data_base64} 
                     isCurrentUser={isCurrentUser}
                     messageId={msg.id}
@@ -848,6 +878,8 @@ function ChatInterface({
                         <div className="ml-2 flex-shrink-0">
                           {msg.is_read ? (
                             <CheckCheck size={16} className="text-yellow-400" />
+                          ) : msg.is_delivered ? (
+                            <CheckCheck size={16} className="text-gray-400" />
                           ) : (
                             <Check size={16} className="text-gray-400" />
                           )}
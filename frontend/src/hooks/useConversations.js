@@ -3,9 +3,10 @@ import axiosInstance from '../utils/axiosConfig';
 import ENV from '../config';
 
 // API functions
-const fetchConversations = async ({ pageParam = 1, pageSize = 8 }) => {
+const fetchConversations = async ({ pageParam = null, pageSize = 8 }) => {
+  const cursorParam = pageParam ? `&cursor=${pageParam}` : '';
   const response = await axiosInstance.get(
-    `${ENV.BASE_API_URL}/chat/api/conversations/?page=${pageParam}&page_size=${pageSize}`
+    `${ENV.BASE_API_URL}/chat/api/conversations/?page_size=${pageSize}${cursorParam}`
   );
   return response.data;
 };
@@ -21,10 +22,11 @@ const deleteConversation = async (conversationId) => {
 export const useConversations = (pageSize = 8) => {
   return useInfiniteQuery({
     queryKey: ['conversations'],
-    queryFn: ({ pageParam = 1 }) => fetchConversations({ pageParam, pageSize }),
+    queryFn: ({ pageParam }) => fetchConversations({ pageParam, pageSize }),
+    initialPageParam: null,
     getNextPageParam: (lastPage) => {
-      // Return next page number if there are more pages, otherwise undefined
-      return lastPage.pagination?.has_next ? lastPage.pagination.page + 1 : undefined;
+      // Return the cursor for the next page if there is one, otherwise undefined
+      return lastPage.pagination?.next_cursor || undefined;
     },
     staleTime: 30000, // Consider fresh for 30 seconds
   });
@@ -7,6 +7,7 @@ export const usePagination = (initialPageSize = 20) => {
   const [totalPages, setTotalPages] = useState(0);
   const [hasNext, setHasNext] = useState(false);
   const [hasPrevious, setHasPrevious] = useState(false);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(false);
 
   const updatePaginationData = useCallback((paginationData) => {
@@ -16,6 +17,7 @@ export const usePagination = (initialPageSize = 20) => {
     setTotalPages(paginationData.total_pages);
     setHasNext(paginationData.has_next);
     setHasPrevious(paginationData.has_previous);
+    setNextCursor(paginationData.next_cursor || null);
   }, []);
 
   const goToPage = useCallback((page) => {
@@ -48,6 +50,7 @@ export const usePagination = (initialPageSize = 20) => {
     setTotalPages(0);
     setHasNext(false);
     setHasPrevious(false);
+    setNextCursor(null);
   }, []);
 
   return {
@@ -57,6 +60,7 @@ export const usePagination = (initialPageSize = 20) => {
     totalPages,
     hasNext,
     hasPrevious,
+    nextCursor,
     loading,
     setLoading,
     setPageSize,